@@ -1,161 +1,973 @@
+import asyncio
+import collections
+import itertools
 import time
 import os
+import math
+import re
+from concurrent.futures import ProcessPoolExecutor
+import numpy as np
 import overpy
+import requests
+import shapely
 import helpers
 import nn_isochrones
+import amenity_index
+import geodesic
+import metrics
+from fetch_engine import AsyncFetcher
 
-def get_amenities(lat, lon, api, radius=500, allowed_amenities=None):
+overpass_url = os.getenv("OVERPASS_URL", "https://overpass-api.de/api/interpreter")
+# seconds to wait after an api request to respect the rate limits
+request_pause = 1
+# area overpass searches for the amenities of an isochrone: "circle" around the
+# property through the farthest vertex, "polygon" the isochrone itself as a
+# poly: filter or "envelope" its bounding box. All of them are filtered against
+# the exact isochrone afterwards, so the amenities are the same
+isochrone_query_mode = os.getenv("ISOCHRONE_QUERY_MODE", "circle")
+# degrees the isochrone may be simplified by for the poly: filter, the shell is
+# grown by as much again so it still contains the whole isochrone
+poly_tolerance = 0.0002
+# ask overpass for id, coordinates, name and amenity only (csv) instead of whole nodes (json)
+slim_output = True
+# retries of an overpass query that is answered with 429 or 504, and seconds between them
+overpass_max_retries = 3
+overpass_retry_timeout = 10
+# processes for the cpu bound part of the sweep (search radiuses, index lookups,
+# isochrone filters, json encoding), also of single scenario runs with an offline
+# index. 1 runs everything in this process, the output is the same for any number
+workers = int(os.getenv("WORKERS", "1"))
+
+# list of allowed amenities to search for
+allowed_amenities = [
+    "cafe",
+    "restaurant",
+    "bar",
+    "pub",
+    "fast_food",
+    "school",
+    "university",
+    "library",
+    "hospital",
+    "clinic",
+    "pharmacy",
+    "bank",
+    "atm",
+    "bus_station",
+    "parking"
+]
+
+def get_amenities(lat, lon, api, radius=500, allowed_amenities=None, index=None):
+    # answer locally if an offline amenity index is given
+    if index is not None:
+        with metrics.timer("amenity_index_query_seconds"):
+            return index.query_radius(lat, lon, radius=radius, allowed_amenities=allowed_amenities)
     # query overpass for nodes with an amenity tag in the given radius
-    if allowed_amenities:
-        # build a regex pattern from the allowed amenities list
-        pattern = "^(%s)$" % "|".join(allowed_amenities)
-        filter_str = f'["amenity"~"{pattern}"]'
-    else:
-        filter_str = '["amenity"]'
-    
+    filter_str = helpers.amenity_filter(allowed_amenities)
     query = f"""
     [out:json];
     node(around:{radius},{lat},{lon}){filter_str};
     out;
     """
-    result = api.query(query)
-    amenities = []
-    for node in result.nodes:
-        amenity = {
-            "id": node.id,
-            "name": node.tags.get("name", "n/a"),
-            "amenity": node.tags.get("amenity", "n/a"),
-            "lat": float(node.lat),
-            "lon": float(node.lon)
-        }
-        amenities.append(amenity)
-    return amenities
+    result = overpass_query(api, query)
+    return [helpers.amenity_from_node(node) for node in result.nodes]
+
+def overpass_query(api, query, kind="around"):
+    # api.query with latency, outcome and received nodes in the metrics
+    try:
+        with metrics.timer("api_request_seconds", provider="overpass", query=kind):
+            result = api.query(query)
+    except Exception:
+        metrics.count("api_requests_total", provider="overpass", result="error")
+        raise
+    metrics.count("api_requests_total", provider="overpass", result="ok")
+    metrics.count("api_elements_received_total", len(result.nodes), provider="overpass")
+    return result
+
+def parse_slim_rows(text):
+    """
+    Amenities from the tab separated rows of an out:csv(::id,::lat,::lon,name,amenity) response.
+
+    Overpass does not escape line breaks or tabs in names, so a row ends after its
+    fifth column. A row with more columns can't be split reliably.
+
+    :return: List of amenity dicts, None if a row does not have exactly 5 columns
+    """
+    ams = []
+    row = None
+    for line in text.split("\n"):
+        row = line if row is None else row + "\n" + line
+        if row.count("\t") < 4:
+            continue
+        fields = row.split("\t")
+        if len(fields) != 5:
+            return None
+        osm_id, lat, lon, name, amenity = fields
+        try:
+            ams.append({"id": int(osm_id), "name": name or "n/a", "amenity": amenity or "n/a", "lat": float(lat), "lon": float(lon)})
+        except ValueError:
+            return None
+        row = None
+    # a cut off last row
+    if row:
+        return None
+    return ams
+
+def overpass_error(content):
+    # overpy exception of the error messages in an overpass html page or csv remark, None if there are none
+    text = content.decode("utf-8", errors="replace")
+    messages = [re.sub(r"<[^>]*?>", "", msg).strip() for msg in re.findall(r"<p>(<strong\s.*?)</p>", text, flags=re.S)]
+    messages += [line.strip() for line in text.split("\n") if line.startswith(("runtime error", "runtime remark"))]
+    for msg in messages:
+        if "runtime error" in msg:
+            return overpy.exception.OverpassRuntimeError(msg=msg)
+        if "runtime remark" in msg:
+            return overpy.exception.OverpassRuntimeRemark(msg=msg)
+    if messages:
+        return overpy.exception.OverpassUnknownError(msg="; ".join(messages))
+    return None
+
+def post_slim_query(api, query):
+    """
+    Send a csv query to the url of api and check the answer like overpy.Overpass.query:
+    429 and 504 are retried up to api.max_retry_count times, error pages and remarks
+    are raised as the matching overpy exceptions.
+
+    :return: requests.Response with the csv rows
+    """
+    errors = []
+    for attempt in range(api.max_retry_count + 1):
+        if attempt:
+            time.sleep(api.retry_timeout)
+        response = requests.post(api.url, data={"data": query}, timeout=180)
+        if response.status_code == 429:
+            errors.append(overpy.exception.OverpassTooManyRequests())
+            continue
+        if response.status_code == 504:
+            errors.append(overpy.exception.OverpassGatewayTimeout())
+            continue
+        if response.status_code == 400:
+            error = overpass_error(response.content)
+            raise overpy.exception.OverpassBadRequest(query, msgs=[str(error)] if error else [])
+        if response.status_code != 200:
+            raise overpy.exception.OverpassUnknownHTTPStatusCode(response.status_code)
+        error = overpass_error(response.content)
+        if error is not None:
+            raise error
+        content_type = response.headers.get("Content-Type", "")
+        if not content_type.startswith("text/csv"):
+            raise overpy.exception.OverpassUnknownContentType(content_type)
+        return response
+    raise overpy.exception.MaxRetriesReached(retry_count=api.max_retry_count + 1, exceptions=errors)
+
+def query_amenity_clauses(api, clauses, kind, slim=None):
+    """
+    Run a union of node clauses and return the amenities sorted by id.
+
+    :param api: overpy.Overpass instance, slim queries are sent to its url directly
+    :param clauses: List of overpass node statements
+    :param kind: Query label in the metrics
+    :param slim: Request the csv columns only, slim_output by default
+    """
+    slim = slim_output if slim is None else slim
+    body = "\n".join(clauses)
+    if not slim:
+        query = f"""
+        [out:json];
+        (
+        {body}
+        );
+        out;
+        """
+        result = overpass_query(api, query, kind=kind)
+        return [helpers.amenity_from_node(node) for node in result.nodes]
+    query = f"""
+    [out:csv(::id,::lat,::lon,name,amenity;false)];
+    (
+    {body}
+    );
+    out;
+    """
+    try:
+        with metrics.timer("api_request_seconds", provider="overpass", query=kind):
+            response = post_slim_query(api, query)
+    except Exception:
+        metrics.count("api_requests_total", provider="overpass", result="error")
+        raise
+    metrics.count("api_requests_total", provider="overpass", result="ok")
+    ams = parse_slim_rows(response.content.decode("utf-8"))
+    if ams is None:
+        # a name with a tab in it, the json output has the names as they are
+        print(f"ambiguous csv rows in the overpass response, querying {kind} again as json")
+        return query_amenity_clauses(api, clauses, kind, slim=False)
+    metrics.count("api_bytes_received_total", len(response.content), provider="overpass")
+    metrics.count("api_elements_received_total", len(ams), provider="overpass")
+    return ams
+
+def isochrone_area_filter(polygon_coords, mode=None, tolerance=None):
+    """
+    Overpass spatial filter that covers the whole isochrone.
+
+    :param polygon_coords: List of [lon, lat] vertices of the isochrone
+    :param mode: "polygon" for a poly: filter of the simplified isochrone or
+                 "envelope" for its bounding box, isochrone_query_mode by default
+    :param tolerance: Simplification in degrees, poly_tolerance by default
+    """
+    mode = mode or isochrone_query_mode
+    tolerance = poly_tolerance if tolerance is None else tolerance
+    polygon = shapely.Polygon(polygon_coords)
+    if mode == "envelope":
+        west, south, east, north = polygon.bounds
+        return f"({south},{west},{north},{east})"
+    if mode != "polygon":
+        raise ValueError("mode must be 'polygon' or 'envelope'")
+    # simplifying moves the outline by at most tolerance, growing it by tolerance
+    # again keeps every point of the isochrone inside with only a few vertices
+    shell = polygon.simplify(tolerance).buffer(tolerance, join_style="mitre")
+    # rounding to 6 decimals (~0.1 m) stays well within that margin
+    coords = np.round(np.asarray(shell.exterior.coords)[:-1], 6)
+    return '(poly:"' + " ".join(f"{lat} {lon}" for lon, lat in coords) + '")'
+
+def get_amenities_in_isochrones(isochrones, api, allowed_amenities=None, mode=None, tile_size=20000, max_polygons_per_query=50):
+    """
+    Candidate amenities of many isochrones with the isochrone (or its envelope)
+    as the search area instead of the circle around the property. Isochrones in
+    the same tile are merged into one union query.
+
+    :param isochrones: List of isochrone GeoJSONs
+    :param api: overpy.Overpass instance
+    :param mode: "polygon" or "envelope", isochrone_query_mode by default
+    :return: List of candidate lists in the order of isochrones, the amenities
+             within the bounding box of each isochrone sorted by id, to be
+             filtered with filter_by_isochrone like the circle candidates
+    """
+    mode = mode or isochrone_query_mode
+    filter_str = helpers.amenity_filter(allowed_amenities)
+    polygons = [iso['features'][0]['geometry']['coordinates'][0] for iso in isochrones]
+    tiles = {}
+    for i, coords in enumerate(polygons):
+        lon, lat = coords[0]
+        tiles.setdefault(tile_key(lat, lon, tile_size), []).append(i)
+    results = [None] * len(polygons)
+    for members in tiles.values():
+        for start in range(0, len(members), max_polygons_per_query):
+            chunk = members[start:start + max_polygons_per_query]
+            clauses = [f"node{isochrone_area_filter(polygons[i], mode)}{filter_str};" for i in chunk]
+            ams = query_amenity_clauses(api, clauses, kind=mode)
+            lats = np.array([a["lat"] for a in ams], dtype=float)
+            lons = np.array([a["lon"] for a in ams], dtype=float)
+            # hand the union out by bounding box, the exact isochrone filter comes later
+            for i in chunk:
+                west, south, east, north = shapely.Polygon(polygons[i]).bounds
+                inside = np.flatnonzero((lats >= south) & (lats <= north) & (lons >= west) & (lons <= east))
+                results[i] = [dict(ams[k]) for k in inside]
+            if len(polygons) > 1:
+                time.sleep(request_pause)  # pause to respect api limits
+    return results
+
+def tile_key(lat, lon, tile_size):
+    # snap a point to a square grid cell of tile_size meters
+    y = lat * 111320
+    x = lon * 111320 * math.cos(math.radians(lat))
+    return (math.floor(y / tile_size), math.floor(x / tile_size))
+
+def location_key(lat, lon, snap_tolerance=None):
+    # properties with the same key share their isochrones and amenities,
+    # exact coordinates by default or a grid cell of snap_tolerance meters
+    if not snap_tolerance:
+        return (lat, lon)
+    return tile_key(lat, lon, snap_tolerance)
+
+def copy_amenities(ams):
+    # every property gets its own amenity dicts, they are changed later on
+    return [dict(am) for am in ams]
+
+def get_amenities_batched(points, api, allowed_amenities=None, tile_size=20000, max_points_per_query=50):
+    """
+    Get amenities for many points with one overpass query per spatial tile.
+
+    The query of a tile is the union of the around() searches of its points, so
+    overlapping results are only transferred once. The nodes are then handed out
+    to the points on the client side with the same distance overpass uses.
+
+    :param points: List of (lat, lon, radius) tuples
+    :param api: overpy.Overpass instance
+    :param allowed_amenities: Optional list of amenity types to keep
+    :param tile_size: Edge length of a tile in meters, only the union of the
+                      search circles is transferred so large tiles are fine
+    :param max_points_per_query: Split crowded tiles to keep queries short
+    :return: List of amenity lists in the order of points, same as get_amenities per point
+    """
+    tiles = {}
+    for i, (lat, lon, radius) in enumerate(points):
+        tiles.setdefault(tile_key(lat, lon, tile_size), []).append(i)
+    filter_str = helpers.amenity_filter(allowed_amenities)
+    results = [None] * len(points)
+    queries = 0
+    for members in tiles.values():
+        for start in range(0, len(members), max_points_per_query):
+            chunk = members[start:start + max_points_per_query]
+            clauses = "\n".join(f"node(around:{points[i][2]},{points[i][0]},{points[i][1]}){filter_str};" for i in chunk)
+            query = f"""
+            [out:json];
+            (
+            {clauses}
+            );
+            out;
+            """
+            result = overpass_query(api, query, kind="tile")
+            tile_index = amenity_index.AmenityIndex([helpers.amenity_from_node(node) for node in result.nodes])
+            for i in chunk:
+                lat, lon, radius = points[i]
+                results[i] = tile_index.query_radius(lat, lon, radius=radius, allowed_amenities=allowed_amenities)
+            queries += 1
+            time.sleep(request_pause)  # pause to respect api limits
+    print(f"batched {len(points)} properties into {queries} overpass queries")
+    return results
 
 # Get amenities within a polygon defined by an isochrone
 # an isochrone is a polygon that defines the area reachable within a given time
-def get_amenities_by_isochrone(lat, lon, api, transport_type, distance_in_minutes = 15, allowed_amenities=None):
-    isochrone = None
+def get_isochrone(lat, lon, transport_type, distance_in_minutes=15):
     if transport_type == "walking":
-        isochrone = nn_isochrones.get_isochrone_by_walking_distance(lat, lon, distance_in_minutes)
+        return nn_isochrones.get_isochrone_by_walking_distance(lat, lon, distance_in_minutes)
     elif transport_type == "driving":
-        isochrone = nn_isochrones.get_isochrone_by_driving_distance(lat, lon, distance_in_minutes)
-    else:
+        return nn_isochrones.get_isochrone_by_driving_distance(lat, lon, distance_in_minutes)
+    raise ValueError("transport_type must be 'walking' or 'driving'")
+
+def get_isochrones(lat, lon, transport_type, distances_in_minutes):
+    # several isochrones of one transport type with a single (cached) request
+    if transport_type not in ("walking", "driving"):
         raise ValueError("transport_type must be 'walking' or 'driving'")
-    
+    isochrones = nn_isochrones.get_isochrones(lat, lon, transport_type, distances_in_minutes)
+    missing = [d for d in distances_in_minutes if isochrones.get(d) is None]
+    if missing:
+        raise ValueError(f"no {transport_type} isochrone for {missing} minutes")
+    return isochrones
+
+def isochrone_search_radius(lat, lon, isochrone):
+    # radius of the circle around the property that contains the whole isochrone
+    return isochrone_search_radiuses([(lat, lon)], [isochrone])[0]
+
+def isochrone_search_radiuses(points, isochrones):
+    # isochrone_search_radius of many (lat, lon) points and their isochrones with one vectorized call
+    if not isochrones:
+        return []
+    radiuses = geodesic.farthest_vertex_distances([lat for lat, _ in points], [lon for _, lon in points],
+                                                  [iso['features'][0]['geometry']['coordinates'][0] for iso in isochrones])
+    radiuses = [float(radius) for radius in radiuses]
+    for radius in radiuses:
+        metrics.observe("search_radius_meters", radius, buckets=metrics.size_buckets)
+        print(f"distance: {radius} m")
+    return radiuses
+
+def filter_by_isochrone(amenities, isochrone):
+    if not amenities:
+        return []
     polygon_coords = isochrone['features'][0]['geometry']['coordinates'][0]
-    radius = helpers.farthest_distance_from_center(lat, lon, polygon_coords)
-    print(f"distance: {radius} m")
-    all_amenities = get_amenities(lat, lon, api, radius, allowed_amenities=allowed_amenities)
-    amenities_to_keep = []
-    for amenity in all_amenities:
-        if helpers.within_polygon(polygon_coords, (amenity['lat'], amenity['lon'])):
-            #add isochrone data to amenity
-            amenities_to_keep.append(amenity)
-    return amenities_to_keep, isochrone
-
-def get_amenities_by_walking(lat, lon, api, distance_in_minutes = 15, allowed_amenities=None):
-    return get_amenities_by_isochrone(lat, lon, api,"walking", distance_in_minutes, allowed_amenities=allowed_amenities)
-
-def get_amenities_by_driving(lat, lon, api, distance_in_minutes = 15, allowed_amenities=None):
-    return get_amenities_by_isochrone(lat, lon, api, "driving", distance_in_minutes, allowed_amenities=allowed_amenities)
-
-def add_amenities_to_properties(input_file, output_file, transport_type, radius=500, distance_in_minutes=15, allowed_amenities=None):
-    # load the rental properties from the json file
-    rental_props = helpers.read_json_clean(input_file)
-    api = overpy.Overpass()
-    # if api limits are reached, we still want to save the data
-    # so we will save every n properties
-    save_every_n = 10
+    # one prepared polygon and one vectorized containment call for all candidates
+    mask = helpers.within_polygon_batch(polygon_coords, [a['lat'] for a in amenities], [a['lon'] for a in amenities])
+    kept = [amenity for amenity, keep in zip(amenities, mask) if keep]
+    # share of the search circle candidates that are within the isochrone
+    metrics.count("amenity_candidates_total", len(amenities))
+    metrics.count("amenities_kept_total", len(kept))
+    metrics.observe("amenity_kept_ratio", len(kept) / len(amenities), buckets=metrics.ratio_buckets)
+    return kept
+
+# Get amenities within a polygon defined by an isochrone
+# an isochrone is a polygon that defines the area reachable within a given time
+def get_amenities_by_isochrone(lat, lon, api, transport_type, distance_in_minutes = 15, allowed_amenities=None, index=None):
+    isochrone = get_isochrone(lat, lon, transport_type, distance_in_minutes)
+    if index is None and isochrone_query_mode != "circle":
+        # let overpass cut out the isochrone, only its amenities are transferred
+        all_amenities = get_amenities_in_isochrones([isochrone], api, allowed_amenities=allowed_amenities)[0]
+        return filter_by_isochrone(all_amenities, isochrone), isochrone
+    radius = isochrone_search_radius(lat, lon, isochrone)
+    all_amenities = get_amenities(lat, lon, api, radius, allowed_amenities=allowed_amenities, index=index)
+    return filter_by_isochrone(all_amenities, isochrone), isochrone
+
+def get_amenities_by_walking(lat, lon, api, distance_in_minutes = 15, allowed_amenities=None, index=None):
+    return get_amenities_by_isochrone(lat, lon, api,"walking", distance_in_minutes, allowed_amenities=allowed_amenities, index=index)
+
+def get_amenities_by_driving(lat, lon, api, distance_in_minutes = 15, allowed_amenities=None, index=None):
+    return get_amenities_by_isochrone(lat, lon, api, "driving", distance_in_minutes, allowed_amenities=allowed_amenities, index=index)
+
+def resume_property(prop, done):
+    # we skip properties that already have amenities, to avoid overwriting them and reducing api calls
+    # done is the resume index of helpers.load_resume_index, so this is a dict lookup
+    finished = done.get(prop.get("property_id"))
+    if finished is None:
+        return False
+    # same field order as a freshly fetched property, so resumed rows are written identically
+    if "isochrone" in finished:
+        prop["isochrone"] = finished["isochrone"]
+    prop["amenities"] = finished["amenities"]
+    return True
+
+def prefetch_amenities_batched(props, api, transport_type, radius=500, distance_in_minutes=15, allowed_amenities=None, tile_size=20000):
+    """
+    Fetch amenities for all given properties with tile-batched overpass queries.
+
+    :return: Dict of list position in props -> (amenities, isochrone), properties
+             that failed are left out and fetched one by one afterwards
+    """
+    points = []
+    positions = []
+    isochrones = []
+    for pos, prop in enumerate(props):
+        lat, lon = prop["lat"], prop["lon"]
+        isochrone = None
+        if transport_type in ("walking", "driving"):
+            try:
+                isochrone = get_isochrone(lat, lon, transport_type, distance_in_minutes)
+                if isochrone is None:
+                    raise ValueError(f"no {transport_type} isochrone for {distance_in_minutes} minutes")
+                time.sleep(request_pause)  # pause to respect api limits
+            except Exception as e:
+                print(f"error for {prop['address']} at ({lat}, {lon}): {e}")
+                continue
+        points.append((lat, lon))
+        positions.append(pos)
+        isochrones.append(isochrone)
+    try:
+        if transport_type in ("walking", "driving") and isochrone_query_mode != "circle":
+            # union of the isochrones of a tile instead of the union of their circles
+            results = get_amenities_in_isochrones(isochrones, api, allowed_amenities=allowed_amenities, tile_size=tile_size)
+        else:
+            if transport_type in ("walking", "driving"):
+                # the search radiuses of all isochrones at once
+                radiuses = isochrone_search_radiuses(points, isochrones)
+            else:
+                radiuses = [radius] * len(points)
+            results = get_amenities_batched([(lat, lon, r) for (lat, lon), r in zip(points, radiuses)], api,
+                                            allowed_amenities=allowed_amenities, tile_size=tile_size)
+    except Exception as e:
+        print(f"error in batched fetch, falling back to single queries: {e}")
+        return {}
+    if transport_type in ("walking", "driving"):
+        # filter the candidates of all properties against their isochrones at once
+        masks = helpers.within_polygons_batch(
+            [iso['features'][0]['geometry']['coordinates'][0] for iso in isochrones],
+            [[a['lat'] for a in ams] for ams in results],
+            [[a['lon'] for a in ams] for ams in results])
+        for ams, mask in zip(results, masks):
+            if len(ams):
+                metrics.count("amenity_candidates_total", len(ams))
+                metrics.count("amenities_kept_total", int(mask.sum()))
+                metrics.observe("amenity_kept_ratio", mask.sum() / len(ams), buckets=metrics.ratio_buckets)
+        results = [[a for a, keep in zip(ams, mask) if keep] for ams, mask in zip(results, masks)]
+    return {pos: (ams, isochrone) for pos, isochrone, ams in zip(positions, isochrones, results)}
+
+@metrics.timed("stage_seconds", stage="amenities")
+def add_amenities_to_properties(input_file, output_file, transport_type, radius=500, distance_in_minutes=15, allowed_amenities=None, index_file=None, batch_tile_size=None, concurrency=None, snap_tolerance=None, n_workers=None):
+    # with a concurrency level the properties are fetched by the async engine
+    if concurrency and not index_file and not batch_tile_size:
+        return asyncio.run(add_amenities_to_properties_async(input_file, output_file, transport_type, radius=radius,
+                                                             distance_in_minutes=distance_in_minutes, allowed_amenities=allowed_amenities,
+                                                             concurrency=concurrency, snap_tolerance=snap_tolerance))
+    # with an offline index and more than one worker the properties are filtered in a
+    # process pool, that is the sweep with this one scenario and gives the same output
+    n_workers = n_workers or workers
+    if index_file and n_workers > 1:
+        scenario = {"transport_type": transport_type, "radius": radius, "distance_in_minutes": distance_in_minutes, "output_file": output_file}
+        return add_amenities_sweep(input_file, [scenario], allowed_amenities=allowed_amenities, index_file=index_file,
+                                   snap_tolerance=snap_tolerance, n_workers=n_workers)
+    # stream the rental properties from the json file, only the batched mode
+    # needs all of them up front
+    if batch_tile_size and not index_file:
+        rental_props = helpers.read_json_clean(input_file)
+    else:
+        rental_props = helpers.iter_json_clean(input_file)
+    api = overpy.Overpass(url=overpass_url, max_retry_count=overpass_max_retries, retry_timeout=overpass_retry_timeout)
+    # with an offline amenity index we don't query overpass at all
+    index = amenity_index.AmenityIndex.load(index_file) if index_file else None
     iteration = 0
-    current_data = []
-    # get output file data if file already exists
-    if os.path.exists(output_file):
-        current_data = helpers.read_json_clean(output_file)
+    # finished properties of an earlier run (output file and checkpoint journal)
+    done = helpers.load_resume_index(output_file)
     max_iterations = -1
+    # in batched mode fetch everything that is not done yet with one query per tile
+    prefetched = {}
+    if batch_tile_size and index is None:
+        # only the first property of every location is fetched, the others reuse its result
+        pending = {}
+        for pos, prop in enumerate(rental_props):
+            if prop.get("lat") is not None and prop.get("lon") is not None and prop.get("property_id") not in done:
+                pending.setdefault(location_key(prop["lat"], prop["lon"], snap_tolerance), pos)
+        pending = list(pending.values())
+        batch = prefetch_amenities_batched([rental_props[pos] for pos in pending], api, transport_type, radius=radius,
+                                           distance_in_minutes=distance_in_minutes, allowed_amenities=allowed_amenities,
+                                           tile_size=batch_tile_size)
+        prefetched = {pending[i]: result for i, result in batch.items()}
+    # if api limits are reached, we still want to keep the data, so every
+    # property is appended to the journal in input order as soon as it is done
+    journal = helpers.open_journal(output_file)
+    # the complete output of this run starts at the current end of the journal
+    start = journal.tell()
+    stopped = False
+    # results per location, properties in the same building are only fetched once.
+    # an entry is dropped after the last property that needs it, so only the
+    # locations still in use are kept in memory
+    locations = {}
+    last_use = {}
+    for pos, prop in enumerate(helpers.iter_json_clean(input_file)):
+        if prop.get("lat") is not None and prop.get("lon") is not None and prop.get("property_id") not in done:
+            last_use[location_key(prop["lat"], prop["lon"], snap_tolerance)] = pos
+    n_locations = 0
+    saved_isochrones = 0
+    saved_amenities = 0
     # for each property, get nearby allowed amenities
+    for pos, prop in enumerate(rental_props):
+        fetched = False
+        lat = prop.get("lat")
+        lon = prop.get("lon")
+        key = location_key(lat, lon, snap_tolerance) if lat is not None and lon is not None else None
+        if stopped or (max_iterations != -1 and iteration >= max_iterations):
+            # keep the remaining properties unchanged in the output
+            if not stopped:
+                print("max iterations reached, stopping...")
+                stopped = True
+        elif lat is None or lon is None:
+            prop["amenities"] = []
+        elif resume_property(prop, done):
+            print(f"skipping {prop['address']} at ({lat}, {lon}), because it already has amenities")
+            iteration += 1
+        elif key in locations:
+            ams, isochrone = locations[key]
+            if isochrone is not None:
+                prop["isochrone"] = isochrone
+                saved_isochrones += 1
+            prop["amenities"] = copy_amenities(ams)
+            saved_amenities += 1
+            print(f"amenities for {prop['address']} at ({lat}, {lon}): {len(ams)} found at the same location")
+            iteration += 1
+            fetched = True
+        else:
+            try:
+                isochrone = None
+                if pos in prefetched:
+                    ams, isochrone = prefetched[pos]
+                    if isochrone is not None:
+                        prop["isochrone"] = isochrone
+                elif transport_type == "walking":
+                    ams, isochrone = get_amenities_by_walking(lat, lon, api, distance_in_minutes=distance_in_minutes, allowed_amenities=allowed_amenities, index=index)
+                    prop["isochrone"] = isochrone
+                elif transport_type == "driving":
+                    ams, isochrone = get_amenities_by_driving(lat, lon, api, distance_in_minutes=distance_in_minutes, allowed_amenities=allowed_amenities, index=index)
+                    prop["isochrone"] = isochrone
+                else:
+                    ams = get_amenities(lat, lon, api, radius=radius, allowed_amenities=allowed_amenities, index=index)
+                if transport_type not in ("walking", "driving"):
+                    # add radius to each amenity
+                    for am in ams:
+                        am["radius"] = radius
+                prop["amenities"] = ams
+                locations[key] = (copy_amenities(ams), isochrone)
+                n_locations += 1
+                print(f"amenities for {prop['address']} at ({lat}, {lon}): {len(ams)} found")
+            except Exception as e:
+                print(f"error for {prop['address']} at ({lat}, {lon}): {e}")
+                prop["amenities"] = []
+
+            # pause to respect api limits, not needed for local or prefetched lookups
+            if pos not in prefetched and (index is None or transport_type in ("walking", "driving")):
+                time.sleep(request_pause)
+            iteration += 1
+            fetched = True
+        if key is not None and last_use.get(key) == pos:
+            locations.pop(key, None)
+        # only freshly fetched properties need to be synced, the rest is on disk already
+        helpers.append_journal(journal, prop, sync=fetched)
+    journal.close()
+    print(f"{n_locations} locations fetched, shared results saved {saved_isochrones} isochrone and {saved_amenities} amenity lookups")
+
+    # the journal now ends with the complete output, copy it over and drop the journal
+    helpers.compact_journal(output_file, start=start)
+
+async def get_amenities_async(fetcher, lat, lon, radius=500, allowed_amenities=None):
+    # same query as get_amenities, sent through the async fetch engine
+    filter_str = helpers.amenity_filter(allowed_amenities)
+    query = f"""
+    [out:json];
+    node(around:{radius},{lat},{lon}){filter_str};
+    out;
+    """
+    data = await fetcher.post_json("overpass", overpass_url, data={"data": query})
+    return [amenity_index.amenity_from_element(e) for e in data.get("elements", []) if e.get("type") == "node"]
+
+async def get_property_amenities_async(fetcher, lat, lon, transport_type, radius=500, distance_in_minutes=15, allowed_amenities=None):
+    # async version of the per property fetch in add_amenities_to_properties
+    if transport_type in ("walking", "driving"):
+        isochrones = await nn_isochrones.get_isochrones_async(fetcher, lat, lon, transport_type, [distance_in_minutes])
+        isochrone = isochrones[distance_in_minutes]
+        if isochrone is None:
+            raise ValueError(f"no {transport_type} isochrone for {distance_in_minutes} minutes")
+        search_radius = isochrone_search_radius(lat, lon, isochrone)
+        ams = await get_amenities_async(fetcher, lat, lon, search_radius, allowed_amenities=allowed_amenities)
+        return filter_by_isochrone(ams, isochrone), isochrone
+    ams = await get_amenities_async(fetcher, lat, lon, radius, allowed_amenities=allowed_amenities)
+    # add radius to each amenity
+    for am in ams:
+        am["radius"] = radius
+    return ams, None
+
+async def add_amenities_to_properties_async(input_file, output_file, transport_type, radius=500, distance_in_minutes=15, allowed_amenities=None, concurrency=4, rate_limits=None, snap_tolerance=None):
+    """
+    Concurrent version of add_amenities_to_properties.
+
+    Properties are fetched with up to concurrency requests in flight, the rate
+    limits per provider and the retries are handled by fetch_engine.AsyncFetcher.
+    The output is written in input order, like the sequential version.
+
+    :param concurrency: Maximum number of requests in flight
+    :param rate_limits: Optional dict of provider -> (requests per second, burst size)
+    :param snap_tolerance: Optional grid size in meters, properties in the same cell share one fetch
+    """
+    rental_props = helpers.read_json_clean(input_file)
+    done = helpers.load_resume_index(output_file)
+    # pending properties grouped by location, the first one of a group is fetched
+    pending = {}
     for prop in rental_props:
-        if max_iterations != -1 and iteration >= max_iterations:
-            print("max iterations reached, stopping...")
-            break
         lat = prop.get("lat")
         lon = prop.get("lon")
-        property_id = prop.get("property_id") 
         if lat is None or lon is None:
             prop["amenities"] = []
             continue
-        # we skip properties that already have amenities, to avoid overwriting them and reducing api calls
-        # check if property_id and amenities are in current_data
-        if property_id and any(p.get("property_id") == property_id for p in current_data):
-            # check if amenities are already in current_data
-            if any(p.get("property_id") == property_id and p.get("amenities") for p in current_data):
-                # get the amenities from current_data
-                prop["amenities"] = [p.get("amenities") for p in current_data if p.get("property_id") == property_id][0]
-                print(f"skipping {prop['address']} at ({lat}, {lon}), because it already has amenities")
-                iteration += 1
-                continue
+        if resume_property(prop, done):
+            print(f"skipping {prop['address']} at ({lat}, {lon}), because it already has amenities")
+            continue
+        pending.setdefault(location_key(lat, lon, snap_tolerance), []).append(prop)
+
+    journal = helpers.open_journal(output_file)
+    async with AsyncFetcher(concurrency=concurrency, rate_limits=rate_limits) as fetcher:
+        async def fetch_location(props):
+            lat, lon = props[0]["lat"], props[0]["lon"]
+            try:
+                ams, isochrone = await get_property_amenities_async(fetcher, lat, lon, transport_type, radius=radius,
+                                                                    distance_in_minutes=distance_in_minutes, allowed_amenities=allowed_amenities)
+                print(f"amenities for {props[0]['address']} at ({lat}, {lon}): {len(ams)} found for {len(props)} properties")
+            except Exception as e:
+                print(f"error for {props[0]['address']} at ({lat}, {lon}): {e}")
+                ams, isochrone = [], None
+            for prop in props:
+                if isochrone is not None:
+                    prop["isochrone"] = isochrone
+                prop["amenities"] = copy_amenities(ams)
+                if prop["amenities"]:
+                    helpers.append_journal(journal, prop)
+
+        await asyncio.gather(*(fetch_location(props) for props in pending.values()))
+        n_props = sum(len(props) for props in pending.values())
+        print(f"{n_props} properties fetched at {len(pending)} locations ({n_props - len(pending)} fetches saved) "
+              f"with {fetcher.retries} retries")
+    journal.close()
+
+    helpers.compact_journal(output_file, rental_props)
+
+def get_scenarios(radiuses, distances_in_minutes, transport_types):
+    # one scenario per (transport type, distance) pair, the radius scenarios are
+    # paired with the isochrone distances by position like in main
+    scenarios = []
+    for index, distance_in_minutes in enumerate(distances_in_minutes):
+        for transport_type in transport_types:
+            scenario = {
+                "transport_type": transport_type,
+                "radius": radiuses[index],
+                "distance_in_minutes": distance_in_minutes,
+            }
+            scenario["output_file"] = helpers.scenario_file(helpers.scenario_name(scenario))
+            scenarios.append(scenario)
+    return scenarios
+
+def derive_scenario_amenities(lat, lon, candidates, scenarios, isochrones, search_radiuses):
+    """
+    Derive the amenities of every scenario from one candidate fetch at the largest extent.
+
+    :param candidates: Amenities within the largest search radius of all scenarios
+    :param scenarios: List of scenario dicts from get_scenarios
+    :param isochrones: List of isochrone GeoJSONs (None for radius scenarios) in scenario order
+    :param search_radiuses: Search radius of every scenario, as a single scenario run would query it
+    :return: List of amenity lists in scenario order
+    """
+    # results are nested, so each scenario is a local filter of the largest fetch:
+    # first the circle the single scenario query would use, then its isochrone
+    candidate_index = amenity_index.AmenityIndex(candidates)
+    results = []
+    for scenario, isochrone, search_radius in zip(scenarios, isochrones, search_radiuses):
+        ams = candidate_index.query_radius(lat, lon, radius=search_radius)
+        if isochrone is None:
+            for am in ams:
+                am["radius"] = scenario["radius"]
+        else:
+            ams = filter_by_isochrone(ams, isochrone)
+        results.append(ams)
+    return results
+
+def derive_location(lat, lon, missing, isochrones, search_radiuses, candidates, scenarios, api=None, index=None, allowed_amenities=None):
+    """
+    Amenities of the missing scenarios of one location of the sweep.
+
+    :param missing: Positions of the scenarios to derive in scenarios
+    :param isochrones: Isochrone GeoJSONs of the missing scenarios, None for radius scenarios
+    :param search_radiuses: Search radius of every missing scenario, None to compute them from the isochrones
+    :param candidates: Amenities within the largest search radius, None to look them up in index or with api
+    :return: (number of candidates, dict of scenario position -> (isochrone, amenities))
+    """
+    if search_radiuses is None:
+        search_radiuses = [scenarios[k]["radius"] if isochrone is None else isochrone_search_radius(lat, lon, isochrone)
+                           for k, isochrone in zip(missing, isochrones)]
+    if candidates is None:
+        candidates = get_amenities(lat, lon, api, max(search_radiuses), allowed_amenities=allowed_amenities, index=index)
+        if index is None:
+            time.sleep(request_pause)  # pause to respect api limits
+    results = derive_scenario_amenities(lat, lon, candidates, [scenarios[k] for k in missing], isochrones, search_radiuses)
+    return len(candidates), dict(zip(missing, zip(isochrones, results)))
+
+def scenario_lines(prop, results):
+    # output json line of a property in every scenario of results
+    lines = {}
+    for k, (isochrone, ams) in results.items():
+        output = dict(prop)
+        if isochrone is not None:
+            output["isochrone"] = isochrone
+        output["amenities"] = ams
+        lines[k] = helpers.json_dumps(output) + "\n"
+    return lines
+
+def derive_rows(rows, scenarios, api=None, index=None, allowed_amenities=None):
+    """
+    Output lines of the sweep, the amenities of a location are derived once for all its properties.
+
+    :param rows: Iterable of (property, location), location is None if there is nothing to derive, else
+                 (location number, last property of the location, lat, lon, missing, isochrones, search_radiuses, candidates)
+    :return: Generator of (property, location number, status, dict of scenario position -> json line) in the order
+             of rows, status is the number of candidates or an error message for the property a location is derived
+             at, else None
+    """
+    results = {}
+    for prop, location in rows:
+        if location is None:
+            yield prop, None, None, {}
+            continue
+        t, last, *inputs = location
+        status = None
+        if t not in results:
+            try:
+                status, results[t] = derive_location(*inputs, scenarios, api=api, index=index, allowed_amenities=allowed_amenities)
+            except Exception as e:
+                status, results[t] = str(e), {}
+        yield prop, t, status, scenario_lines(prop, results[t])
+        if last:
+            del results[t]
+
+worker_index = None
+worker_scenarios = None
+worker_allowed_amenities = None
+
+def init_sweep_worker(index_file, scenarios, allowed_amenities):
+    # every worker process loads the offline amenity index and the scenarios once
+    global worker_index, worker_scenarios, worker_allowed_amenities
+    worker_index = amenity_index.AmenityIndex.load(index_file) if index_file else None
+    worker_scenarios = scenarios
+    worker_allowed_amenities = allowed_amenities
+
+def derive_rows_chunk(rows):
+    # derive_rows of a chunk of rows in a worker process, a location with properties
+    # in several chunks is derived again in each of them
+    return list(derive_rows(rows, worker_scenarios, index=worker_index, allowed_amenities=worker_allowed_amenities))
+
+def derive_rows_parallel(rows, scenarios, index_file, allowed_amenities, n_workers, chunk_size=256):
+    """
+    derive_rows over chunks of rows in a process pool, in the order of rows.
+
+    Only the properties, the isochrones and candidates of their locations go to
+    the workers and only encoded json lines come back. At most two chunks per
+    process are in flight, so rows can be a generator over the input file.
+    """
+    rows = iter(rows)
+    pending = collections.deque()
+    with ProcessPoolExecutor(max_workers=n_workers, initializer=init_sweep_worker,
+                             initargs=(index_file, scenarios, allowed_amenities)) as pool:
+        while True:
+            while len(pending) < 2 * n_workers:
+                chunk = list(itertools.islice(rows, chunk_size))
+                if not chunk:
+                    break
+                pending.append(pool.submit(derive_rows_chunk, chunk))
+            if not pending:
+                return
+            yield from pending.popleft().result()
+
+@metrics.timed("stage_seconds", stage="amenities_sweep")
+def add_amenities_sweep(input_file, scenarios, allowed_amenities=None, index_file=None, batch_tile_size=None, snap_tolerance=None, n_workers=None):
+    """
+    Run all scenarios in one pass: fetch the candidate amenities once per
+    location at the largest extent and write every scenario output file.
+    The input is streamed, only the locations to fetch are kept in memory.
+
+    :param input_file: Geocoded properties (one json per line)
+    :param scenarios: List of scenario dicts from get_scenarios
+    :param snap_tolerance: Optional grid size in meters, properties in the same
+                           cell share the results of the first one instead of
+                           only properties with identical coordinates
+    :param n_workers: Processes for the search radiuses, candidate filtering and
+                      json encoding once no more network calls are needed (offline
+                      index or batched fetch), workers by default
+    """
+    n_workers = n_workers or workers
+    api = overpy.Overpass(url=overpass_url, max_retry_count=overpass_max_retries, retry_timeout=overpass_retry_timeout)
+    index = amenity_index.AmenityIndex.load(index_file) if index_file else None
+    done = [helpers.load_resume_index(s["output_file"]) for s in scenarios]
+    # the local isochrone backend computes all origins in one batch up front
+    points = [(prop["lat"], prop["lon"]) for prop in helpers.iter_json_clean(input_file)
+              if prop.get("lat") is not None and prop.get("lon") is not None]
+    for transport_type in ("walking", "driving"):
+        minutes = sorted({s["distance_in_minutes"] for s in scenarios if s["transport_type"] == transport_type})
+        nn_isochrones.prefetch_isochrones(points, transport_type, minutes)
+    # the batched fetch needs the search radiuses up front, otherwise they are
+    # computed where the location is derived
+    batched = bool(batch_tile_size) and index is None
+
+    # first pass: get the isochrones of the missing scenarios, once per location.
+    # members maps the input position of every property that needs amenities to
+    # its location in todo, the other properties there reuse the results
+    todo = []
+    locations = {}
+    members = {}
+    last_member = {}
+    n_members = {}
+    saved_isochrones = 0
+    for pos, prop in enumerate(helpers.iter_json_clean(input_file)):
+        lat, lon = prop.get("lat"), prop.get("lon")
+        if lat is None or lon is None:
+            continue
+        missing = [k for k in range(len(scenarios)) if done[k].get(prop.get("property_id")) is None]
+        if not missing:
+            print(f"skipping {prop['address']} at ({lat}, {lon}), because it already has amenities")
+            continue
+        key = (location_key(lat, lon, snap_tolerance), tuple(missing))
+        if key in locations:
+            members[pos] = locations[key]
+            last_member[locations[key]] = pos
+            n_members[locations[key]] += 1
+            saved_isochrones += len({scenarios[k]["transport_type"] for k in missing} & {"walking", "driving"})
+            continue
         try:
-            if transport_type == "walking":
-                ams, isochrone = get_amenities_by_walking(lat, lon, api, distance_in_minutes=distance_in_minutes, allowed_amenities=allowed_amenities)
-                prop["isochrone"] = isochrone
-            elif transport_type == "driving":
-                ams, isochrone = get_amenities_by_driving(lat, lon, api, distance_in_minutes=distance_in_minutes, allowed_amenities=allowed_amenities)
-                prop["isochrone"] = isochrone
-            else:
-                ams = get_amenities(lat, lon, api, radius=radius, allowed_amenities=allowed_amenities)
-                # add radius to each amenity
-                for am in ams:
-                    am["radius"] = radius
-            prop["amenities"] = ams
-            print(f"amenities for {prop['address']} at ({lat}, {lon}): {len(ams)} found")
+            # all contours of a transport type come from one request
+            contours = {}
+            for transport_type in ("walking", "driving"):
+                minutes = [scenarios[k]["distance_in_minutes"] for k in missing if scenarios[k]["transport_type"] == transport_type]
+                if minutes:
+                    contours[transport_type] = get_isochrones(lat, lon, transport_type, minutes)
+            isochrones = [contours[scenarios[k]["transport_type"]][scenarios[k]["distance_in_minutes"]]
+                          if scenarios[k]["transport_type"] in ("walking", "driving") else None for k in missing]
+            for k, isochrone in zip(missing, isochrones):
+                if isochrone is None and scenarios[k]["transport_type"] in ("walking", "driving"):
+                    raise ValueError(f"no {scenarios[k]['transport_type']} isochrone for {scenarios[k]['distance_in_minutes']} minutes")
         except Exception as e:
+            # the property is written without amenities, the next one at this location tries again
             print(f"error for {prop['address']} at ({lat}, {lon}): {e}")
-            prop["amenities"] = []
-        
-        time.sleep(1)  # pause to respect api limits
-        iteration += 1
-        if iteration % save_every_n == 0:
-            print(f"saving {iteration} properties...")
-            # save the data to a json file if api limits are reached
-            # we will save the data every n properties to avoid losing data
-            helpers.save_json_clean(output_file, rental_props)
-
-    # write the updated data to a new json file
-    helpers.save_json_clean(output_file, rental_props)
+            continue
+        locations[key] = members[pos] = len(todo)
+        last_member[len(todo)] = pos
+        n_members[len(todo)] = 1
+        todo.append([lat, lon, missing, isochrones, None, None])
+
+    # second pass: one candidate fetch per tile at the largest extent
+    prefetched = False
+    if batched and todo:
+        # the search radiuses of all isochrones of the first pass at once
+        pairs = [(location, i) for location in todo for i, isochrone in enumerate(location[3]) if isochrone is not None]
+        radiuses = isochrone_search_radiuses([(location[0], location[1]) for location, _ in pairs],
+                                             [location[3][i] for location, i in pairs])
+        for location in todo:
+            location[4] = [scenarios[k]["radius"] for k in location[2]]
+        for (location, i), radius in zip(pairs, radiuses):
+            location[4][i] = radius
+        points = [(lat, lon, max(search_radiuses)) for lat, lon, _, _, search_radiuses, _ in todo]
+        try:
+            for location, candidates in zip(todo, get_amenities_batched(points, api, allowed_amenities=allowed_amenities, tile_size=batch_tile_size)):
+                location[5] = candidates
+            prefetched = True
+        except Exception as e:
+            print(f"error in batched fetch, falling back to single queries: {e}")
+
+    def location_rows():
+        # (property, location) per input row, a location is dropped after its last property
+        for pos, prop in enumerate(helpers.iter_json_clean(input_file)):
+            t = members.get(pos)
+            if t is None:
+                yield prop, None
+                continue
+            yield prop, (t, last_member[t] == pos, *todo[t])
+            if last_member[t] == pos:
+                todo[t] = None
+
+    # third pass: stream the input again and append every property of every scenario
+    # to its journal in input order, like add_amenities_to_properties. Without network
+    # calls left the locations are derived in a process pool
+    if n_workers > 1 and (prefetched or index is not None):
+        rows = derive_rows_parallel(location_rows(), scenarios, index_file if not prefetched else None, allowed_amenities, n_workers)
+    else:
+        rows = derive_rows(location_rows(), scenarios, api=api, index=index, allowed_amenities=allowed_amenities)
+    # the complete output of this run starts at the current end of each journal
+    journals = [helpers.open_journal(s["output_file"]) for s in scenarios]
+    starts = [journal.tell() for journal in journals]
+    reported = set()
+    for prop, t, status, lines in rows:
+        lat, lon = prop.get("lat"), prop.get("lon")
+        # a location derived in several chunks of the pool is reported once
+        if status is not None and t not in reported:
+            reported.add(t)
+            if isinstance(status, str):
+                print(f"error for {prop['address']} at ({lat}, {lon}): {status}")
+            else:
+                print(f"amenities for {prop['address']} at ({lat}, {lon}): {status} candidates for {len(lines)} scenarios "
+                      f"and {n_members[t]} properties")
+        for k, journal in enumerate(journals):
+            if k in lines:
+                # only freshly fetched properties need to be synced, the rest is on disk already
+                helpers.append_journal_line(journal, lines[k])
+                continue
+            output = dict(prop)
+            if lat is None or lon is None or not resume_property(output, done[k]):
+                output["amenities"] = []
+            helpers.append_journal(journal, output, sync=False)
+    for journal in journals:
+        journal.close()
+    n_shared = sum(n_members.values()) - len(todo)
+    print(f"{len(todo)} locations fetched, shared results saved {saved_isochrones} isochrone and {n_shared} amenity lookups")
+
+    # every journal now ends with the complete output, copy it over and drop the journal
+    for scenario, start in zip(scenarios, starts):
+        helpers.compact_journal(scenario["output_file"], start=start)
 
 def main():
     input_file = 'rental_properties_geocoded.json'
     radiuses = [500, 1000, 1500]  # search radius in meters
     distances_in_minutes = [3, 7, 10]  # distance in minutes for isochrone
     transport_types = ["driving","walking", "radius"]
-    # list of allowed amenities to search for
-    allowed_amenities = [
-        "cafe",
-        "restaurant",
-        "bar",
-        "pub",
-        "fast_food",
-        "school",
-        "university",
-        "library",
-        "hospital",
-        "clinic",
-        "pharmacy",
-        "bank",
-        "atm",
-        "bus_station",
-        "parking"
-    ]
-    for index, distance_in_minutes in enumerate(distances_in_minutes):
+    # optional offline amenity index, build it with amenity_index.main()
+    index_file = 'amenity_index.pkl' if os.path.exists('amenity_index.pkl') else None
+    # group properties into tiles of n meters and send one overpass query per tile
+    # set to None to query overpass once per property
+    batch_tile_size = 20000
+    # fetch n properties concurrently with the async engine (single scenario runs without batching)
+    concurrency = None
+    # fetch once per property at the largest extent and derive all scenarios from it
+    sweep = True
+    # properties closer than n meters (same grid cell) share isochrones and amenities,
+    # None only shares them between identical coordinates
+    snap_tolerance = None
+    # processes for the filtering once all candidates are fetched (sweep) or with an offline index
+    n_workers = workers
+    scenarios = get_scenarios(radiuses, distances_in_minutes, transport_types)
+    if sweep:
+        add_amenities_sweep(input_file, scenarios, allowed_amenities=allowed_amenities, index_file=index_file, batch_tile_size=batch_tile_size, snap_tolerance=snap_tolerance, n_workers=n_workers)
+    else:
         #get amenties for all types
-        for transport_type in transport_types:
-            print(f"getting amenities for {transport_type}...")
-            if transport_type == "walking":
-                output_file = f'rental_properties_with_walking_{distance_in_minutes}_amenities.json'
-            elif transport_type == "driving":
-                output_file = f'rental_properties_with_driving_{distance_in_minutes}_amenities.json'
-            else:
-                output_file = f'rental_properties_with_radius_{radiuses[index]}_amenities.json'
-            add_amenities_to_properties(input_file, output_file, transport_type, radius=radiuses[index], distance_in_minutes=distance_in_minutes, allowed_amenities=allowed_amenities)
+        for scenario in scenarios:
+            print(f"getting amenities for {scenario['transport_type']}...")
+            add_amenities_to_properties(input_file, scenario["output_file"], scenario["transport_type"], radius=scenario["radius"], distance_in_minutes=scenario["distance_in_minutes"], allowed_amenities=allowed_amenities, index_file=index_file, batch_tile_size=batch_tile_size, concurrency=concurrency, snap_tolerance=snap_tolerance, n_workers=n_workers)
+    metrics.write_summary()
     print("all done!")
 
 
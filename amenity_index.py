@@ -0,0 +1,174 @@
+# Offline amenity index
+# loads all amenity nodes of a region once (from a local overpass json dump or a
+# single bbox query) and answers radius lookups locally instead of sending one
+# overpass query per property
+import json
+import os
+import pickle
+import numpy as np
+import overpy
+from sklearn.neighbors import BallTree
+import helpers
+
+# overpass measures around distances on a sphere where a quarter meridian is
+# exactly 10'000 km, using the same radius keeps local results identical
+OVERPASS_EARTH_RADIUS = 2e7 / np.pi  # meters
+
+
+class AmenityIndex:
+    """
+    In-memory spatial index over amenity nodes.
+
+    Amenities are stored in the same schema as amenities.get_amenities
+    (id, name, amenity, lat, lon) and kept sorted by id, which is the order
+    overpass returns nodes in.
+    """
+
+    def __init__(self, amenities):
+        # dedup by osm id, a dump can contain the same node more than once
+        unique = {a["id"]: a for a in amenities}
+        self.amenities = [unique[i] for i in sorted(unique)]
+        self.types = np.array([a["amenity"] for a in self.amenities], dtype=object)
+        coords = np.array([[a["lat"], a["lon"]] for a in self.amenities], dtype=float).reshape(-1, 2)
+        # haversine ball tree expects (lat, lon) in radians
+        self.tree = BallTree(np.radians(coords), leaf_size=15, metric='haversine') if len(coords) else None
+
+    def __len__(self):
+        return len(self.amenities)
+
+    def query_radius(self, lat, lon, radius=500, allowed_amenities=None):
+        """
+        Get all amenities within radius meters of a point.
+
+        :param lat: Latitude of the point
+        :param lon: Longitude of the point
+        :param radius: Search radius in meters
+        :param allowed_amenities: Optional list of amenity types to keep
+        :return: List of amenity dicts sorted by id
+        """
+        if self.tree is None:
+            return []
+        point = np.radians([[lat, lon]])
+        indices = self.tree.query_radius(point, r=radius / OVERPASS_EARTH_RADIUS)[0]
+        indices.sort()
+        if allowed_amenities:
+            indices = indices[np.isin(self.types[indices], list(allowed_amenities))]
+        # return copies, callers add fields like "radius" to the dicts
+        return [dict(self.amenities[i]) for i in indices]
+
+    def save(self, file_name):
+        with open(file_name, 'wb') as f:
+            pickle.dump(self, f, protocol=pickle.HIGHEST_PROTOCOL)
+        print(f"amenity index with {len(self)} nodes saved to {file_name}")
+
+    @staticmethod
+    def load(file_name):
+        with open(file_name, 'rb') as f:
+            return pickle.load(f)
+
+
+def amenity_from_element(element):
+    # convert an overpass json element to the get_amenities schema
+    tags = element.get("tags", {})
+    return {
+        "id": element["id"],
+        "name": tags.get("name", "n/a"),
+        "amenity": tags.get("amenity", "n/a"),
+        "lat": float(element["lat"]),
+        "lon": float(element["lon"])
+    }
+
+
+def build_index_from_dump(dump_file, allowed_amenities=None):
+    """
+    Build an amenity index from a local overpass/osm json dump.
+
+    :param dump_file: Path to a json file with an "elements" list ([out:json] format)
+    :param allowed_amenities: Optional list of amenity types to keep
+    :return: AmenityIndex
+    """
+    with open(dump_file, 'r', encoding='utf-8') as f:
+        data = json.load(f)
+    amenities = []
+    for element in data.get("elements", []):
+        if element.get("type") != "node" or "lat" not in element:
+            continue
+        amenity = amenity_from_element(element)
+        if allowed_amenities and amenity["amenity"] not in allowed_amenities:
+            continue
+        amenities.append(amenity)
+    return AmenityIndex(amenities)
+
+
+def build_index_from_bbox(bbox, api=None, allowed_amenities=None, timeout=600):
+    """
+    Build an amenity index with one overpass query over a bounding box.
+
+    :param bbox: (south, west, north, east) in degrees
+    :param api: overpy.Overpass instance, a new one for OVERPASS_URL is created if None
+    :param allowed_amenities: Optional list of amenity types to keep
+    :param timeout: Overpass server side timeout in seconds
+    :return: AmenityIndex
+    """
+    if api is None:
+        api = overpy.Overpass(url=os.getenv("OVERPASS_URL", "https://overpass-api.de/api/interpreter"))
+    filter_str = helpers.amenity_filter(allowed_amenities)
+    south, west, north, east = bbox
+    query = f"""
+    [out:json][timeout:{timeout}];
+    node({south},{west},{north},{east}){filter_str};
+    out;
+    """
+    result = api.query(query)
+    amenities = [helpers.amenity_from_node(node) for node in result.nodes]
+    return AmenityIndex(amenities)
+
+
+def bbox_of_properties(properties, padding=2000):
+    """
+    Get the bounding box of all geocoded properties, padded by padding meters.
+
+    :return: (south, west, north, east) in degrees
+    """
+    lats = [p["lat"] for p in properties if p.get("lat") is not None and p.get("lon") is not None]
+    lons = [p["lon"] for p in properties if p.get("lat") is not None and p.get("lon") is not None]
+    if not lats:
+        raise ValueError("no geocoded properties to build a bounding box from")
+    pad_lat = padding / 111320
+    pad_lon = padding / (111320 * np.cos(np.radians(max(abs(min(lats)), abs(max(lats))))))
+    return (min(lats) - pad_lat, min(lons) - pad_lon, max(lats) + pad_lat, max(lons) + pad_lon)
+
+
+def load_or_build_index(index_file, dump_file=None, bbox=None, api=None, allowed_amenities=None):
+    """
+    Load a saved amenity index, or build it from a dump / bbox query and save it.
+
+    :param index_file: Path of the pickled index, used as warm start on later runs
+    :param dump_file: Optional local overpass json dump to build from
+    :param bbox: Optional (south, west, north, east) to query if there is no dump
+    :return: AmenityIndex
+    """
+    if os.path.exists(index_file):
+        return AmenityIndex.load(index_file)
+    if dump_file:
+        index = build_index_from_dump(dump_file, allowed_amenities=allowed_amenities)
+    elif bbox:
+        index = build_index_from_bbox(bbox, api=api, allowed_amenities=allowed_amenities)
+    else:
+        raise ValueError("index file not found, either dump_file or bbox is required to build it")
+    index.save(index_file)
+    return index
+
+
+def main():
+    input_file = 'rental_properties_geocoded.json'
+    index_file = 'amenity_index.pkl'
+    properties = helpers.read_json_clean(input_file)
+    # pad by more than the largest search radius (driving isochrones reach a few km)
+    bbox = bbox_of_properties(properties, padding=10000)
+    from amenities import allowed_amenities
+    load_or_build_index(index_file, bbox=bbox, allowed_amenities=allowed_amenities)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,230 @@
+# Compact in-memory store of the amenity scenario files
+# every osm node is kept once in numpy arrays (int64 id, float64 lat/lon, an
+# amenity type code and an interned name code) instead of one dict per property
+# that sees it. Per scenario the properties point to their amenities with a CSR
+# adjacency (offsets into one indices array). The arrays are saved as .npy files
+# and loaded memory mapped, so loading a store does not copy the data
+#   meta.json                       amenity types, properties and scenarios
+#   ids.npy lats.npy lons.npy ...   one entry per amenity
+#   <scenario>/rows.npy             property position of every row of the scenario file
+#   <scenario>/offsets.npy          amenities of row i are indices[offsets[i]:offsets[i+1]]
+#   <scenario>/indices.npy
+import json
+import os
+import numpy as np
+import helpers
+
+property_columns = ["property_id", "address", "price", "area", "rooms", "lat", "lon"]
+amenity_arrays = ["ids", "lats", "lons", "type_codes", "name_codes", "names_data", "names_offsets"]
+scenario_arrays = ["rows", "offsets", "indices"]
+
+
+class AmenityStore:
+    """
+    Amenities of all scenarios held once, with a CSR property -> amenity adjacency per scenario.
+
+    :param ids: Osm ids of the amenities
+    :param lats: Latitudes of the amenities
+    :param lons: Longitudes of the amenities
+    :param type_codes: Position of the amenity type in types
+    :param types: List of amenity types
+    :param name_codes: Position of the name in the interned names
+    :param names_data: Utf-8 bytes of all interned names, one after the other
+    :param names_offsets: Name i is names_data[names_offsets[i]:names_offsets[i+1]]
+    :param properties: List of property dicts (property_columns only)
+    :param scenarios: Dict of scenario -> dict with rows, offsets, indices and radius
+    """
+
+    def __init__(self, ids, lats, lons, type_codes, types, name_codes, names_data, names_offsets, properties=None, scenarios=None):
+        self.ids = ids
+        self.lats = lats
+        self.lons = lons
+        self.type_codes = type_codes
+        self.types = list(types)
+        self.name_codes = name_codes
+        self.names_data = names_data
+        self.names_offsets = names_offsets
+        self.properties = properties or []
+        self.scenarios = scenarios or {}
+
+    def __len__(self):
+        return len(self.ids)
+
+    @staticmethod
+    def from_scenario_files(scenario_files, scenarios=None):
+        """
+        Build the store from scenario json files, one pass per file.
+
+        :param scenario_files: List of rental_properties_with_<scenario>_amenities.json files
+        :param scenarios: Scenario names, derived from the file names if None
+        """
+        if scenarios is None:
+            scenarios = [helpers.scenario_from_file(f) for f in scenario_files]
+        builder = StoreBuilder()
+        for file_name, scenario in zip(scenario_files, scenarios):
+            builder.add_scenario(scenario, helpers.iter_json_clean(file_name))
+        return builder.build()
+
+    def name(self, i):
+        code = self.name_codes[i]
+        return bytes(self.names_data[self.names_offsets[code]:self.names_offsets[code + 1]]).decode("utf-8")
+
+    def amenity(self, i, radius=None):
+        # amenity dict in the schema of the scenario files
+        am = {"id": int(self.ids[i]), "name": self.name(i), "amenity": self.types[self.type_codes[i]],
+              "lat": float(self.lats[i]), "lon": float(self.lons[i])}
+        if radius is not None:
+            am["radius"] = radius
+        return am
+
+    def row_indices(self, scenario, row):
+        # amenity positions of one row of a scenario
+        adjacency = self.scenarios[scenario]
+        return adjacency["indices"][adjacency["offsets"][row]:adjacency["offsets"][row + 1]]
+
+    def iter_properties(self, scenario):
+        """
+        Rebuild the property dicts of a scenario (without isochrones), in the order of its file.
+
+        :return: Generator of property dicts with an "amenities" list
+        """
+        adjacency = self.scenarios[scenario]
+        for row, pos in enumerate(adjacency["rows"]):
+            prop = dict(self.properties[pos])
+            prop["amenities"] = [self.amenity(i, adjacency.get("radius")) for i in self.row_indices(scenario, row)]
+            yield prop
+
+    def scenario_properties(self, scenario):
+        # property dicts of the rows of a scenario, without amenities
+        return [self.properties[pos] for pos in self.scenarios[scenario]["rows"]]
+
+    def type_counts(self, scenario, types):
+        """
+        Number of amenities of every type per row of a scenario, with one bincount over the adjacency.
+
+        :param types: List of amenity types, compared lowercase
+        :return: (counts array rows x len(types), total amenities per row)
+        """
+        adjacency = self.scenarios[scenario]
+        n_rows = len(adjacency["rows"])
+        totals = np.diff(adjacency["offsets"])
+        # column of every store type, -1 for types that are not counted
+        column_of = {t: j for j, t in enumerate(types)}
+        columns = np.array([column_of.get(str(t).lower(), -1) for t in self.types] + [-1], dtype=np.int64)
+        codes = columns[self.type_codes[adjacency["indices"]]]
+        pair_rows = np.repeat(np.arange(n_rows, dtype=np.int64), totals)
+        keep = codes >= 0
+        k = len(types)
+        counts = np.bincount(pair_rows[keep] * k + codes[keep], minlength=n_rows * k).reshape(n_rows, k)
+        return counts, totals
+
+    def save(self, out_dir="amenity_store"):
+        os.makedirs(out_dir, exist_ok=True)
+        for name in amenity_arrays:
+            np.save(os.path.join(out_dir, f"{name}.npy"), np.asarray(getattr(self, name)))
+        for scenario, adjacency in self.scenarios.items():
+            os.makedirs(os.path.join(out_dir, scenario), exist_ok=True)
+            for name in scenario_arrays:
+                np.save(os.path.join(out_dir, scenario, f"{name}.npy"), np.asarray(adjacency[name]))
+        meta = {
+            "types": self.types,
+            "properties": self.properties,
+            "scenarios": {scenario: {"radius": adjacency.get("radius")} for scenario, adjacency in self.scenarios.items()},
+        }
+        with open(os.path.join(out_dir, "meta.json"), "w", encoding="utf-8") as f:
+            json.dump(meta, f, ensure_ascii=False)
+        print(f"{len(self)} amenities and {len(self.scenarios)} scenarios saved to {out_dir}")
+
+    @staticmethod
+    def load(out_dir="amenity_store", mmap=True):
+        """
+        Load a saved store.
+
+        :param mmap: Memory map the arrays instead of reading them, pages are only read when used
+        """
+        mmap_mode = "r" if mmap else None
+        with open(os.path.join(out_dir, "meta.json"), "r", encoding="utf-8") as f:
+            meta = json.load(f)
+        arrays = {name: np.load(os.path.join(out_dir, f"{name}.npy"), mmap_mode=mmap_mode) for name in amenity_arrays}
+        scenarios = {}
+        for scenario, info in meta["scenarios"].items():
+            scenarios[scenario] = {name: np.load(os.path.join(out_dir, scenario, f"{name}.npy"), mmap_mode=mmap_mode)
+                                   for name in scenario_arrays}
+            scenarios[scenario]["radius"] = info.get("radius")
+        return AmenityStore(types=meta["types"], properties=meta["properties"], scenarios=scenarios, **arrays)
+
+
+class StoreBuilder:
+    # collects the scenarios property by property, the amenities are interned by osm id
+    def __init__(self):
+        self.positions = {}
+        self.ids = []
+        self.lats = []
+        self.lons = []
+        self.type_codes = []
+        self.name_codes = []
+        self.types = {}
+        self.names = {}
+        self.property_positions = {}
+        self.properties = []
+        self.scenarios = {}
+
+    def intern(self, am):
+        pos = self.positions.get(am["id"])
+        if pos is None:
+            pos = self.positions[am["id"]] = len(self.ids)
+            self.ids.append(am["id"])
+            self.lats.append(am["lat"])
+            self.lons.append(am["lon"])
+            self.type_codes.append(self.types.setdefault(am.get("amenity", "n/a"), len(self.types)))
+            self.name_codes.append(self.names.setdefault(am.get("name", "n/a"), len(self.names)))
+        return pos
+
+    def add_scenario(self, scenario, props):
+        rows = []
+        offsets = [0]
+        indices = []
+        radius = None
+        for prop in props:
+            key = prop.get("property_id")
+            pos = self.property_positions.get(key)
+            if pos is None:
+                pos = self.property_positions[key] = len(self.properties)
+                self.properties.append({col: prop.get(col) for col in property_columns})
+            rows.append(pos)
+            for am in prop.get("amenities", []):
+                indices.append(self.intern(am))
+                radius = am.get("radius", radius)
+            offsets.append(len(indices))
+        self.scenarios[scenario] = {
+            "rows": np.array(rows, dtype=np.int32),
+            "offsets": np.array(offsets, dtype=np.int64),
+            "indices": np.array(indices, dtype=np.int32),
+            "radius": radius,
+        }
+
+    def build(self):
+        names = [name.encode("utf-8") for name in self.names]
+        names_offsets = np.zeros(len(names) + 1, dtype=np.int64)
+        names_offsets[1:] = np.cumsum([len(name) for name in names])
+        return AmenityStore(
+            ids=np.array(self.ids, dtype=np.int64),
+            lats=np.array(self.lats, dtype=np.float64),
+            lons=np.array(self.lons, dtype=np.float64),
+            type_codes=np.array(self.type_codes, dtype=np.int16),
+            types=list(self.types),
+            name_codes=np.array(self.name_codes, dtype=np.int32),
+            names_data=np.frombuffer(b"".join(names), dtype=np.uint8),
+            names_offsets=names_offsets,
+            properties=self.properties,
+            scenarios=self.scenarios,
+        )
+
+
+def main():
+    store = AmenityStore.from_scenario_files(helpers.list_scenario_files())
+    store.save()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,288 @@
+# Benchmarks for the hot paths of the pipeline, run on the committed data files
+# usage: python benchmarks.py [name ...]   (runs all benchmarks without names)
+import sys
+import time
+import helpers
+import amenity_index
+
+
+def timed(func, *args, repeat=3, **kwargs):
+    # best of n runs, returns (seconds, result of the last run)
+    best = None
+    result = None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        result = func(*args, **kwargs)
+        elapsed = time.perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+    return best, result
+
+
+def load_isochrone_candidates(isochrone_file='rental_properties_with_driving_3_amenities.json'):
+    # isochrones from a committed scenario file and the candidates the circle query would return
+    props = [p for p in helpers.read_json_clean(isochrone_file) if p.get("isochrone")]
+    all_amenities = [a for p in props for a in p.get("amenities", [])]
+    index = amenity_index.AmenityIndex(all_amenities)
+    polygons, lats, lons = [], [], []
+    for p in props:
+        coords = p["isochrone"]['features'][0]['geometry']['coordinates'][0]
+        radius = helpers.farthest_distance_from_center(p["lat"], p["lon"], coords)
+        candidates = index.query_radius(p["lat"], p["lon"], radius)
+        polygons.append(coords)
+        lats.append([a["lat"] for a in candidates])
+        lons.append([a["lon"] for a in candidates])
+    return polygons, lats, lons
+
+
+def benchmark_within_polygon():
+    polygons, lats, lons = load_isochrone_candidates()
+    n_points = sum(len(la) for la in lats)
+    print(f"within_polygon: {len(polygons)} isochrones, {n_points} candidate points")
+
+    def per_point():
+        return [[helpers.within_polygon(coords, (la, lo)) for la, lo in zip(p_lats, p_lons)]
+                for coords, p_lats, p_lons in zip(polygons, lats, lons)]
+
+    def per_property():
+        return [list(helpers.within_polygon_batch(coords, p_lats, p_lons))
+                for coords, p_lats, p_lons in zip(polygons, lats, lons)]
+
+    def all_properties():
+        return [list(mask) for mask in helpers.within_polygons_batch(polygons, lats, lons)]
+
+    t_point, expected = timed(per_point, repeat=1)
+    t_prop, res_prop = timed(per_property)
+    t_all, res_all = timed(all_properties)
+    assert res_prop == expected and res_all == expected, "batch results differ from per point results"
+    print(f"  per point:      {t_point:8.3f} s")
+    print(f"  per property:   {t_prop:8.3f} s  ({t_point / t_prop:6.1f}x)")
+    print(f"  all properties: {t_all:8.3f} s  ({t_point / t_all:6.1f}x)")
+
+
+def benchmark_feature_matrix(scenario_file='rental_properties_with_radius_500_amenities.json', factors=(1, 10, 100)):
+    import pandas as pd
+    import feature_engineering
+    props = helpers.read_json_clean(scenario_file)
+    print(f"feature matrix: {scenario_file}")
+    for factor in factors:
+        # scale the listing count by repeating the committed properties
+        scaled = props * factor
+
+        def per_row():
+            return pd.DataFrame([feature_engineering.create_feature_dict(p) for p in scaled])
+
+        t_row, expected = timed(per_row, repeat=1)
+        t_vec, result = timed(feature_engineering.create_feature_frame, scaled, repeat=1)
+        assert result.equals(expected), "vectorized features differ from create_feature_dict"
+        print(f"  {len(scaled):7d} properties: per row {t_row:7.3f} s, vectorized {t_vec:7.3f} s ({t_row / t_vec:5.1f}x)")
+
+
+def legacy_farthest_distance(lat, lon, polygon_coords):
+    # the search radius before the geodesic kernel: the farthest vertex in planar
+    # degrees (LineString lengths), then its geodesic distance with pyproj
+    import pyproj
+    from shapely.geometry import LineString, Point, Polygon
+    polygon = Polygon([tuple(coord) for coord in polygon_coords])
+    center = Point(lon, lat)
+    vertex = polygon.exterior.coords
+    distances = [LineString([center, v]).length for v in vertex]
+    farthest_point = Point(vertex[distances.index(max(distances))])
+    geod = pyproj.Geod(ellps="WGS84")
+    _, _, max_distance = geod.inv(center.x, center.y, farthest_point.x, farthest_point.y)
+    return max_distance
+
+
+def benchmark_search_radius(isochrone_file='rental_properties_with_driving_3_amenities.json'):
+    import numpy as np
+    import geodesic
+    props = [p for p in helpers.read_json_clean(isochrone_file) if p.get("isochrone")]
+    lats = [p["lat"] for p in props]
+    lons = [p["lon"] for p in props]
+    polygons = [p["isochrone"]['features'][0]['geometry']['coordinates'][0] for p in props]
+    print(f"search radius: {len(props)} isochrones")
+
+    def legacy():
+        return [legacy_farthest_distance(lat, lon, coords) for lat, lon, coords in zip(lats, lons, polygons)]
+
+    def per_property():
+        return [helpers.farthest_distance_from_center(lat, lon, coords) for lat, lon, coords in zip(lats, lons, polygons)]
+
+    t_legacy, baseline = timed(legacy)
+    t_prop, expected = timed(per_property)
+    t_all, result = timed(geodesic.farthest_vertex_distances, lats, lons, polygons)
+    assert np.allclose(result, expected), "batch radii differ from per property radii"
+    # the degree ranking can pick a vertex that is not the farthest one, its radius falls short
+    short = np.asarray(result) - np.asarray(baseline)
+    print(f"  legacy:         {t_legacy:8.3f} s")
+    print(f"  per property:   {t_prop:8.3f} s  ({t_legacy / t_prop:6.1f}x)")
+    print(f"  all properties: {t_all:8.3f} s  ({t_legacy / t_all:6.1f}x)")
+    print(f"  legacy radius short by more than 1 m for {(short > 1).sum()} of {len(short)} isochrones, "
+          f"mean {short.mean():.1f} m, max {short.max():.1f} m")
+
+
+def benchmark_query_modes(isochrone_files=('rental_properties_with_driving_3_amenities.json', 'rental_properties_with_walking_7_amenities.json')):
+    # response bytes and candidates of the overpass search areas, against the local overpass stand-in
+    import overpy
+    import amenities
+    import replay_benchmark
+    pause = amenities.request_pause
+    amenities.request_pause = 0
+    filter_str = helpers.amenity_filter(amenities.allowed_amenities)
+    with replay_benchmark.ReplayServer(replay_benchmark.ReplayData()) as server:
+        api = overpy.Overpass(url=server.url + "/api/interpreter")
+        for isochrone_file in isochrone_files:
+            props = [p for p in helpers.read_json_clean(isochrone_file) if p.get("isochrone")]
+            isochrones = [p["isochrone"] for p in props]
+
+            def single(mode, slim):
+                candidates = []
+                for p, iso in zip(props, isochrones):
+                    coords = iso['features'][0]['geometry']['coordinates'][0]
+                    if mode == "circle":
+                        radius = helpers.farthest_distance_from_center(p["lat"], p["lon"], coords)
+                        area = f"(around:{radius},{p['lat']},{p['lon']})"
+                    else:
+                        area = amenities.isochrone_area_filter(coords, mode)
+                    candidates.append(amenities.query_amenity_clauses(api, [f"node{area}{filter_str};"], kind=mode, slim=slim))
+                return candidates
+
+            def union(mode, slim):
+                amenities.slim_output, slim_output = slim, amenities.slim_output
+                try:
+                    return amenities.get_amenities_in_isochrones(isochrones, api, allowed_amenities=amenities.allowed_amenities, mode=mode)
+                finally:
+                    amenities.slim_output = slim_output
+
+            print(f"overpass query modes: {isochrone_file}, {len(props)} isochrones")
+            reference = None
+            for name, func, mode, slim in [("circle json", single, "circle", False), ("circle csv", single, "circle", True),
+                                           ("envelope csv", single, "envelope", True), ("polygon json", single, "polygon", False),
+                                           ("polygon csv", single, "polygon", True), ("polygon csv union", union, "polygon", True)]:
+                before = dict(server.stats.get("overpass", {"requests": 0, "bytes": 0}))
+                seconds, candidates = timed(func, mode, slim, repeat=1)
+                after = server.stats["overpass"]
+                kept = [[a["id"] for a in amenities.filter_by_isochrone(c, iso)] for c, iso in zip(candidates, isochrones)]
+                reference = reference or kept
+                print(f"  {name:18s} {after['requests'] - before['requests']:4d} requests {after['bytes'] - before['bytes']:9d} bytes "
+                      f"{sum(len(c) for c in candidates):6d} candidates {sum(len(k) for k in kept):5d} kept "
+                      f"{seconds:7.3f}s  same result: {kept == reference}")
+    amenities.request_pause = pause
+
+
+def benchmark_amenity_store(scenario_files=('rental_properties_with_driving_3_amenities.json', 'rental_properties_with_radius_500_amenities.json',
+                                            'rental_properties_with_walking_3_amenities.json', 'rental_properties_with_walking_7_amenities.json')):
+    # memory of the scenario files as property dicts vs the array store, and the feature counts of both
+    import tracemalloc
+    import amenity_store
+    import feature_engineering
+    tracemalloc.start()
+    props = [helpers.read_json_clean(f) for f in scenario_files]
+    dict_bytes, _ = tracemalloc.get_traced_memory()
+    del props
+    tracemalloc.stop()
+    tracemalloc.start()
+    store = amenity_store.AmenityStore.from_scenario_files(scenario_files)
+    store_bytes, _ = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    links = sum(len(a["indices"]) for a in store.scenarios.values())
+    print(f"amenity_store: {len(scenario_files)} scenarios, {links} property-amenity links, {len(store)} unique amenities")
+    print(f"  property dicts  {dict_bytes / 2 ** 20:8.1f} MB")
+    print(f"  array store     {store_bytes / 2 ** 20:8.1f} MB")
+    for f in scenario_files:
+        scenario = helpers.scenario_from_file(f)
+        t_dicts, by_dicts = timed(lambda: feature_engineering.create_feature_frame(helpers.iter_json_clean(f)))
+        t_store, by_store = timed(feature_engineering.create_feature_frame_from_amenity_store, store, scenario)
+        print(f"  {scenario:12s} features from json {t_dicts:7.3f}s  from store {t_store:7.4f}s  same: {by_dicts.equals(by_store)}")
+
+
+def benchmark_scoring():
+    # p50 / p99 latency of the scoring service, see scoring_service.py
+    import scoring_service
+    scoring_service.run_latency_benchmark()
+
+
+def benchmark_parallel(max_workers=None):
+    # sweep and feature files with 1 to n processes, against the local api stand-ins with an offline index
+    import contextlib
+    import io
+    import os
+    import tempfile
+    import amenities
+    import feature_engineering
+    import nn_isochrones
+    import replay_benchmark
+    max_workers = max_workers or os.cpu_count()
+    counts = sorted({1, 2, 4, 8, max_workers} & set(range(1, max_workers + 1)))
+    with tempfile.TemporaryDirectory() as tmp, replay_benchmark.ReplayServer(replay_benchmark.ReplayData()) as server:
+        data = replay_benchmark.ReplayData()
+        index_file = os.path.join(tmp, "amenity_index.pkl")
+        data.index.save(index_file)
+        saved = {(nn_isochrones, "mapbox_url"): nn_isochrones.mapbox_url,
+                 (nn_isochrones, "min_request_interval"): nn_isochrones.min_request_interval,
+                 (amenities, "request_pause"): amenities.request_pause}
+        saved_cache = (nn_isochrones.isochrone_cache_file, nn_isochrones.isochrone_cache_max_bytes, nn_isochrones.isochrone_cache_precision)
+        try:
+            nn_isochrones.mapbox_url = server.url
+            nn_isochrones.min_request_interval = 0
+            nn_isochrones.configure_isochrone_cache(os.path.join(tmp, "isochrones.sqlite"))
+            amenities.request_pause = 0
+            print(f"parallel: sweep over {len(replay_benchmark.replay_scenarios)} scenarios with an offline index, {counts} processes")
+            reference = None
+            for run, n in enumerate([1] + counts):
+                out_dir = os.path.join(tmp, f"sweep_{run}")
+                os.makedirs(out_dir, exist_ok=True)
+                scenarios = [dict(s, output_file=os.path.join(out_dir, helpers.scenario_file(helpers.scenario_name(s))))
+                             for s in replay_benchmark.replay_scenarios]
+                start = time.perf_counter()
+                with contextlib.redirect_stdout(io.StringIO()):
+                    amenities.add_amenities_sweep("rental_properties_geocoded.json", scenarios, allowed_amenities=amenities.allowed_amenities,
+                                                  index_file=index_file, n_workers=n)
+                seconds = time.perf_counter() - start
+                outputs = [open(s["output_file"], "rb").read() for s in scenarios]
+                if reference is None:
+                    # the first run only fills the isochrone cache
+                    reference = outputs
+                    continue
+                print(f"  sweep    {n:2d} processes {seconds:7.3f}s  same output: {outputs == reference}")
+        finally:
+            # the temporary cache is closed before the directory is removed
+            for (module, name), value in saved.items():
+                setattr(module, name, value)
+            nn_isochrones.configure_isochrone_cache(*saved_cache)
+
+        input_files = [helpers.scenario_file(helpers.scenario_name(s)) for s in replay_benchmark.replay_scenarios]
+        reference = None
+        for n in counts:
+            output_files = [os.path.join(tmp, f"features_{n}_{i}.csv") for i in range(len(input_files))]
+            seconds, _ = timed(feature_engineering.write_feature_files, input_files, output_files, n_workers=n, repeat=1)
+            outputs = [open(f, "rb").read() for f in output_files]
+            reference = reference or outputs
+            print(f"  features {n:2d} processes {seconds:7.3f}s  same output: {outputs == reference}")
+
+
+def benchmark_replay():
+    # whole pipeline against the local api stand-ins, see replay_benchmark.py
+    import replay_benchmark
+    replay_benchmark.run_replay_benchmark()
+
+
+benchmarks = {
+    "within_polygon": benchmark_within_polygon,
+    "feature_matrix": benchmark_feature_matrix,
+    "search_radius": benchmark_search_radius,
+    "query_modes": benchmark_query_modes,
+    "amenity_store": benchmark_amenity_store,
+    "scoring": benchmark_scoring,
+    "parallel": benchmark_parallel,
+    "replay": benchmark_replay,
+}
+
+
+def main():
+    names = sys.argv[1:] or list(benchmarks)
+    for name in names:
+        benchmarks[name]()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,44 @@
+# Offline check of the web scraper against a saved homegate result page
+# fixtures/homegate_results_page.html is parsed with parse_rentals and with the
+# parse-only mode (parse_saved_pages), both have to give the rows of
+# fixtures/homegate_results_page.jsonl. No browser or network is needed
+import os
+import shutil
+import sys
+import tempfile
+import helpers
+import web_scraper
+
+fixture_dir = os.path.join(os.path.dirname(os.path.abspath(__file__)), "fixtures")
+page_file = os.path.join(fixture_dir, "homegate_results_page.html")
+expected_file = os.path.join(fixture_dir, "homegate_results_page.jsonl")
+
+
+def check_parse_rentals():
+    with open(page_file, "r", encoding="utf-8") as f:
+        rental = web_scraper.parse_rentals(f.read())
+    return rental == helpers.read_json_clean(expected_file)
+
+
+def check_parse_saved_pages():
+    # the saved page as page_1.html of an html_dir, parsed twice: the second run adds no duplicates
+    with tempfile.TemporaryDirectory() as tmp:
+        html_dir = os.path.join(tmp, "pages")
+        os.makedirs(html_dir)
+        shutil.copy(page_file, os.path.join(html_dir, "page_1.html"))
+        output_file = os.path.join(tmp, "rental_properties.json")
+        web_scraper.parse_saved_pages(html_dir, output_file)
+        web_scraper.parse_saved_pages(html_dir, output_file)
+        return helpers.read_json_clean(output_file) == helpers.read_json_clean(expected_file)
+
+
+def main():
+    checks = {"parse_rentals": check_parse_rentals, "parse_saved_pages": check_parse_saved_pages}
+    failed = [name for name, check in checks.items() if not check()]
+    for name in checks:
+        print(f"{name}: {'failed' if name in failed else 'ok'}")
+    sys.exit(1 if failed else 0)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,147 @@
+# Normalized columnar storage of the amenity scenario files
+# instead of one json line per property with the full isochrone and full copies
+# of every amenity, the data is split into parquet tables:
+#   properties.parquet       one row per property
+#   amenities.parquet        one row per osm node, deduplicated over all scenarios
+#   isochrones.parquet       isochrone polygons as WKB (GeoParquet), per scenario and property
+#   links/<scenario>.parquet property_id -> amenity_id pairs of a scenario
+#   rows/<scenario>.parquet  property_id of every row of the scenario file, in file order
+import json
+import os
+import pandas as pd
+import pyarrow as pa
+import pyarrow.parquet as pq
+import shapely
+from shapely.geometry import shape
+import helpers
+
+property_columns = ["property_id", "address", "price", "area", "rooms", "lat", "lon"]
+amenity_columns = ["id", "name", "amenity", "lat", "lon"]
+
+
+def write_geoparquet(df, file_name, geometry_column="geometry"):
+    # write WKB geometries with the GeoParquet metadata, readable by geopandas.read_parquet
+    table = pa.Table.from_pandas(df, preserve_index=False)
+    geo = {
+        "version": "1.0.0",
+        "primary_column": geometry_column,
+        "columns": {
+            geometry_column: {
+                "encoding": "WKB",
+                "geometry_types": sorted({g.geom_type for g in shapely.from_wkb(df[geometry_column].to_numpy())}),
+                "crs": "OGC:CRS84",
+            }
+        },
+    }
+    metadata = dict(table.schema.metadata or {})
+    metadata[b"geo"] = json.dumps(geo).encode("utf-8")
+    pq.write_table(table.replace_schema_metadata(metadata), file_name)
+
+
+def write_columnar_store(scenario_files, out_dir="columnar_store"):
+    """
+    Convert scenario json files into the normalized parquet tables.
+
+    :param scenario_files: List of rental_properties_with_<scenario>_amenities.json files
+    :param out_dir: Directory the tables are written to
+    """
+    os.makedirs(os.path.join(out_dir, "links"), exist_ok=True)
+    os.makedirs(os.path.join(out_dir, "rows"), exist_ok=True)
+    properties = {}
+    amenities = {}
+    isochrone_rows = []
+    for file_name in scenario_files:
+        scenario = helpers.scenario_from_file(file_name)
+        links = []
+        rows = []
+        # stream the file, the embedded isochrones and amenities are only kept once
+        for prop in helpers.iter_json_clean(file_name):
+            property_id = prop.get("property_id")
+            rows.append(property_id)
+            if property_id not in properties:
+                properties[property_id] = {col: prop.get(col) for col in property_columns}
+            for amenity in prop.get("amenities", []):
+                if amenity["id"] not in amenities:
+                    amenities[amenity["id"]] = {col: amenity.get(col) for col in amenity_columns}
+                links.append((property_id, amenity["id"]))
+            isochrone = prop.get("isochrone")
+            if isochrone:
+                feature = isochrone["features"][0]
+                isochrone_rows.append({
+                    "scenario": scenario,
+                    "property_id": property_id,
+                    "contour": feature["properties"].get("contour"),
+                    "geometry": shapely.to_wkb(shape(feature["geometry"])),
+                })
+        link_df = pd.DataFrame(links, columns=["property_id", "amenity_id"]).astype("int64")
+        link_df.to_parquet(os.path.join(out_dir, "links", f"{scenario}.parquet"), index=False)
+        pd.DataFrame({"property_id": rows}).astype("int64").to_parquet(os.path.join(out_dir, "rows", f"{scenario}.parquet"), index=False)
+        print(f"{scenario}: {len(link_df)} links")
+
+    pd.DataFrame(list(properties.values()), columns=property_columns).to_parquet(
+        os.path.join(out_dir, "properties.parquet"), index=False)
+    amenity_df = pd.DataFrame(list(amenities.values()), columns=amenity_columns)
+    amenity_df["amenity"] = amenity_df["amenity"].astype("category")
+    amenity_df.to_parquet(os.path.join(out_dir, "amenities.parquet"), index=False)
+    isochrone_df = pd.DataFrame(isochrone_rows, columns=["scenario", "property_id", "contour", "geometry"])
+    write_geoparquet(isochrone_df, os.path.join(out_dir, "isochrones.parquet"))
+    print(f"{len(properties)} properties, {len(amenities)} unique amenities and "
+          f"{len(isochrone_df)} isochrones saved to {out_dir}")
+
+
+def list_scenarios(out_dir="columnar_store"):
+    return sorted(f[:-len(".parquet")] for f in os.listdir(os.path.join(out_dir, "links")) if f.endswith(".parquet"))
+
+
+def read_properties(out_dir="columnar_store", columns=None):
+    return pd.read_parquet(os.path.join(out_dir, "properties.parquet"), columns=columns)
+
+
+def read_amenities(out_dir="columnar_store", columns=None):
+    return pd.read_parquet(os.path.join(out_dir, "amenities.parquet"), columns=columns)
+
+
+def read_links(scenario, out_dir="columnar_store", columns=None):
+    return pd.read_parquet(os.path.join(out_dir, "links", f"{scenario}.parquet"), columns=columns)
+
+
+def read_scenario_properties(scenario, out_dir="columnar_store", columns=None):
+    # the properties of the rows of a scenario file, in file order
+    rows = pd.read_parquet(os.path.join(out_dir, "rows", f"{scenario}.parquet"))
+    props = read_properties(out_dir, columns=columns if columns is None or "property_id" in columns else ["property_id"] + columns)
+    return props.set_index("property_id", drop=False).loc[rows["property_id"].to_numpy()].reset_index(drop=True)
+
+
+def read_isochrones(out_dir="columnar_store", scenario=None, columns=None):
+    # only the row groups / rows of one scenario are decoded if a scenario is given
+    filters = [("scenario", "==", scenario)] if scenario else None
+    return pd.read_parquet(os.path.join(out_dir, "isochrones.parquet"), columns=columns, filters=filters)
+
+
+def iter_scenario_properties(scenario, out_dir="columnar_store", amenity_fields=("amenity",)):
+    """
+    Rebuild the property dicts of a scenario, with only the needed amenity fields.
+
+    :param scenario: Scenario name, e.g. driving_3
+    :param amenity_fields: Amenity columns to load, e.g. ("amenity",) for the feature counts
+    :return: Generator of property dicts with an "amenities" list, in the original order
+    """
+    props = read_scenario_properties(scenario, out_dir)
+    fields = ["id"] + [f for f in amenity_fields if f != "id"]
+    amenities = read_amenities(out_dir, columns=fields).set_index("id", drop=False)
+    links = read_links(scenario, out_dir)
+    joined = amenities.loc[links["amenity_id"].to_numpy()]
+    grouped = {}
+    for property_id, amenity in zip(links["property_id"].to_numpy(), joined[list(amenity_fields)].to_dict("records")):
+        grouped.setdefault(int(property_id), []).append(amenity)
+    for prop in props.to_dict("records"):
+        prop["amenities"] = grouped.get(prop["property_id"], [])
+        yield prop
+
+
+def main():
+    write_columnar_store(helpers.list_scenario_files())
+
+
+if __name__ == "__main__":
+    main()
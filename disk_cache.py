@@ -0,0 +1,79 @@
+# Persistent key/value cache on disk
+# sqlite backed, values are stored as json, the least recently used entries are
+# evicted once the cache grows over its size limit
+import json
+import sqlite3
+import threading
+import time
+
+
+class DiskCache:
+    """
+    Small persistent LRU cache.
+
+    :param file_name: Path of the sqlite file, created if it does not exist
+    :param max_bytes: Size limit of all stored values, None for no limit
+    """
+
+    def __init__(self, file_name, max_bytes=256 * 1024 * 1024):
+        self.file_name = file_name
+        self.max_bytes = max_bytes
+        self.lock = threading.Lock()
+        self.db = sqlite3.connect(file_name, check_same_thread=False)
+        self.db.execute(
+            "CREATE TABLE IF NOT EXISTS cache ("
+            "key TEXT PRIMARY KEY, value TEXT NOT NULL, size INTEGER NOT NULL, last_access REAL NOT NULL)"
+        )
+        self.db.execute("CREATE INDEX IF NOT EXISTS cache_last_access ON cache (last_access)")
+        self.db.commit()
+
+    def get(self, key, default=None):
+        with self.lock:
+            row = self.db.execute("SELECT value FROM cache WHERE key = ?", (key,)).fetchone()
+            if row is None:
+                return default
+            self.db.execute("UPDATE cache SET last_access = ? WHERE key = ?", (time.time(), key))
+            self.db.commit()
+        return json.loads(row[0])
+
+    def set(self, key, value):
+        data = json.dumps(value, ensure_ascii=False)
+        with self.lock:
+            self.db.execute(
+                "INSERT OR REPLACE INTO cache (key, value, size, last_access) VALUES (?, ?, ?, ?)",
+                (key, data, len(data), time.time()),
+            )
+            self.evict()
+            self.db.commit()
+
+    def evict(self):
+        # drop least recently used entries until the cache fits into max_bytes
+        if self.max_bytes is None:
+            return
+        total = self.db.execute("SELECT COALESCE(SUM(size), 0) FROM cache").fetchone()[0]
+        if total <= self.max_bytes:
+            return
+        rows = self.db.execute("SELECT key, size FROM cache ORDER BY last_access").fetchall()
+        for key, size in rows:
+            if total <= self.max_bytes:
+                break
+            self.db.execute("DELETE FROM cache WHERE key = ?", (key,))
+            total -= size
+
+    def items(self):
+        # all (key, value) pairs, e.g. to load the whole cache into memory, access times are not touched
+        with self.lock:
+            rows = self.db.execute("SELECT key, value FROM cache").fetchall()
+        return [(key, json.loads(value)) for key, value in rows]
+
+    def __contains__(self, key):
+        with self.lock:
+            return self.db.execute("SELECT 1 FROM cache WHERE key = ?", (key,)).fetchone() is not None
+
+    def __len__(self):
+        with self.lock:
+            return self.db.execute("SELECT COUNT(*) FROM cache").fetchone()[0]
+
+    def close(self):
+        with self.lock:
+            self.db.close()
@@ -1,6 +1,10 @@
-from helpers import read_json_clean, save_json_clean, parse_price
+from helpers import iter_json_clean, parse_price, scenario_from_file
 import json
+import os
+from concurrent.futures import ProcessPoolExecutor
+import numpy as np
 import pandas as pd
+import metrics
 
 # allowed amenities list
 allowed_amenities = [
@@ -21,6 +25,9 @@ allowed_amenities = [
     "parking"
 ]
 
+# processes for the scenario files, each file is built in its own process
+workers = int(os.getenv("WORKERS", "1"))
+
 def create_feature_dict(property_data):
     # create a dict of features from one property
     feat = {}
@@ -46,6 +53,202 @@ def create_feature_dict(property_data):
     feat['total_amenities'] = len(amenities)
     return feat
 
+# base columns of a feature row, in the order of create_feature_dict
+base_columns = ['address', 'price', 'lat', 'lon', 'property_id', 'rooms', 'area']
+
+def base_feature_row(property_data):
+    # the non amenity part of create_feature_dict
+    return {
+        'address': property_data.get('address', ''),
+        'price': property_data.get('prise', ''),
+        'lat': property_data.get('lat', ''),
+        'lon': property_data.get('lon', ''),
+        'property_id': property_data.get('property_id', ''),
+        'rooms': property_data.get('rooms', 0),
+        'area': property_data.get('area', 0),
+    }
+
+def amenity_count_frame(n_props, pair_pos, pair_types, totals):
+    """
+    Count the amenity types of all property-amenity pairs at once.
+
+    :param n_props: Number of properties
+    :param pair_pos: Array with the property position of every pair
+    :param pair_types: Array with the amenity type of every pair
+    :param totals: Array with the total number of amenities per property
+    :return: DataFrame with the _count / _present columns and total_amenities
+    """
+    # factorize the pairs and map the few distinct types to their column in
+    # allowed_amenities (-1 if not allowed), so only the distinct types are lowercased
+    type_codes, uniques = pd.factorize(np.asarray(pair_types, dtype=object))
+    column_of = {amenity: j for j, amenity in enumerate(allowed_amenities)}
+    unique_columns = np.array([column_of.get(str(t).lower(), -1) for t in uniques] + [-1], dtype=np.int64)
+    codes = unique_columns[type_codes]
+    keep = codes >= 0
+    k = len(allowed_amenities)
+    # crosstab of position x type as one bincount over the flattened pairs
+    counts = np.bincount(np.asarray(pair_pos, dtype=np.int64)[keep] * k + codes[keep], minlength=n_props * k).reshape(n_props, k)
+    return count_frame(counts, totals)
+
+def count_frame(counts, totals):
+    # _count / _present columns from a properties x allowed_amenities count matrix
+    columns = {}
+    for j, amenity in enumerate(allowed_amenities):
+        columns[f"{amenity}_count"] = counts[:, j]
+        columns[f"{amenity}_present"] = (counts[:, j] > 0).astype(np.int64)
+    columns['total_amenities'] = np.asarray(totals, dtype=np.int64)
+    return pd.DataFrame(columns)
+
+@metrics.timed("stage_seconds", stage="features")
+def create_feature_frame(props):
+    """
+    Vectorized version of create_feature_dict for a whole scenario.
+
+    :param props: Iterable of property dicts, e.g. helpers.iter_json_clean(file)
+    :return: DataFrame with the same columns and values as the create_feature_dict rows
+    """
+    base = []
+    pair_types = []
+    totals = []
+    # flatten all property-amenity pairs, only the amenity type is kept
+    for prop in props:
+        base.append(base_feature_row(prop))
+        amenities = prop.get('amenities', [])
+        totals.append(len(amenities))
+        pair_types.extend([a.get("amenity", "") for a in amenities])
+    if not base:
+        return pd.DataFrame(columns=[c for c in create_feature_dict({})])
+    pair_pos = np.repeat(np.arange(len(base)), totals)
+    counts = amenity_count_frame(len(base), pair_pos, pair_types, totals)
+    return pd.concat([pd.DataFrame(base, columns=base_columns), counts], axis=1)
+
+def create_feature_frame_from_store(scenario, store_dir="columnar_store"):
+    # build the features of one scenario from the parquet tables, only the
+    # amenity type column of the amenity table is read
+    import columnar_store
+    props = columnar_store.read_scenario_properties(scenario, store_dir)
+    base = pd.DataFrame([base_feature_row(p) for p in props.to_dict("records")], columns=base_columns)
+    links = columnar_store.read_links(scenario, store_dir)
+    amenities = columnar_store.read_amenities(store_dir, columns=["id", "amenity"])
+    pair_pos = pd.Index(props["property_id"]).get_indexer(links["property_id"])
+    pair_types = amenities["amenity"].astype(object).to_numpy()[pd.Index(amenities["id"]).get_indexer(links["amenity_id"])]
+    totals = np.bincount(pair_pos, minlength=len(props))
+    counts = amenity_count_frame(len(props), pair_pos, pair_types, totals)
+    return pd.concat([base, counts], axis=1)
+
+def create_feature_frame_from_amenity_store(store, scenario):
+    """
+    Features of one scenario of an amenity_store.AmenityStore, the counts are one
+    bincount over its property -> amenity adjacency.
+
+    :return: DataFrame with the same columns and values as create_feature_frame
+    """
+    base = pd.DataFrame([base_feature_row(p) for p in store.scenario_properties(scenario)], columns=base_columns)
+    counts, totals = store.type_counts(scenario, allowed_amenities)
+    return pd.concat([base, count_frame(counts, totals)], axis=1)
+
+def create_scenario_feature_frame(input_file, amenity_store_dir=None, store_dir=None):
+    # features of one scenario file, from the array store, the parquet tables or the json file
+    if amenity_store_dir:
+        import amenity_store
+        return create_feature_frame_from_amenity_store(amenity_store.AmenityStore.load(amenity_store_dir), scenario_from_file(input_file))
+    if store_dir:
+        return create_feature_frame_from_store(scenario_from_file(input_file), store_dir)
+    # stream properties from the json file (one object per line), only the
+    # amenity types are kept, not the amenities and isochrones
+    return create_feature_frame(iter_json_clean(input_file))
+
+def write_feature_file(input_file, output_csv, amenity_store_dir=None, store_dir=None):
+    # build and save the features of one scenario, runs in a worker process
+    df = create_scenario_feature_frame(input_file, amenity_store_dir=amenity_store_dir, store_dir=store_dir)
+    df.to_csv(output_csv, index=False)
+    return repr(df.head())
+
+def write_feature_files(input_files, output_files, amenity_store_dir=None, store_dir=None, n_workers=1):
+    """
+    Build and save the features of several scenario files, in a process pool with
+    n_workers > 1, the files are the same as with one process.
+
+    :return: Preview of the first rows of every file, in the order of input_files
+    """
+    n = len(input_files)
+    if n_workers > 1 and n > 1:
+        with ProcessPoolExecutor(max_workers=min(n_workers, n)) as pool:
+            return list(pool.map(write_feature_file, input_files, output_files, [amenity_store_dir] * n, [store_dir] * n))
+    return [write_feature_file(i, o, amenity_store_dir=amenity_store_dir, store_dir=store_dir) for i, o in zip(input_files, output_files)]
+
+def create_wide_feature_matrix(input_files, scenarios=None, store=None, n_workers=1):
+    """
+    One feature matrix for several scenarios, the amenity columns get the
+    scenario as suffix (e.g. cafe_count_driving_3), the base columns are kept once.
+
+    :param input_files: Scenario json files
+    :param scenarios: Suffixes, derived from the file names if None
+    :param store: Optional amenity_store.AmenityStore with these scenarios, read instead of the files
+    :param n_workers: Processes to read the json files with, the store is read in this process
+    :return: DataFrame with one row per property, in the order of the first file
+    """
+    if scenarios is None:
+        scenarios = [scenario_from_file(f) for f in input_files]
+    if store is not None:
+        frames = [create_feature_frame_from_amenity_store(store, scenario) for scenario in scenarios]
+    elif n_workers > 1 and len(input_files) > 1:
+        with ProcessPoolExecutor(max_workers=min(n_workers, len(input_files))) as pool:
+            frames = list(pool.map(create_scenario_feature_frame, input_files))
+    else:
+        frames = [create_scenario_feature_frame(f) for f in input_files]
+    wide = None
+    for df, scenario in zip(frames, scenarios):
+        amenity_part = df.drop(columns=base_columns)
+        amenity_part.columns = [f"{c}_{scenario}" for c in amenity_part.columns]
+        amenity_part['property_id'] = df['property_id']
+        if wide is None:
+            wide = df[base_columns].join(amenity_part.set_index('property_id'), on='property_id')
+        else:
+            wide = wide.join(amenity_part.set_index('property_id'), on='property_id')
+    return wide
+
+def load_or_build_nearest_index(index_file="nearest_amenity_index.pkl", input_files=(), amenity_index_file="amenity_index.pkl"):
+    """
+    Load the saved nearest amenity index, or build it without any network call,
+    from the regional amenity index if there is one, else from the amenities
+    already stored in the scenario files. A saved index that is older than one
+    of these files is built again.
+    """
+    import nn_isochrones
+    # like the stores, a saved index older than its sources holds the amenities of an earlier run
+    if store_is_current(index_file, list(input_files) + [amenity_index_file]):
+        return nn_isochrones.NearestAmenityIndex.load(index_file)
+    if os.path.exists(amenity_index_file):
+        import amenity_index
+        amenities = amenity_index.AmenityIndex.load(amenity_index_file).amenities
+    else:
+        amenities = (a for f in input_files if os.path.exists(f) for p in iter_json_clean(f) for a in p.get('amenities', []))
+    index = nn_isochrones.NearestAmenityIndex(a for a in amenities if a.get('amenity') in allowed_amenities)
+    index.save(index_file)
+    return index
+
+def create_nearest_feature_frame(props_df, index, k=5, n_jobs=1):
+    # distance to the nearest amenity and mean distance to the k nearest, per type in meters
+    lats = pd.to_numeric(props_df['lat'], errors='coerce').to_numpy(dtype=float)
+    lons = pd.to_numeric(props_df['lon'], errors='coerce').to_numpy(dtype=float)
+    columns = index.features(lats, lons, amenity_types=[a for a in allowed_amenities if a in index.amenity_types], k=k, n_jobs=n_jobs)
+    df = pd.DataFrame(columns)
+    df.insert(0, 'property_id', props_df['property_id'].to_numpy())
+    return df
+
+def store_is_current(marker_file, input_files):
+    # a store is only used if it was written after every scenario file it is built from,
+    # after a new amenities run it would hold an old snapshot
+    if not os.path.exists(marker_file):
+        return False
+    built = os.path.getmtime(marker_file)
+    newer = [f for f in input_files if os.path.exists(f) and os.path.getmtime(f) > built]
+    if newer:
+        print(f"{marker_file} is older than {newer[0]}, not using it")
+        return False
+    return True
+
 def main():
     infput_files = [
         "rental_properties_with_driving_3_amenities.json",
@@ -69,21 +272,31 @@ def main():
         "rental_features_walking_7_amenities.csv",
         "rental_features_walking_10_amenities.csv",
     ]
-    for index, input_file in enumerate(infput_files):
-        output_csv = output_files[index]
-        # load properties from the json file (one object per line)
-        props = read_json_clean(input_file)
-        
-        # build a list of feature dicts
-        features = [create_feature_dict(p) for p in props]
-        
-        # create a dataframe from features
-        df = pd.DataFrame(features)
-        
-        # save the dataframe to csv
-        df.to_csv(output_csv, index=False)
+    # read the arrays of amenity_store.py or the normalized parquet tables of
+    # columnar_store.py instead of the json files if they were built after them
+    amenity_store_dir = "amenity_store" if store_is_current(os.path.join("amenity_store", "meta.json"), infput_files) else None
+    store_dir = "columnar_store" if store_is_current(os.path.join("columnar_store", "properties.parquet"), infput_files) else None
+    # one process per scenario file with workers > 1
+    previews = write_feature_files(infput_files, output_files, amenity_store_dir=amenity_store_dir, store_dir=store_dir, n_workers=workers)
+    for output_csv, preview in zip(output_files, previews):
         print("dataframe saved to", output_csv)
-        print(df.head())
+        print(preview)
+
+    store = None
+    if amenity_store_dir:
+        import amenity_store
+        store = amenity_store.AmenityStore.load(amenity_store_dir)
+    # all scenarios side by side in one matrix
+    wide = create_wide_feature_matrix(infput_files, store=store, n_workers=workers)
+    wide.to_csv("rental_features_all_scenarios.csv", index=False)
+    print("wide feature matrix saved to rental_features_all_scenarios.csv", wide.shape)
+
+    # k nearest distance features from the persisted index, no network calls
+    nearest_index = load_or_build_nearest_index(input_files=infput_files)
+    nearest = create_nearest_feature_frame(wide, nearest_index, k=5, n_jobs=os.cpu_count())
+    nearest.to_csv("rental_features_nearest_amenities.csv", index=False)
+    print("nearest amenity features saved to rental_features_nearest_amenities.csv", nearest.shape)
+    metrics.write_summary()
 
 if __name__ == "__main__":
     main()
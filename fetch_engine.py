@@ -0,0 +1,146 @@
+# Concurrent fetch layer for the external apis (overpass, mapbox, nominatim)
+# asyncio + one shared httpx client, a token bucket per provider for the rate
+# limit, a semaphore for the number of requests in flight and exponential
+# backoff on 429 / 5xx responses
+import asyncio
+import random
+import time
+import httpx
+import metrics
+
+# default rate limits per provider: (requests per second, burst size)
+default_rate_limits = {
+    "overpass": (1, 2),
+    "mapbox": (5, 5),
+    "nominatim": (1, 1),
+}
+
+# status codes that are worth retrying
+retry_status_codes = {429, 500, 502, 503, 504}
+
+
+class TokenBucket:
+    """
+    Token bucket rate limiter.
+
+    :param rate: Tokens added per second
+    :param capacity: Maximum number of tokens, i.e. the allowed burst
+    """
+
+    def __init__(self, rate, capacity=1):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = time.monotonic()
+        self.lock = asyncio.Lock()
+
+    async def acquire(self):
+        async with self.lock:
+            while True:
+                now = time.monotonic()
+                self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+                self.updated = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                await asyncio.sleep((1 - self.tokens) / self.rate)
+
+
+class FetchError(Exception):
+    pass
+
+
+class AsyncFetcher:
+    """
+    Shared http client with per provider rate limits and retries.
+
+    Use it as an async context manager, the connections are reused for all requests.
+
+    :param concurrency: Maximum number of requests in flight over all providers
+    :param rate_limits: Dict of provider -> (requests per second, burst size)
+    :param max_retries: Retries on 429 / 5xx and connection errors
+    :param backoff_base: First retry delay in seconds, doubled on every retry
+    :param backoff_max: Upper bound of a single retry delay in seconds
+    :param timeout: Request timeout in seconds
+    """
+
+    def __init__(self, concurrency=4, rate_limits=None, max_retries=5, backoff_base=1, backoff_max=60, timeout=60):
+        self.concurrency = concurrency
+        self.rate_limits = dict(default_rate_limits)
+        if rate_limits:
+            self.rate_limits.update(rate_limits)
+        self.max_retries = max_retries
+        self.backoff_base = backoff_base
+        self.backoff_max = backoff_max
+        self.timeout = timeout
+        self.buckets = {}
+        self.semaphore = None
+        self.client = None
+        self.retries = 0
+
+    async def __aenter__(self):
+        self.semaphore = asyncio.Semaphore(self.concurrency)
+        self.buckets = {name: TokenBucket(rate, burst) for name, (rate, burst) in self.rate_limits.items()}
+        limits = httpx.Limits(max_connections=self.concurrency, max_keepalive_connections=self.concurrency)
+        self.client = httpx.AsyncClient(timeout=self.timeout, limits=limits)
+        return self
+
+    async def __aexit__(self, *exc_info):
+        await self.client.aclose()
+        self.client = None
+
+    def backoff_delay(self, attempt, response=None):
+        # honor retry-after if the server sends one, else exponential backoff with jitter
+        if response is not None and response.headers.get("retry-after"):
+            try:
+                return min(float(response.headers["retry-after"]), self.backoff_max)
+            except ValueError:
+                pass
+        delay = min(self.backoff_base * 2 ** attempt, self.backoff_max)
+        return delay * (0.5 + random.random() / 2)
+
+    async def request(self, provider, method, url, **kwargs):
+        """
+        Send a request through the rate limiter of provider, retrying on 429 / 5xx.
+
+        :return: httpx.Response with a 2xx status
+        """
+        bucket = self.buckets.get(provider)
+        for attempt in range(self.max_retries + 1):
+            response = None
+            error = None
+            if bucket is not None:
+                await bucket.acquire()
+            async with self.semaphore:
+                try:
+                    with metrics.timer("api_request_seconds", provider=provider):
+                        response = await self.client.request(method, url, **kwargs)
+                except httpx.TransportError as e:
+                    error = e
+            if response is not None:
+                metrics.count("api_requests_total", provider=provider, result=str(response.status_code))
+                metrics.count("api_bytes_received_total", len(response.content), provider=provider)
+            else:
+                metrics.count("api_requests_total", provider=provider, result="transport_error")
+            if response is not None and response.status_code < 400:
+                return response
+            if response is not None and response.status_code not in retry_status_codes:
+                raise FetchError(f"{provider}: {response.status_code} - {response.text[:200]}")
+            if attempt == self.max_retries:
+                break
+            self.retries += 1
+            metrics.count("api_retries_total", provider=provider)
+            delay = self.backoff_delay(attempt, response)
+            reason = error if error is not None else response.status_code
+            print(f"{provider}: {reason}, retrying in {delay:.1f} seconds...")
+            await asyncio.sleep(delay)
+        reason = error if error is not None else f"{response.status_code} - {response.text[:200]}"
+        raise FetchError(f"{provider}: giving up after {self.max_retries} retries ({reason})")
+
+    async def get_json(self, provider, url, **kwargs):
+        response = await self.request(provider, "GET", url, **kwargs)
+        return response.json()
+
+    async def post_json(self, provider, url, **kwargs):
+        response = await self.request(provider, "POST", url, **kwargs)
+        return response.json()
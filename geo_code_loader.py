@@ -1,46 +1,179 @@
+import csv
+import os
+import re
 import time
-from helpers import read_json_clean, save_json_clean
+import unicodedata
+from collections import defaultdict
+from helpers import iter_json_clean, write_json_stream
+from disk_cache import DiskCache
+import metrics
 from geopy.geocoders import Nominatim
 from geopy.exc import GeocoderTimedOut, GeocoderServiceError
 
+# persistent geocode cache, keyed by the normalized address
+geocode_cache_file = os.getenv("GEOCODE_CACHE", "geocode_cache.sqlite")
+
+# offline fallback: centroid per swiss postcode (postcode,town,lat,lon), the
+# official postcode directory of swisstopo can be dropped in with the same columns
+postcode_centroids_file = "postcode_centroids.csv"
+
+# minimum seconds between two nominatim requests, cache hits are not delayed
+min_request_interval = 1
+last_request_time = 0
+
+class GeocodingFailed(Exception):
+    # all retries failed, unlike a None result this says nothing about the address
+    pass
+
+postcode_pattern = re.compile(r"(?:^|,)\s*(\d{4})\s+([^,]+)")
+
+def normalize_address(address):
+    # cache / dedup key: case, accents composition, remarks in brackets and spacing do not matter
+    address = unicodedata.normalize("NFC", address or "").casefold()
+    address = re.sub(r"\([^)]*\)", " ", address)
+    address = re.sub(r"\s*,\s*", ", ", address)
+    return re.sub(r"\s+", " ", address).strip(" ,")
+
+def parse_postcodes(address):
+    # all (postcode, town) pairs of an address, e.g. "..., 2502 Biel, 2505 Biel"
+    return [(postcode, town.strip()) for postcode, town in postcode_pattern.findall(address or "")]
+
+def build_postcode_centroids(geocoded_file, output_file=postcode_centroids_file):
+    """
+    Build the postcode centroid table from already geocoded properties.
+
+    :param geocoded_file: Json lines file with address, lat and lon
+    :param output_file: Csv file with postcode, town, lat and lon columns
+    """
+    points = defaultdict(list)
+    towns = {}
+    for prop in iter_json_clean(geocoded_file):
+        if prop.get("lat") is None or prop.get("lon") is None:
+            continue
+        for postcode, town in parse_postcodes(prop.get("address"))[:1]:
+            points[postcode].append((prop["lat"], prop["lon"]))
+            towns.setdefault(postcode, town)
+    with open(output_file, "w", encoding="utf-8", newline="") as f:
+        writer = csv.writer(f)
+        writer.writerow(["postcode", "town", "lat", "lon"])
+        for postcode in sorted(points):
+            lats, lons = zip(*points[postcode])
+            writer.writerow([postcode, towns[postcode], round(sum(lats) / len(lats), 7), round(sum(lons) / len(lons), 7)])
+    print(f"{len(points)} postcode centroids saved to {output_file}")
+
+def load_postcode_centroids(file_name=postcode_centroids_file):
+    # postcode -> (lat, lon), empty if there is no table
+    if not file_name or not os.path.exists(file_name):
+        return {}
+    with open(file_name, "r", encoding="utf-8", newline="") as f:
+        return {row["postcode"]: (float(row["lat"]), float(row["lon"])) for row in csv.DictReader(f)}
+
+def geocode_offline(address, centroids):
+    # centroid of the first known postcode of the address
+    for postcode, _ in parse_postcodes(address):
+        if postcode in centroids:
+            return centroids[postcode]
+    return None
+
 def geocode_address(address, geolocator, retries=3):
-    # try to geocode the address, retry if needed
+    # try to geocode the address, retry if needed. Returns None if nominatim has
+    # no match and raises GeocodingFailed if every attempt failed
+    global last_request_time
     for i in range(retries):
+        wait = min_request_interval - (time.monotonic() - last_request_time)
+        if wait > 0:
+            # wait to respect api rate limits
+            time.sleep(wait)
+        last_request_time = time.monotonic()
+        if i > 0:
+            metrics.count("api_retries_total", provider="nominatim")
         try:
             # add ", switzerland" to improve accuracy
-            return geolocator.geocode(address + ", switzerland")
+            with metrics.timer("api_request_seconds", provider="nominatim"):
+                location = geolocator.geocode(address + ", switzerland")
+            metrics.count("api_requests_total", provider="nominatim", result="ok" if location else "not_found")
+            return location
         except (GeocoderTimedOut, GeocoderServiceError) as e:
+            metrics.count("api_requests_total", provider="nominatim", result="error")
             print(f"error geocoding '{address}' (attempt {i+1}): {e}")
-            time.sleep(1)
-    return None
+    raise GeocodingFailed(f"no answer from nominatim for '{address}' after {retries} attempts")
 
-def main():
-    input_file = 'rental_properties.json'
-    output_file = 'rental_properties_geocoded.json'
-    
-    # load the rental properties from the file (one json per line)
-    rental_properties = read_json_clean(input_file)
-    
-    # initialize the geolocator with a user agent
-    geolocator = Nominatim(user_agent="rental_geocoder")
+def geocode_properties(rental_properties, geolocator, cache=None, centroids=None):
+    """
+    Geocode each property and add lat/lon, one at a time so the properties can
+    be streamed from and to disk.
+
+    Every normalized address is looked up once: first in the cache, then with
+    nominatim, and if that fails in the postcode centroids.
 
-    # geocode each property and add lat/lon
+    :param cache: Optional DiskCache of normalized address -> [lat, lon] or None
+    :param centroids: Optional dict of postcode -> (lat, lon) for the offline fallback
+    """
+    resolved = {}
+    stats = defaultdict(int)
     for prop in rental_properties:
         address = prop.get("address")
-        location = geocode_address(address, geolocator)
-        if location:
-            prop["lat"] = location.latitude
-            prop["lon"] = location.longitude
-            print(f"geocoded: {address} -> ({location.latitude}, {location.longitude})")
+        key = normalize_address(address)
+        if key in resolved:
+            coords = resolved[key]
+            stats["duplicate"] += 1
+        elif cache is not None and key in cache:
+            coords = cache.get(key)
+            stats["cached"] += 1
+            metrics.count("cache_lookups_total", cache="geocode", result="hit")
+        else:
+            if cache is not None:
+                metrics.count("cache_lookups_total", cache="geocode", result="miss")
+            stats["requested"] += 1
+            try:
+                location = geocode_address(address, geolocator)
+                coords = [location.latitude, location.longitude] if location else None
+                if cache is not None:
+                    # addresses without a match are cached too, so repeat runs do not ask nominatim again
+                    cache.set(key, coords)
+            except GeocodingFailed as e:
+                # errors are not cached, the address is asked again on the next run
+                print(e)
+                coords = None
+                stats["errors"] += 1
+        resolved[key] = coords
+        source = "nominatim"
+        if coords is None and centroids:
+            coords = geocode_offline(address, centroids)
+            source = "postcode"
+        if coords:
+            prop["lat"], prop["lon"] = coords
+            stats[source] += 1
+            metrics.count("geocoded_total", source=source)
+            print(f"geocoded ({source}): {address} -> ({prop['lat']}, {prop['lon']})")
         else:
             prop["lat"] = None
             prop["lon"] = None
+            stats["failed"] += 1
+            metrics.count("geocoded_total", source="failed")
             print(f"failed to geocode: {address}")
-        # wait to respect api rate limits
-        time.sleep(1)
-    
-    # write the updated properties to the output file
-    save_json_clean(output_file, rental_properties)
+        yield prop
+    print(f"{stats['requested']} nominatim requests ({stats['errors']} without answer), {stats['cached']} cache hits, "
+          f"{stats['duplicate']} duplicate addresses, {stats['postcode']} postcode fallbacks, {stats['failed']} failed")
+
+def main():
+    input_file = 'rental_properties.json'
+    output_file = 'rental_properties_geocoded.json'
+
+    # stream the rental properties from the file (one json per line)
+    rental_properties = iter_json_clean(input_file)
+
+    # initialize the geolocator with a user agent
+    geolocator = Nominatim(user_agent="rental_geocoder")
+    cache = DiskCache(geocode_cache_file) if geocode_cache_file else None
+    centroids = load_postcode_centroids()
+
+    # geocode each property and write it to the output file right away
+    count = write_json_stream(output_file, geocode_properties(rental_properties, geolocator, cache=cache, centroids=centroids))
+    print(f"geocoding complete. {count} properties saved to {output_file}")
+    if cache is not None:
+        cache.close()
+    metrics.write_summary()
 
 if __name__ == "__main__":
     main()
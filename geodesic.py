@@ -0,0 +1,47 @@
+# Vectorized geodesic distances on the WGS84 ellipsoid
+# one shared pyproj.Geod and array inputs, so many distances cost a single
+# Geod.inv call instead of one python call (and one Geod) per pair
+import numpy as np
+import pyproj
+
+geod = pyproj.Geod(ellps="WGS84")
+
+
+def distances(lats1, lons1, lats2, lons2):
+    """
+    Geodesic distances between pairs of points, inputs broadcast against each other.
+
+    :return: numpy array of distances in meters
+    """
+    lats1, lons1, lats2, lons2 = np.broadcast_arrays(
+        *(np.asarray(a, dtype=float) for a in (lats1, lons1, lats2, lons2)))
+    if lats1.size == 0:
+        return np.zeros(lats1.shape)
+    _, _, dist = geod.inv(lons1.ravel(), lats1.ravel(), lons2.ravel(), lats2.ravel())
+    return np.asarray(dist).reshape(lats1.shape)
+
+
+def farthest_vertex_distances(lats, lons, polygons_coords):
+    """
+    Geodesic distance from every center to the farthest vertex of its polygon.
+
+    The vertices are ranked by their geodesic distance, so east-west offsets are
+    not underestimated like with distances in degrees.
+
+    :param lats: Latitudes of the centers
+    :param lons: Longitudes of the centers
+    :param polygons_coords: One exterior ring per center, lists of [lon, lat] vertices
+    :return: numpy array of distances in meters, nan for empty rings
+    """
+    sizes = np.array([len(coords) for coords in polygons_coords], dtype=np.int64)
+    result = np.full(len(sizes), np.nan)
+    if not sizes.sum():
+        return result
+    vertices = np.concatenate([np.asarray(coords, dtype=float).reshape(-1, 2) for coords in polygons_coords])
+    owner = np.repeat(np.arange(len(sizes)), sizes)
+    dist = distances(np.asarray(lats, dtype=float)[owner], np.asarray(lons, dtype=float)[owner],
+                     vertices[:, 1], vertices[:, 0])
+    non_empty = sizes > 0
+    starts = np.concatenate([[0], np.cumsum(sizes)[:-1]])
+    result[non_empty] = np.maximum.reduceat(dist, starts[non_empty])
+    return result
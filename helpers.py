@@ -1,7 +1,94 @@
+import gzip
 import json
+import os
 import re
-import pyproj
-from shapely.geometry import Point, Polygon, LineString
+import shutil
+import time
+import numpy as np
+import shapely
+from shapely.geometry import Point, Polygon
+import geodesic
+import metrics
+
+# optional fast json codec, falls back to the standard library
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+# optional zstd compression for .zst files
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+def json_dumps(obj):
+    # one json document as str, non ascii characters are kept as they are
+    if orjson is not None:
+        return orjson.dumps(obj, option=orjson.OPT_NON_STR_KEYS).decode('utf-8')
+    return json.dumps(obj, ensure_ascii=False)
+
+def json_loads(line):
+    if orjson is not None:
+        return orjson.loads(line)
+    return json.loads(line)
+
+def open_jsonl(file_name, mode='r'):
+    """
+    Open a json lines file as text, compressed if the name ends with .gz or .zst.
+    :param file_name: Path of the file
+    :param mode: 'r', 'w' or 'a'
+    :return: Text file object
+    """
+    if file_name.endswith('.gz'):
+        return gzip.open(file_name, mode + 't', encoding='utf-8')
+    if file_name.endswith('.zst'):
+        if zstandard is None:
+            raise ImportError("zstandard is required to read or write .zst files")
+        return zstandard.open(file_name, mode + 't', encoding='utf-8')
+    return open(file_name, mode, encoding='utf-8')
+
+def iter_json_clean(file_name):
+    """
+    Stream the objects of a json lines file one by one.
+    :param file_name: Path of the file, .gz and .zst are decompressed on the fly
+    :return: Generator of dicts
+    """
+    with open_jsonl(file_name, 'r') as f:
+        for line in f:
+            line = line.strip()
+            if line:
+                yield json_loads(line)
+
+def write_json_stream(file_name, rows, append=False):
+    """
+    Write objects from any iterable (e.g. a generator) to a json lines file
+    without holding them in memory.
+    :param file_name: Path of the file, .gz and .zst are compressed
+    :param rows: Iterable of dicts
+    :param append: Append to the file instead of overwriting it
+    :return: Number of written objects
+    """
+    count = 0
+    # only the encoding and writing is timed, not the work of a generator
+    track = metrics.enabled
+    spent = 0.0
+    written = 0
+    with open_jsonl(file_name, 'a' if append else 'w') as f:
+        for row in rows:
+            if track:
+                start = time.perf_counter()
+            line = json_dumps(row) + "\n"
+            f.write(line)
+            count += 1
+            if track:
+                spent += time.perf_counter() - start
+                written += len(line)
+    if track:
+        metrics.observe("json_write_seconds", spent)
+        metrics.count("json_rows_written_total", count)
+        metrics.count("json_characters_written_total", written)
+    return count
 
 def save_json_clean(file_name, dt_to_save):
     if not dt_to_save:
@@ -11,19 +98,108 @@ def save_json_clean(file_name, dt_to_save):
         print("Data to save should be a list.")
         return
     # write the updated properties to the output file
-    with open(file_name, 'w', encoding='utf-8') as f:
-        for prop in dt_to_save:
-            f.write(json.dumps(prop, ensure_ascii=False) + "\n")
+    write_json_stream(file_name, dt_to_save)
     print(f"geocoding complete. data saved to {file_name}")
 
 def read_json_clean(file_name):
     # load the rental properties from the file (one json per line)
-    rental_properties = []
+    return list(iter_json_clean(file_name))
+
+def scenario_name(scenario):
+    # driving_3, walking_7 or radius_500 for a scenario dict of amenities.get_scenarios
+    if scenario["transport_type"] in ("walking", "driving"):
+        return f"{scenario['transport_type']}_{scenario['distance_in_minutes']}"
+    return f"radius_{scenario['radius']}"
+
+def scenario_file(name):
+    # driving_3 -> rental_properties_with_driving_3_amenities.json
+    return f"rental_properties_with_{name}_amenities.json"
+
+def scenario_from_file(file_name):
+    # rental_properties_with_driving_3_amenities.json (or a path to it) -> driving_3
+    match = re.fullmatch(r"rental_properties_with_(\w+?_\d+)_amenities\.json", os.path.basename(file_name))
+    if not match:
+        raise ValueError(f"cannot derive the scenario name from {file_name}")
+    return match.group(1)
+
+def list_scenario_files(directory="."):
+    # scenario output files in a directory, sorted by name
+    return sorted(f for f in os.listdir(directory) if re.fullmatch(r"rental_properties_with_\w+?_\d+_amenities\.json", f))
+
+def journal_file_name(file_name):
+    # checkpoint journal that belongs to an output file
+    return file_name + ".journal"
+
+def iter_journal(file_name):
+    # like iter_json_clean, but a line cut off by a crash is ignored
     with open(file_name, 'r', encoding='utf-8') as f:
         for line in f:
-            if line.strip():
-                rental_properties.append(json.loads(line.strip()))
-    return rental_properties
+            line = line.strip()
+            if line:
+                try:
+                    yield json_loads(line)
+                except ValueError:
+                    print(f"ignoring incomplete line in {file_name}")
+
+def read_journal(file_name):
+    return list(iter_journal(file_name))
+
+def load_resume_index(output_file):
+    """
+    Load the finished properties of an earlier run, keyed by property_id.
+    Reads the output file and its checkpoint journal, journal entries are newer.
+    Only properties with amenities count as finished.
+    :param output_file: Output file of the stage
+    :return: Dict of property_id -> property dict
+    """
+    done = {}
+    journal = journal_file_name(output_file)
+    sources = []
+    if os.path.exists(output_file):
+        sources.append(iter_json_clean(output_file))
+    if os.path.exists(journal):
+        sources.append(iter_journal(journal))
+    for props in sources:
+        for prop in props:
+            if prop.get("property_id") and prop.get("amenities"):
+                done[prop["property_id"]] = prop
+    return done
+
+def open_journal(output_file):
+    # append only, finished properties are written once and never rewritten
+    return open(journal_file_name(output_file), 'a', encoding='utf-8')
+
+def append_journal(journal, entry, sync=True):
+    # write one entry and make sure it is on disk before going on
+    append_journal_line(journal, json_dumps(entry) + "\n", sync=sync)
+
+def append_journal_line(journal, line, sync=True):
+    # same as append_journal for an entry that is already encoded, e.g. by a worker process
+    with metrics.timer("journal_append_seconds", sync=sync):
+        journal.write(line)
+        journal.flush()
+        if sync:
+            os.fsync(journal.fileno())
+
+@metrics.timed("journal_compact_seconds")
+def compact_journal(output_file, dt_to_save=None, start=0):
+    """
+    Write the complete output file once and drop the journal it replaces.
+    :param output_file: Output file of the stage
+    :param dt_to_save: Properties to write, if None the journal itself holds the
+                       complete output from byte offset start on and is copied over
+    :param start: Offset in the journal where the complete output of this run begins
+    """
+    journal = journal_file_name(output_file)
+    if dt_to_save is None:
+        with open(journal, 'rb') as src, open(output_file, 'wb') as dst:
+            src.seek(start)
+            shutil.copyfileobj(src, dst)
+        print(f"data saved to {output_file}")
+    else:
+        save_json_clean(output_file, dt_to_save)
+    if os.path.exists(journal) and os.path.exists(output_file):
+        os.remove(journal)
 
 def parse_price(price_str):
     # convert price string like "chf 2’880.– / monat" to an int
@@ -34,6 +210,25 @@ def parse_price(price_str):
 def has_numbers(inputString):
     return any(char.isdigit() for char in inputString)
 
+def amenity_filter(allowed_amenities=None):
+    # build the overpass tag filter for the allowed amenities list
+    if allowed_amenities:
+        # build a regex pattern from the allowed amenities list
+        pattern = "^(%s)$" % "|".join(allowed_amenities)
+        return f'["amenity"~"{pattern}"]'
+    return '["amenity"]'
+
+def amenity_from_node(node):
+    # convert an overpy node to the amenity dict we store per property
+    return {
+        "id": node.id,
+        "name": node.tags.get("name", "n/a"),
+        "amenity": node.tags.get("amenity", "n/a"),
+        "lat": float(node.lat),
+        "lon": float(node.lon)
+    }
+
+@metrics.timed("polygon_filter_seconds", method="per_point")
 def within_polygon(polygon_coords, point):
     """
     Check if a point is within a polygon defined by its coordinates.
@@ -59,31 +254,51 @@ def within_polygon(polygon_coords, point):
     
     return polygon.contains(point)
 
+def prepared_polygon(polygon_coords):
+    # build the polygon once and prepare it for repeated containment checks
+    polygon = Polygon(polygon_coords)
+    shapely.prepare(polygon)
+    return polygon
+
+@metrics.timed("polygon_filter_seconds", method="batch")
+def within_polygon_batch(polygon_coords, lats, lons):
+    """
+    Check for many points at once if they are within one polygon.
+    :param polygon_coords: List of (lon, lat) vertices, as in an isochrone GeoJSON, or a shapely Polygon
+    :param lats: Array of point latitudes
+    :param lons: Array of point longitudes
+    :return: Boolean numpy array, True where the point is within the polygon
+    """
+    polygon = polygon_coords if isinstance(polygon_coords, Polygon) else prepared_polygon(polygon_coords)
+    return shapely.contains_xy(polygon, np.asarray(lons, dtype=float), np.asarray(lats, dtype=float))
+
+@metrics.timed("polygon_filter_seconds", method="all_properties")
+def within_polygons_batch(polygons_coords, lats, lons):
+    """
+    Containment check for many polygons (e.g. one isochrone per property) in one call.
+    :param polygons_coords: List of polygon vertex lists, one per property
+    :param lats: List of latitude arrays, the candidate points of each property
+    :param lons: List of longitude arrays, the candidate points of each property
+    :return: List of boolean numpy arrays, one per property
+    """
+    polygons = np.array([prepared_polygon(coords) for coords in polygons_coords], dtype=object)
+    counts = np.array([len(la) for la in lats], dtype=int)
+    if counts.sum() == 0:
+        return [np.zeros(0, dtype=bool) for _ in counts]
+    # repeat every polygon for its candidates and test all pairs in one vectorized call
+    mask = shapely.contains_xy(np.repeat(polygons, counts),
+                               np.concatenate([np.asarray(lo, dtype=float) for lo in lons]),
+                               np.concatenate([np.asarray(la, dtype=float) for la in lats]))
+    return np.split(mask, np.cumsum(counts)[:-1])
+
 def farthest_distance_from_center(lat, lon, polygon_coords):
     """
     Calculate the farthest distance from the center of a polygon defined by its coordinates.
-    :param polygon_coords: List of (lat, lon) tuples defining the polygon vertices
-    :return: Farthest distance from the center of the polygon to its vertices in meters
+    :param polygon_coords: List of [lon, lat] pairs defining the polygon vertices
+    :return: Farthest geodesic distance from the center of the polygon to its vertices in meters
     """
-    # Convert polygon_coords array to list of tuples
-    if isinstance(polygon_coords, list) and all(isinstance(coord, list) and len(coord) == 2 for coord in polygon_coords):
-        polygon_coords = [tuple(coord) for coord in polygon_coords]
-    
-    # Check if polygon_coords is a list of tuples
-    if not isinstance(polygon_coords, list) or not all(isinstance(coord, tuple) and len(coord) == 2 for coord in polygon_coords):
-        raise ValueError("polygon_coords must be a list of (lat, lon) tuples")
-    
-    # calculate the farthest distance from coordinates to the farthest point in the polygon in meters
-    polygon = Polygon(polygon_coords)
-    center = Point(lon, lat)  # Note: Point takes (lon, lat)
-    vertex = polygon.exterior.coords
-
-    #calculate all distances from centroid to polygon vertex
-    distances=[LineString([center, v]).length for v in vertex]
-    farthest_point = Point(vertex[distances.index(max(distances))])
-    
-    #convert max_distance to meters using pyproj
-    geod = pyproj.Geod(ellps="WGS84")
-    _, _, max_distance = geod.inv(center.x, center.y, farthest_point.x, farthest_point.y)
+    if not isinstance(polygon_coords, (list, tuple, np.ndarray)) or not all(len(coord) == 2 for coord in polygon_coords):
+        raise ValueError("polygon_coords must be a list of [lon, lat] pairs")
 
-    return max_distance  # Convert to meters (assuming the CRS is in degrees)
\ No newline at end of file
+    # rank the vertices by their geodesic distance, degrees underestimate east-west offsets
+    return float(geodesic.farthest_vertex_distances([lat], [lon], [polygon_coords])[0])
\ No newline at end of file
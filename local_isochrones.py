@@ -0,0 +1,325 @@
+# Offline isochrone engine on a local road network
+# the road graph is read once from an osm extract (.osm xml, optionally gzipped,
+# or an overpass json dump of highways), one sparse travel time graph per
+# profile is kept in a compressed .npz cache next to it. Isochrones come from a
+# time bounded dijkstra per origin on the nodes it can reach in time (optionally
+# spread over a process pool) and the reached nodes are turned into a polygon with the same
+# GeoJSON shape the mapbox isochrone api returns
+import gzip
+import json
+import os
+import xml.etree.ElementTree as ET
+from concurrent.futures import ProcessPoolExecutor
+import numpy as np
+import shapely
+from scipy.sparse import csr_matrix
+from scipy.sparse.csgraph import dijkstra
+from sklearn.neighbors import BallTree
+import geodesic
+
+# bump when the graph layout changes, older caches are rebuilt
+graph_version = 1
+
+# speed in km/h per highway type, highways that are not listed can't be used
+walking_speeds = dict.fromkeys([
+    "primary", "primary_link", "secondary", "secondary_link", "tertiary", "tertiary_link", "unclassified",
+    "residential", "living_street", "service", "pedestrian", "footway", "path", "steps", "track",
+    "cycleway", "bridleway", "corridor", "road",
+], 5.0)
+cycling_speeds = dict.fromkeys([
+    "primary", "primary_link", "secondary", "secondary_link", "tertiary", "tertiary_link", "unclassified",
+    "residential", "living_street", "service", "track", "cycleway", "path", "road",
+], 15.0)
+driving_speeds = {
+    "motorway": 100, "motorway_link": 60, "trunk": 80, "trunk_link": 50, "primary": 60, "primary_link": 40,
+    "secondary": 50, "secondary_link": 40, "tertiary": 40, "tertiary_link": 30, "unclassified": 30,
+    "residential": 30, "living_street": 10, "service": 15, "road": 30,
+}
+profiles = {
+    "walking": {"speeds": walking_speeds, "oneway": False, "no_access": ("foot",)},
+    "cycling": {"speeds": cycling_speeds, "oneway": True, "no_access": ("bicycle", "vehicle")},
+    "driving": {"speeds": driving_speeds, "oneway": True, "no_access": ("motor_vehicle", "motorcar", "vehicle")},
+}
+# mean earth radius in meters of the haversine ball trees
+earth_radius = 6371008.8
+# speed in km/h from the origin to the nearest node of the graph
+access_speed = 5.0
+# shapely.concave_hull ratio of the isochrone polygons, 1 is the convex hull
+hull_ratio = 0.3
+# style of the mapbox responses, so both backends look the same on a map
+feature_style = {"fill-opacity": 0.33, "fillColor": "#bf4040", "opacity": 0.33, "fill": "#bf4040",
+                 "fillOpacity": 0.33, "color": "#bf4040"}
+
+
+def max_speed(profile):
+    # fastest edge of a profile in km/h, maxspeed tags can raise driving speeds by half
+    speed = max(profiles[profile]["speeds"].values())
+    return speed * 1.5 if profile == "driving" else speed
+
+
+def read_osm_xml(file_name):
+    # (node id -> (lat, lon), list of (tags, node refs)) of the highways of an osm xml extract
+    nodes = {}
+    ways = []
+    opener = gzip.open if file_name.endswith(".gz") else open
+    with opener(file_name, "rb") as f:
+        for _, element in ET.iterparse(f, events=("end",)):
+            if element.tag == "node":
+                nodes[int(element.get("id"))] = (float(element.get("lat")), float(element.get("lon")))
+                element.clear()
+            elif element.tag == "way":
+                tags = {tag.get("k"): tag.get("v") for tag in element.iter("tag")}
+                if "highway" in tags:
+                    ways.append((tags, [int(nd.get("ref")) for nd in element.iter("nd")]))
+                element.clear()
+    return nodes, ways
+
+
+def read_overpass_json(file_name):
+    # same as read_osm_xml for an overpass [out:json] dump, e.g. way[highway](bbox);(._;>;);out;
+    opener = gzip.open if file_name.endswith(".gz") else open
+    with opener(file_name, "rt", encoding="utf-8") as f:
+        data = json.load(f)
+    nodes = {}
+    ways = []
+    for element in data.get("elements", []):
+        if element.get("type") == "node":
+            nodes[element["id"]] = (float(element["lat"]), float(element["lon"]))
+        elif element.get("type") == "way" and "highway" in element.get("tags", {}):
+            ways.append((element["tags"], element.get("nodes", [])))
+    return nodes, ways
+
+
+def parse_speed(value):
+    # maxspeed tag in km/h, None if it is not a plain number
+    try:
+        return float(str(value).split()[0])
+    except (ValueError, IndexError):
+        return None
+
+
+def way_direction(tags, profile):
+    # 1 forward only, -1 backward only, 0 both directions
+    if not profiles[profile]["oneway"]:
+        return 0
+    oneway = tags.get("oneway", "")
+    if oneway in ("yes", "true", "1"):
+        return 1
+    if oneway == "-1":
+        return -1
+    if oneway == "no":
+        return 0
+    if tags.get("junction") in ("roundabout", "circular") or tags.get("highway") == "motorway":
+        return 1
+    return 0
+
+
+class RoadGraph:
+    """
+    Road network with one travel time graph per profile.
+
+    :param lats: Latitudes of the graph nodes
+    :param lons: Longitudes of the graph nodes
+    :param graphs: Dict of profile -> scipy csr_matrix of travel times in seconds
+    :param source: Signature of the extract the graph was built from
+    """
+
+    def __init__(self, lats, lons, graphs, source=None):
+        self.lats = np.asarray(lats, dtype=float)
+        self.lons = np.asarray(lons, dtype=float)
+        self.graphs = graphs
+        self.source = source
+        self.trees = {}
+
+    @staticmethod
+    def from_extract(file_name):
+        """Build the graph from an osm xml extract or an overpass json dump."""
+        if file_name.endswith((".json", ".json.gz")):
+            nodes, ways = read_overpass_json(file_name)
+        else:
+            nodes, ways = read_osm_xml(file_name)
+        # only nodes of highways end up in the graph
+        used = sorted({ref for _, refs in ways for ref in refs if ref in nodes})
+        position = {ref: i for i, ref in enumerate(used)}
+        coords = np.array([nodes[ref] for ref in used], dtype=float).reshape(-1, 2)
+        n = len(used)
+        graphs = {}
+        for profile, settings in profiles.items():
+            u, v, speeds = [], [], []
+            for tags, refs in ways:
+                speed = settings["speeds"].get(tags["highway"])
+                if speed is None or tags.get("access") in ("no", "private"):
+                    continue
+                if any(tags.get(key) == "no" for key in settings["no_access"]):
+                    continue
+                if profile == "driving":
+                    speed = min(parse_speed(tags.get("maxspeed")) or speed, speed * 1.5)
+                refs = [position[ref] for ref in refs if ref in position]
+                direction = way_direction(tags, profile)
+                for a, b in zip(refs[:-1], refs[1:]):
+                    if direction >= 0:
+                        u.append(a), v.append(b), speeds.append(speed)
+                    if direction <= 0:
+                        u.append(b), v.append(a), speeds.append(speed)
+            u = np.asarray(u, dtype=np.int64)
+            v = np.asarray(v, dtype=np.int64)
+            lengths = geodesic.distances(coords[u, 0], coords[u, 1], coords[v, 0], coords[v, 1]) if len(u) else np.zeros(0)
+            seconds = lengths / (np.asarray(speeds, dtype=float) / 3.6)
+            # keep the fastest of parallel edges, csr_matrix would add them up
+            order = np.lexsort((seconds, v, u))
+            u, v, seconds = u[order], v[order], seconds[order]
+            first = np.ones(len(u), dtype=bool)
+            first[1:] = (u[1:] != u[:-1]) | (v[1:] != v[:-1])
+            # zero length edges would vanish in the sparse matrix
+            seconds = np.maximum(seconds[first], 1e-3).astype(np.float32)
+            graphs[profile] = csr_matrix((seconds, (u[first], v[first])), shape=(n, n))
+        stat = os.stat(file_name)
+        return RoadGraph(coords[:, 0], coords[:, 1], graphs, source=f"{os.path.basename(file_name)}|{stat.st_size}|{stat.st_mtime_ns}")
+
+    def save(self, file_name):
+        arrays = {"lats": self.lats, "lons": self.lons, "version": np.array(graph_version), "source": np.array(self.source or "")}
+        for profile, graph in self.graphs.items():
+            arrays[f"{profile}_indptr"] = graph.indptr
+            arrays[f"{profile}_indices"] = graph.indices
+            arrays[f"{profile}_data"] = graph.data
+        with open(file_name, "wb") as f:
+            np.savez_compressed(f, **arrays)
+        print(f"road graph with {len(self.lats)} nodes saved to {file_name}")
+
+    @staticmethod
+    def load(file_name):
+        with np.load(file_name) as data:
+            n = len(data["lats"])
+            graphs = {profile: csr_matrix((data[f"{profile}_data"], data[f"{profile}_indices"], data[f"{profile}_indptr"]), shape=(n, n))
+                      for profile in profiles if f"{profile}_data" in data}
+            graph = RoadGraph(data["lats"], data["lons"], graphs, source=str(data["source"]))
+            graph.version = int(data["version"])
+        return graph
+
+    def node_tree(self, profile):
+        # haversine ball tree over the nodes that have an edge in the graph of profile
+        if profile not in self.trees:
+            graph = self.graphs[profile]
+            connected = np.flatnonzero(np.diff(graph.indptr) + np.bincount(graph.indices, minlength=graph.shape[0]))
+            coords = np.radians(np.column_stack([self.lats[connected], self.lons[connected]]))
+            self.trees[profile] = (BallTree(coords, leaf_size=15, metric="haversine"), connected)
+        return self.trees[profile]
+
+    def nearest_nodes(self, profile, lats, lons):
+        """
+        Snap points to the nearest node that has an edge in the graph of profile.
+
+        :return: (node positions, distances in meters)
+        """
+        tree, connected = self.node_tree(profile)
+        points = np.radians(np.column_stack([np.asarray(lats, dtype=float), np.asarray(lons, dtype=float)]))
+        _, indices = tree.query(points, k=1)
+        nodes = connected[indices[:, 0]]
+        return nodes, geodesic.distances(lats, lons, self.lats[nodes], self.lons[nodes])
+
+    def isochrones(self, points, profile, distances):
+        """
+        Isochrones of many origins, one bounded dijkstra per origin on the part of
+        the graph that can be reached in time.
+
+        :param points: List of (lat, lon) origins
+        :param profile: 'walking', 'cycling' or 'driving'
+        :param distances: List of travel times in minutes
+        :return: List of dicts minutes -> isochrone GeoJSON, in the order of points
+        """
+        if not len(points):
+            return []
+        lats = np.array([p[0] for p in points], dtype=float)
+        lons = np.array([p[1] for p in points], dtype=float)
+        nodes, offsets = self.nearest_nodes(profile, lats, lons)
+        # the way from the origin to the road is walked
+        offsets = offsets / (access_speed / 3.6)
+        limit = max(distances) * 60
+        # no path gets farther than the fastest edge allows in the time limit, so
+        # dijkstra only needs the nodes within that radius (1% for the sphere of
+        # the ball tree against the ellipsoid of the edge lengths). Its result has
+        # one entry per subgraph node instead of one per node of the whole extract
+        reach = max_speed(profile) / 3.6 * limit * 1.01 / earth_radius
+        tree, connected = self.node_tree(profile)
+        neighborhoods = tree.query_radius(np.radians(np.column_stack([self.lats[nodes], self.lons[nodes]])), r=reach)
+        graph = self.graphs[profile]
+        results = []
+        for node, neighborhood, lat, lon, offset in zip(nodes, neighborhoods, lats, lons, offsets):
+            sub = np.sort(connected[neighborhood])
+            times = dijkstra(graph[sub][:, sub], indices=np.searchsorted(sub, node), limit=limit)
+            results.append({minutes: self.polygon(lat, lon, sub[times <= minutes * 60 - offset], minutes) for minutes in distances})
+        return results
+
+    def polygon(self, lat, lon, reached, minutes):
+        # concave hull of the origin and the reached nodes (positions in ascending order)
+        coords = np.column_stack([np.append(self.lons[reached], lon), np.append(self.lats[reached], lat)])
+        hull = shapely.concave_hull(shapely.multipoints(coords), ratio=hull_ratio)
+        if hull.geom_type != "Polygon":
+            # a point or a line if almost nothing is reachable, keep a small area around it
+            hull = hull.buffer(1e-4)
+        ring = np.round(np.asarray(hull.exterior.coords), 6).tolist()
+        return {
+            "features": [{
+                "properties": dict(feature_style, contour=minutes, metric="time"),
+                "geometry": {"coordinates": [ring], "type": "Polygon"},
+                "type": "Feature",
+            }],
+            "type": "FeatureCollection",
+        }
+
+
+def graph_cache_file(extract_file):
+    return extract_file + ".graph.npz"
+
+
+def load_or_build_graph(extract_file, cache_file=None):
+    """
+    Load the cached road graph of an extract, or build it and cache it.
+
+    :param extract_file: .osm / .osm.gz xml extract or overpass json dump of highways
+    :param cache_file: Path of the .npz cache, next to the extract by default
+    :return: RoadGraph
+    """
+    cache_file = cache_file or graph_cache_file(extract_file)
+    if os.path.exists(cache_file):
+        graph = RoadGraph.load(cache_file)
+        stat = os.stat(extract_file) if os.path.exists(extract_file) else None
+        source = f"{os.path.basename(extract_file)}|{stat.st_size}|{stat.st_mtime_ns}" if stat else graph.source
+        # a changed extract or an older cache layout is rebuilt
+        if graph.version == graph_version and graph.source == source:
+            return graph
+    graph = RoadGraph.from_extract(extract_file)
+    graph.save(cache_file)
+    return graph
+
+
+worker_graph = None
+
+
+def init_worker(cache_file):
+    # every worker process loads the cached graph once
+    global worker_graph
+    worker_graph = RoadGraph.load(cache_file)
+
+
+def worker_isochrones(points, profile, distances):
+    return worker_graph.isochrones(points, profile, distances)
+
+
+def isochrones_parallel(extract_file, points, profile, distances, workers=None, chunk_size=32):
+    """
+    Isochrones of many origins, spread over a process pool.
+
+    :param extract_file: Osm extract, its graph cache is built first if needed
+    :param points: List of (lat, lon) origins
+    :param workers: Number of processes, None for one per cpu
+    :return: List of dicts minutes -> isochrone GeoJSON, in the order of points
+    """
+    graph = load_or_build_graph(extract_file)
+    workers = workers or os.cpu_count()
+    if workers <= 1 or len(points) <= chunk_size:
+        return graph.isochrones(points, profile, distances)
+    chunks = [points[i:i + chunk_size] for i in range(0, len(points), chunk_size)]
+    with ProcessPoolExecutor(max_workers=workers, initializer=init_worker, initargs=(graph_cache_file(extract_file),)) as pool:
+        results = pool.map(worker_isochrones, chunks, [profile] * len(chunks), [distances] * len(chunks))
+        return [isochrones for chunk in results for isochrones in chunk]
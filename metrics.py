@@ -0,0 +1,227 @@
+# Lightweight run metrics: counters, timers and histograms
+# disabled by default, every call returns right away then. Enable it with
+# METRICS=1 or metrics.enable(), the summary is written as json and in the
+# prometheus text format with write_summary()
+import json
+import math
+import os
+import threading
+import time
+from functools import wraps
+
+enabled = os.getenv("METRICS", "") not in ("", "0", "false")
+
+# upper bounds of the histogram buckets
+latency_buckets = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, math.inf)
+ratio_buckets = (0.1, 0.2, 0.3, 0.4, 0.5, 0.6, 0.7, 0.8, 0.9, 1.0, math.inf)
+size_buckets = (10, 100, 1000, 10000, 100000, 1000000, 10000000, math.inf)
+
+counters = {}
+histograms = {}
+lock = threading.Lock()
+
+
+class Histogram:
+    def __init__(self, buckets):
+        self.buckets = buckets
+        self.counts = [0] * len(buckets)
+        self.count = 0
+        self.sum = 0.0
+        self.min = math.inf
+        self.max = -math.inf
+
+    def observe(self, value):
+        for i, bound in enumerate(self.buckets):
+            if value <= bound:
+                self.counts[i] += 1
+                break
+        self.count += 1
+        self.sum += value
+        self.min = min(self.min, value)
+        self.max = max(self.max, value)
+
+    def quantile(self, q):
+        # estimated from the buckets, linear within the bucket the quantile falls into
+        if not self.count:
+            return None
+        rank = q * self.count
+        seen = 0
+        lower = 0.0
+        for bound, n in zip(self.buckets, self.counts):
+            if n and seen + n >= rank:
+                upper = min(bound, self.max)
+                lower = max(lower, self.min)
+                return lower + (upper - lower) * (rank - seen) / n
+            seen += n
+            lower = bound
+        return self.max
+
+    def to_dict(self):
+        return {
+            "count": self.count,
+            "sum": self.sum,
+            "min": self.min if self.count else None,
+            "max": self.max if self.count else None,
+            "mean": self.sum / self.count if self.count else None,
+            "p50": self.quantile(0.5),
+            "p90": self.quantile(0.9),
+            "p99": self.quantile(0.99),
+        }
+
+
+def enable():
+    global enabled
+    enabled = True
+
+
+def disable():
+    global enabled
+    enabled = False
+
+
+def reset():
+    with lock:
+        counters.clear()
+        histograms.clear()
+
+
+def metric_key(name, labels):
+    return (name, tuple(sorted(labels.items())))
+
+
+def count(name, value=1, **labels):
+    """Add value to the counter name."""
+    if not enabled:
+        return
+    key = metric_key(name, labels)
+    with lock:
+        counters[key] = counters.get(key, 0) + value
+
+
+def observe(name, value, buckets=latency_buckets, **labels):
+    """Record value in the histogram name."""
+    if not enabled:
+        return
+    key = metric_key(name, labels)
+    with lock:
+        histogram = histograms.get(key)
+        if histogram is None:
+            histogram = histograms[key] = Histogram(buckets)
+        histogram.observe(value)
+
+
+class Timer:
+    # context manager that records the elapsed seconds in a histogram
+    def __init__(self, name, labels):
+        self.name = name
+        self.labels = labels
+        self.start = None
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc_info):
+        observe(self.name, time.perf_counter() - self.start, **self.labels)
+        return False
+
+
+class NullTimer:
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        return False
+
+
+null_timer = NullTimer()
+
+
+def timer(name, **labels):
+    """
+    Time a block: with metrics.timer("api_request_seconds", provider="mapbox"): ...
+
+    :return: Context manager, a shared no-op one if metrics are disabled
+    """
+    if not enabled:
+        return null_timer
+    return Timer(name, labels)
+
+
+def timed(name, **labels):
+    """Decorator that times every call of a function in the histogram name."""
+    def decorator(func):
+        @wraps(func)
+        def wrapper(*args, **kwargs):
+            if not enabled:
+                return func(*args, **kwargs)
+            with Timer(name, labels):
+                return func(*args, **kwargs)
+        return wrapper
+    return decorator
+
+
+def summary():
+    """
+    All metrics as a json serializable dict.
+
+    :return: Dict with "counters" and "histograms", each a list of {name, labels, ...}
+    """
+    with lock:
+        return {
+            "timestamp": time.strftime("%Y-%m-%dT%H:%M:%S"),
+            "counters": [{"name": name, "labels": dict(labels), "value": value}
+                         for (name, labels), value in sorted(counters.items())],
+            "histograms": [dict({"name": name, "labels": dict(labels)}, **histogram.to_dict())
+                           for (name, labels), histogram in sorted(histograms.items())],
+        }
+
+
+def format_labels(labels, extra=()):
+    labels = list(labels) + list(extra)
+    if not labels:
+        return ""
+    return "{" + ",".join(f'{k}="{v}"' for k, v in labels) + "}"
+
+
+def prometheus_text():
+    """All metrics in the prometheus text exposition format."""
+    lines = []
+    typed = set()
+    with lock:
+        for (name, labels), value in sorted(counters.items()):
+            if name not in typed:
+                lines.append(f"# TYPE {name} counter")
+                typed.add(name)
+            lines.append(f"{name}{format_labels(labels)} {value}")
+        for (name, labels), histogram in sorted(histograms.items()):
+            if name not in typed:
+                lines.append(f"# TYPE {name} histogram")
+                typed.add(name)
+            cumulative = 0
+            for bound, n in zip(histogram.buckets, histogram.counts):
+                cumulative += n
+                le = "+Inf" if bound == math.inf else repr(bound)
+                lines.append(f"{name}_bucket{format_labels(labels, [('le', le)])} {cumulative}")
+            lines.append(f"{name}_sum{format_labels(labels)} {histogram.sum}")
+            lines.append(f"{name}_count{format_labels(labels)} {histogram.count}")
+    return "\n".join(lines) + "\n"
+
+
+def write_summary(json_file="metrics.json", prometheus_file="metrics.prom"):
+    """
+    Write the metrics collected so far, nothing is written if metrics are disabled.
+
+    :param json_file: Path of the json summary, None to skip it
+    :param prometheus_file: Path of the prometheus text file, None to skip it
+    """
+    if not enabled:
+        return
+    if json_file:
+        with open(json_file, "w", encoding="utf-8") as f:
+            json.dump(summary(), f, indent=2)
+        print(f"metrics saved to {json_file}")
+    if prometheus_file:
+        with open(prometheus_file, "w", encoding="utf-8") as f:
+            f.write(prometheus_text())
+        print(f"metrics saved to {prometheus_file}")
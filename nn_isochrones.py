@@ -1,4 +1,5 @@
 # Nearest neighbor functions
+import pickle
 import time
 from sklearn.neighbors import BallTree
 import numpy as np
@@ -6,18 +7,133 @@ import requests
 
 from openrouteservice import client
 import os
+from disk_cache import DiskCache
+import geodesic
+import metrics
 
 open_route_key = os.getenv("OPENROUTE")
 mapbox_token = os.getenv("MAPBOX")
+mapbox_url = os.getenv("MAPBOX_URL", "https://api.mapbox.com")
 
-def get_nearest(src_points, candidates, k_neighbors=1):
-    """Find nearest neighbors for all source points from a set of candidate points"""
+# mapbox returns at most 4 contours per request
+max_contours_per_request = 4
+# minimum seconds between two mapbox requests, cache hits are not delayed
+min_request_interval = 1
+last_request_time = 0
+
+# persistent isochrone cache, keyed by profile, minutes and rounded coordinates
+isochrone_cache_file = os.getenv("ISOCHRONE_CACHE", "isochrone_cache.sqlite")
+isochrone_cache_max_bytes = 512 * 1024 * 1024
+# decimals the coordinates are rounded to in the cache key, 6 decimals are ~0.1 m
+isochrone_cache_precision = 6
+isochrone_cache = None
+
+# isochrone backend: "mapbox" for the api, "local" for the road graph of local_isochrones
+isochrone_backend = os.getenv("ISOCHRONE_BACKEND", "mapbox")
+# osm extract of the local backend, its graph is cached next to it as .graph.npz
+isochrone_graph_file = os.getenv("ISOCHRONE_GRAPH", "road_network.osm")
+local_graph = None
+
+def configure_isochrone_cache(file_name="isochrone_cache.sqlite", max_bytes=512 * 1024 * 1024, precision=6):
+    """
+    Change the isochrone cache settings.
+
+    :param file_name: Path of the cache file, None disables the cache
+    :param max_bytes: Size limit, least recently used isochrones are evicted first
+    :param precision: Decimals the coordinates are rounded to in the cache key
+    """
+    global isochrone_cache, isochrone_cache_file, isochrone_cache_max_bytes, isochrone_cache_precision
+    if isochrone_cache is not None:
+        isochrone_cache.close()
+    isochrone_cache = None
+    isochrone_cache_file = file_name
+    isochrone_cache_max_bytes = max_bytes
+    isochrone_cache_precision = precision
+
+def get_isochrone_cache():
+    # open the cache lazily, so importing the module does not create the file
+    global isochrone_cache
+    if isochrone_cache is None and isochrone_cache_file:
+        isochrone_cache = DiskCache(isochrone_cache_file, max_bytes=isochrone_cache_max_bytes)
+    return isochrone_cache
+
+def isochrone_cache_key(profile, minutes, lat, lon):
+    lat = round(float(lat), isochrone_cache_precision)
+    lon = round(float(lon), isochrone_cache_precision)
+    key = f"{profile}|{minutes}|{lat}|{lon}"
+    # the local polygons differ from the mapbox ones, they are cached apart
+    return f"local|{key}" if isochrone_backend == "local" else key
+
+def get_local_graph():
+    # load the road graph once, it is built from the extract on the first run
+    global local_graph
+    if local_graph is None:
+        import local_isochrones
+        local_graph = local_isochrones.load_or_build_graph(isochrone_graph_file)
+    return local_graph
+
+def get_local_isochrones(isochrones, lat, lon, profile, distances):
+    # compute the missing contours on the local road graph and cache them
+    cache = get_isochrone_cache()
+    with metrics.timer("local_isochrone_seconds", profile=profile):
+        contours = get_local_graph().isochrones([(lat, lon)], profile, distances)[0]
+    for distance in distances:
+        isochrones[distance] = contours[distance]
+        if cache is not None:
+            cache.set(isochrone_cache_key(profile, distance, lat, lon), contours[distance])
+
+def prefetch_isochrones(points, profile, distances, workers=None):
+    """
+    Compute the isochrones of many points at once on the local road graph and
+    put them in the cache, later get_isochrones calls are cache hits. Does
+    nothing for the mapbox backend or without a cache.
+
+    :param points: List of (lat, lon)
+    :param workers: Number of processes, None for one per cpu
+    :return: Number of points that were computed
+    """
+    cache = get_isochrone_cache()
+    if isochrone_backend != "local" or cache is None or not distances:
+        return 0
+    import local_isochrones
+    todo = list(dict.fromkeys(
+        (lat, lon) for lat, lon in points
+        if any(isochrone_cache_key(profile, distance, lat, lon) not in cache for distance in distances)
+    ))
+    if not todo:
+        return 0
+    results = local_isochrones.isochrones_parallel(isochrone_graph_file, todo, profile, distances, workers=workers)
+    for (lat, lon), contours in zip(todo, results):
+        for distance in distances:
+            cache.set(isochrone_cache_key(profile, distance, lat, lon), contours[distance])
+    print(f"{len(todo)} {profile} isochrones computed on the local road graph")
+    return len(todo)
+
+earth_radius = 6371000  # meters
+
+def build_tree(candidates):
+    """Create a haversine BallTree from candidate points given as (lat, lon) in radians"""
+    return BallTree(candidates, leaf_size=15, metric='haversine')
+
+def get_nearest(src_points, candidates=None, k_neighbors=1, tree=None, return_all=False):
+    """
+    Find nearest neighbors for all source points from a set of candidate points
+
+    :param src_points: Array of (lat, lon) in radians
+    :param candidates: Array of (lat, lon) in radians, not needed if a prebuilt tree is given
+    :param k_neighbors: Number of neighbors to find
+    :param tree: Optional BallTree from build_tree, reused instead of building a new one
+    :param return_all: Return all k neighbors as (n, k) arrays instead of only the closest
+    """
 
     # Create tree from the candidate points
-    tree = BallTree(candidates, leaf_size=15, metric='haversine')
+    if tree is None:
+        tree = build_tree(candidates)
 
     # Find closest points and distances
     distances, indices = tree.query(src_points, k=k_neighbors)
+    if return_all:
+        return (indices, distances)
 
     # Transpose to get distances and indices into arrays
     distances = distances.transpose()
@@ -39,37 +155,133 @@ def nearest_neighbor(left_gdf, right_gdf, return_dist=False):
     NOTICE: Assumes that the input Points are in WGS84 projection (lat/lon).
     """
 
-    left_geom_col = left_gdf.geometry.name
-    right_geom_col = right_gdf.geometry.name
-
-    # Ensure that index in right gdf is formed of sequential numbers
-    right = right_gdf.copy().reset_index(drop=True)
+    left_geom = left_gdf.geometry
+    right_geom = right_gdf.geometry
 
-    # Parse coordinates from points and insert them into a numpy array as RADIANS
-    left_radians = np.array(left_gdf[left_geom_col].apply(lambda geom: (geom.x * np.pi / 180, geom.y * np.pi / 180)).to_list())
-    right_radians = np.array(right[right_geom_col].apply(lambda geom: (geom.x * np.pi / 180, geom.y * np.pi / 180)).to_list())
+    # Parse coordinates from points into numpy arrays as RADIANS, the haversine
+    # tree expects (lat, lon), i.e. (y, x)
+    left_radians = np.radians(np.column_stack([left_geom.y.to_numpy(), left_geom.x.to_numpy()]))
+    right_radians = np.radians(np.column_stack([right_geom.y.to_numpy(), right_geom.x.to_numpy()]))
 
     # Find the nearest points
     # -----------------------
-    # closest ==> index in right_gdf that corresponds to the closest point
+    # closest ==> position in right_gdf that corresponds to the closest point
     # dist ==> distance between the nearest neighbors (in meters)
 
     closest, dist = get_nearest(src_points=left_radians, candidates=right_radians)
 
-    # Return points from right GeoDataFrame that are closest to points in left GeoDataFrame
-    closest_points = right.loc[closest]
+    # Return points from right GeoDataFrame that are closest to points in left GeoDataFrame,
+    # selected by position so right_gdf does not need to be copied and reindexed
+    closest_points = right_gdf.iloc[closest]
 
     # Ensure that the index corresponds the one in left_gdf
     closest_points = closest_points.reset_index(drop=True)
 
     # Add distance if requested
     if return_dist:
-        # Convert to meters from radians
-        earth_radius = 6371000  # meters
-        closest_points['distance'] = dist * earth_radius
+        # geodesic distance in meters between each left point and its neighbor
+        closest_points['distance'] = geodesic.distances(left_geom.y.to_numpy(), left_geom.x.to_numpy(),
+                                                        right_geom.y.to_numpy()[closest], right_geom.x.to_numpy()[closest])
 
     return closest_points
 
+
+class NearestAmenityIndex:
+    """
+    Reusable k-nearest index over amenities, one BallTree per amenity type.
+
+    Built once from amenity dicts (id, amenity, lat, lon), saved to and loaded
+    from disk, and queried for all properties at once.
+    """
+
+    def __init__(self, amenities):
+        by_type = {}
+        for amenity in amenities:
+            by_type.setdefault(amenity["amenity"], {})[amenity["id"]] = (amenity["lat"], amenity["lon"])
+        self.ids = {}
+        self.trees = {}
+        for amenity_type, nodes in sorted(by_type.items()):
+            ids = np.fromiter(nodes.keys(), dtype=np.int64, count=len(nodes))
+            coords = np.radians(np.array(list(nodes.values()), dtype=float))
+            self.ids[amenity_type] = ids
+            self.trees[amenity_type] = build_tree(coords)
+
+    @property
+    def amenity_types(self):
+        return list(self.trees)
+
+    def query(self, lats, lons, amenity_type, k=1, n_jobs=1):
+        """
+        k nearest amenities of one type for many points.
+
+        :param lats: Array of latitudes
+        :param lons: Array of longitudes
+        :param amenity_type: e.g. "pharmacy"
+        :param k: Number of neighbors, padded with nan / -1 if there are fewer amenities
+        :param n_jobs: Number of threads the points are split over
+        :return: (distances in meters, osm ids), both arrays of shape (n, k)
+        """
+        points = np.radians(np.column_stack([np.asarray(lats, dtype=float), np.asarray(lons, dtype=float)]))
+        n = len(points)
+        distances = np.full((n, k), np.nan)
+        ids = np.full((n, k), -1, dtype=np.int64)
+        tree = self.trees.get(amenity_type)
+        valid = ~np.isnan(points).any(axis=1)
+        if tree is None or not valid.any():
+            return distances, ids
+        k_available = min(k, len(self.ids[amenity_type]))
+        query_points = points[valid]
+        if n_jobs and n_jobs > 1 and len(query_points) > n_jobs:
+            # chunks share the read only tree, sklearn runs the tree queries without holding the gil
+            from concurrent.futures import ThreadPoolExecutor
+            chunks = np.array_split(query_points, n_jobs)
+            with ThreadPoolExecutor(max_workers=n_jobs) as pool:
+                results = list(pool.map(lambda c: get_nearest(c, k_neighbors=k_available, tree=tree, return_all=True), chunks))
+            indices = np.vstack([r[0] for r in results])
+            dist = np.vstack([r[1] for r in results])
+        else:
+            indices, dist = get_nearest(query_points, k_neighbors=k_available, tree=tree, return_all=True)
+        distances[valid, :k_available] = dist * earth_radius
+        ids[valid, :k_available] = self.ids[amenity_type][indices]
+        return distances, ids
+
+    def features(self, lats, lons, amenity_types=None, k=5, n_jobs=1):
+        """
+        Distance features for many points, in meters.
+
+        :return: Dict of column -> array with "<type>_nearest_m" (distance to the
+                 nearest amenity) and "<type>_mean_<k>_nearest_m" (mean distance
+                 to the k nearest ones) for every amenity type
+        """
+        columns = {}
+        for amenity_type in amenity_types or self.amenity_types:
+            distances, _ = self.query(lats, lons, amenity_type, k=k, n_jobs=n_jobs)
+            columns[f"{amenity_type}_nearest_m"] = distances[:, 0]
+            with np.errstate(invalid='ignore'):
+                # nan if there are fewer than k amenities of the type
+                columns[f"{amenity_type}_mean_{k}_nearest_m"] = distances.mean(axis=1)
+        return columns
+
+    def save(self, file_name):
+        with open(file_name, 'wb') as f:
+            pickle.dump(self, f, protocol=pickle.HIGHEST_PROTOCOL)
+        print(f"nearest amenity index with {len(self.trees)} amenity types saved to {file_name}")
+
+    @staticmethod
+    def load(file_name):
+        with open(file_name, 'rb') as f:
+            return pickle.load(f)
+
+def isochrone_url(query):
+    #create GET request to https://api.mapbox.com/isochrone/v1/mapbox/{profile}/{lon}%2C{lat}?contours_minutes={range}&polygons={polygons}&access_token={access_token}
+    polygons = query['polygons']
+    polygons = 'true' if polygons else 'false'
+    # range can be a list of minutes to get several contours with one request
+    contours = query['range']
+    if isinstance(contours, (list, tuple)):
+        contours = ",".join(str(c) for c in contours)
+    return f"{mapbox_url}/isochrone/v1/mapbox/{query['profile']}/{query['lon']}%2C{query['lat']}?contours_minutes={contours}&polygons={polygons}&access_token={mapbox_token}"
+
 def get_isochrone_by_query(query=None, retries=1, retry_delay=1, current_try=0):
     if query is None:
         return None
@@ -77,27 +289,136 @@ def get_isochrone_by_query(query=None, retries=1, retry_delay=1, current_try=0):
     #ors = client.Client(base_url='localhost:8080/ors')
     # Get isochrones for the given query
     #isochrones = ors.isochrones(**query)
-    geoJSON = None
-    #create GET request to https://api.mapbox.com/isochrone/v1/mapbox/{profile}/{lon}%2C{lat}?contours_minutes={range}&polygons={polygons}&access_token={access_token}
-    polygons = query['polygons']
-    polygons = 'true' if polygons else 'false'
-    request = f"https://api.mapbox.com/isochrone/v1/mapbox/{query['profile']}/{query['lon']}%2C{query['lat']}?contours_minutes={query['range']}&polygons={polygons}&access_token={mapbox_token}"
-    
-    response = requests.get(request, timeout=15)
+    request = isochrone_url(query)
+    with metrics.timer("api_request_seconds", provider="mapbox"):
+        response = requests.get(request, timeout=15)
+    metrics.count("api_requests_total", provider="mapbox", result=str(response.status_code))
+    metrics.count("api_bytes_received_total", len(response.content), provider="mapbox")
     geoJSON = None
     if response.status_code == 200:
         geoJSON = response.json()
     else:
-        if current_try < retries:
-            print(f"Retrying in {retry_delay} seconds...")
-            time.sleep(retry_delay)
+        from fetch_engine import retry_status_codes
+        # only rate limits and server errors are retried, other errors (401, 404, 422) stay the same
+        if response.status_code in retry_status_codes and current_try < retries:
+            # exponential backoff, the delay doubles on every retry
+            delay = retry_delay * 2 ** current_try
+            print(f"Retrying in {delay} seconds...")
+            metrics.count("api_retries_total", provider="mapbox")
+            time.sleep(delay)
             geoJSON = get_isochrone_by_query(query, retries=retries, retry_delay=retry_delay, current_try=current_try+1)
         else:
             print(f"Error: {response.status_code} - {response.text}")
             return None
     return geoJSON
 
-def get_isochrone_by_walking_distance(lat, lon, distance=10, retries=5, retry_delay=2, current_try=0):
+def split_isochrone_contours(geoJSON):
+    """
+    Split a multi contour isochrone into one FeatureCollection per contour.
+
+    :param geoJSON: Isochrone GeoJSON with one feature per contour
+    :return: Dict of minutes -> GeoJSON with the same shape as a single contour request
+    """
+    contours = {}
+    for feature in geoJSON.get('features', []):
+        minutes = feature['properties']['contour']
+        contours[minutes] = {'features': [feature], 'type': 'FeatureCollection'}
+    return contours
+
+def lookup_cached_isochrones(lat, lon, profile, distances):
+    # split the distances into cached isochrones and the ones still missing
+    cache = get_isochrone_cache()
+    isochrones = {}
+    missing = []
+    for distance in distances:
+        isochrone = cache.get(isochrone_cache_key(profile, distance, lat, lon)) if cache is not None else None
+        if isochrone is None:
+            missing.append(distance)
+        else:
+            isochrones[distance] = isochrone
+        metrics.count("cache_lookups_total", cache="isochrone", result="miss" if isochrone is None else "hit")
+    return isochrones, missing
+
+def store_isochrones(isochrones, lat, lon, profile, distances, geoJSON):
+    # split a multi contour response into isochrones and cache them
+    cache = get_isochrone_cache()
+    contours = split_isochrone_contours(geoJSON) if geoJSON else {}
+    for distance in distances:
+        isochrone = contours.get(distance)
+        isochrones[distance] = isochrone
+        # failed requests are not cached, they are retried on the next run
+        if isochrone is not None and cache is not None:
+            cache.set(isochrone_cache_key(profile, distance, lat, lon), isochrone)
+
+def get_isochrones(lat, lon, profile, distances, retries=5, retry_delay=2):
+    """
+    Get isochrones for several distances of one profile, using the cache first and
+    requesting all missing contours with as few calls as possible.
+
+    :param lat: Latitude of the point
+    :param lon: Longitude of the point
+    :param profile: 'walking', 'driving' or 'cycling'
+    :param distances: List of distances in minutes
+    :return: Dict of minutes -> isochrone GeoJSON, None for contours that failed
+    """
+    isochrones, missing = lookup_cached_isochrones(lat, lon, profile, distances)
+    if isochrone_backend == "local":
+        if missing:
+            get_local_isochrones(isochrones, lat, lon, profile, missing)
+        return isochrones
+    # mapbox only accepts contours_minutes in increasing order
+    missing = sorted(missing)
+    for start in range(0, len(missing), max_contours_per_request):
+        chunk = missing[start:start + max_contours_per_request]
+        query = {
+            'lon': lon,
+            'lat': lat,
+            'range': chunk,
+            'polygons': True,
+            'profile': profile,
+        }
+        # pause to respect api limits, only if the last request was too recent
+        global last_request_time
+        wait = min_request_interval - (time.time() - last_request_time)
+        if wait > 0:
+            time.sleep(wait)
+        geoJSON = get_isochrone_by_query(query, retries, retry_delay)
+        last_request_time = time.time()
+        store_isochrones(isochrones, lat, lon, profile, chunk, geoJSON)
+    return isochrones
+
+async def get_isochrones_async(fetcher, lat, lon, profile, distances):
+    """
+    Async version of get_isochrones on top of a fetch_engine.AsyncFetcher,
+    rate limits and retries are handled by the fetcher.
+
+    :return: Dict of minutes -> isochrone GeoJSON, None for contours that failed
+    """
+    isochrones, missing = lookup_cached_isochrones(lat, lon, profile, distances)
+    if isochrone_backend == "local":
+        if missing:
+            get_local_isochrones(isochrones, lat, lon, profile, missing)
+        return isochrones
+    # mapbox only accepts contours_minutes in increasing order
+    missing = sorted(missing)
+    for start in range(0, len(missing), max_contours_per_request):
+        chunk = missing[start:start + max_contours_per_request]
+        query = {
+            'lon': lon,
+            'lat': lat,
+            'range': chunk,
+            'polygons': True,
+            'profile': profile,
+        }
+        try:
+            geoJSON = await fetcher.get_json("mapbox", isochrone_url(query))
+        except Exception as e:
+            print(f"Error: {e}")
+            geoJSON = None
+        store_isochrones(isochrones, lat, lon, profile, chunk, geoJSON)
+    return isochrones
+
+def get_isochrone_by_walking_distance(lat, lon, distance=10, retries=5, retry_delay=2):
     """
     Get isochrone for a given lat/lon and walking distance.
 
@@ -106,17 +427,9 @@ def get_isochrone_by_walking_distance(lat, lon, distance=10, retries=5, retry_de
     :param distance: Walking distance in minutes
     :return: Isochrone GeoJSON object
     """
-    profile='walking'
-    query = {
-        'lon': lon,
-        'lat': lat,
-        'range': distance,
-        'polygons': True,
-        'profile': profile,
-    }
-    return get_isochrone_by_query(query, retries, retry_delay, current_try)
+    return get_isochrones(lat, lon, 'walking', [distance], retries, retry_delay)[distance]
 
-def get_isochrone_by_driving_distance(lat, lon, distance=10, retries=5, retry_delay=2, current_try=0):
+def get_isochrone_by_driving_distance(lat, lon, distance=10, retries=5, retry_delay=2):
     """
     Get isochrone for a given lat/lon and driving distance.
 
@@ -125,13 +438,5 @@ def get_isochrone_by_driving_distance(lat, lon, distance=10, retries=5, retry_de
     :param distance: Driving distance in minutes
     :return: Isochrone GeoJSON object
     """
-    profile='driving'
-    query = {
-        'lon': lon,
-        'lat': lat,
-        'range': distance,
-        'polygons': True,
-        'profile': profile,
-    }
-    return get_isochrone_by_query(query, retries, retry_delay, current_try)
+    return get_isochrones(lat, lon, 'driving', [distance], retries, retry_delay)[distance]
     
\ No newline at end of file
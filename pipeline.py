@@ -0,0 +1,332 @@
+# Incremental pipeline runner: scraper -> geocoder -> amenities -> features
+# the stages form a DAG and independent stages run in parallel threads. Every
+# per property stage fingerprints the inputs of each property (address,
+# coordinates, scenario parameters, amenity whitelist) and only recomputes the
+# properties whose fingerprint changed since the last run. The fingerprints are
+# kept in pipeline_state.json, only for the properties the stage succeeded on so
+# that failed geocodes and amenity fetches are retried by the next run
+import hashlib
+import json
+import os
+import threading
+from concurrent.futures import ThreadPoolExecutor, FIRST_COMPLETED, wait
+import helpers
+import metrics
+
+default_config = {
+    "listings_file": "rental_properties.json",
+    "geocoded_file": "rental_properties_geocoded.json",
+    # scraping loads the live result pages, so it is off unless asked for
+    "scrape": False,
+    "max_pages": 51,
+    "scrape_workers": 4,
+    "radiuses": [500, 1000, 1500],
+    "distances_in_minutes": [3, 7, 10],
+    "transport_types": ["driving", "walking", "radius"],
+    "allowed_amenities": None,  # None uses amenities.allowed_amenities
+    "index_file": None,
+    "batch_tile_size": 20000,
+    "snap_tolerance": None,
+    # processes for the cpu bound parts of the amenities and features stages
+    "workers": 1,
+    "wide_features_file": "rental_features_all_scenarios.csv",
+    "nearest_features_file": "rental_features_nearest_amenities.csv",
+    "nearest_index_file": "nearest_amenity_index.pkl",
+    # directory of the parquet tables of columnar_store.py, None skips the stage
+    "store_dir": None,
+    # directory the arrays of amenity_store.py are saved to by the features stage, None keeps them in memory only
+    "amenity_store_dir": None,
+}
+
+def fingerprint(*parts):
+    # stable hash of json serializable inputs
+    data = json.dumps(parts, sort_keys=True, ensure_ascii=False, default=str)
+    return hashlib.sha1(data.encode("utf-8")).hexdigest()
+
+class Stage:
+    """
+    One step of the pipeline.
+
+    :param name: Unique stage name
+    :param run: Function called with the Pipeline, does the work of the stage
+    :param deps: Names of the stages that have to finish first
+    """
+
+    def __init__(self, name, run, deps=()):
+        self.name = name
+        self.run = run
+        self.deps = list(deps)
+
+class Pipeline:
+    """
+    DAG of stages with a persistent state of the property fingerprints.
+
+    :param config: Settings, see default_config
+    :param state_file: Json file the fingerprints of the last run are kept in
+    """
+
+    def __init__(self, config=None, state_file="pipeline_state.json"):
+        self.config = dict(default_config)
+        if config:
+            self.config.update(config)
+        if self.config["allowed_amenities"] is None:
+            from amenities import allowed_amenities
+            self.config["allowed_amenities"] = allowed_amenities
+        self.state_file = state_file
+        self.state = {}
+        if os.path.exists(state_file):
+            with open(state_file, "r", encoding="utf-8") as f:
+                self.state = json.load(f)
+        self.lock = threading.Lock()
+        self.stages = {}
+
+    def add(self, stage):
+        self.stages[stage.name] = stage
+        return stage
+
+    def get_state(self, name):
+        with self.lock:
+            return self.state.get(name, {})
+
+    def set_state(self, name, value):
+        # written after every stage, so a failed run keeps what is done
+        with self.lock:
+            self.state[name] = value
+            tmp_file = self.state_file + ".tmp"
+            with open(tmp_file, "w", encoding="utf-8") as f:
+                json.dump(self.state, f)
+            os.replace(tmp_file, self.state_file)
+
+    def run(self, workers=4):
+        """
+        Run all stages, each one as soon as its dependencies are done.
+
+        :param workers: Maximum number of stages running at the same time
+        """
+        for stage in self.stages.values():
+            # dependencies that are not part of this pipeline count as done
+            stage.deps = [d for d in stage.deps if d in self.stages]
+        done = set()
+        running = {}
+        with ThreadPoolExecutor(max_workers=workers) as pool:
+            while len(done) < len(self.stages):
+                for stage in self.stages.values():
+                    if stage.name not in done and stage.name not in running and all(d in done for d in stage.deps):
+                        print(f"stage {stage.name} started")
+                        running[stage.name] = pool.submit(metrics.timed("stage_seconds", stage=stage.name)(stage.run), self)
+                if not running:
+                    raise ValueError(f"stages {sorted(set(self.stages) - done)} have unresolved dependencies")
+                finished, _ = wait(running.values(), return_when=FIRST_COMPLETED)
+                for name, future in list(running.items()):
+                    if future in finished:
+                        # re-raise errors of the stage
+                        future.result()
+                        print(f"stage {name} done")
+                        done.add(name)
+                        del running[name]
+
+def get_scenarios(config):
+    from amenities import get_scenarios as amenity_scenarios
+    return amenity_scenarios(config["radiuses"], config["distances_in_minutes"], config["transport_types"])
+
+def read_by_id(file_name):
+    # property_id -> property of an earlier output, empty if there is none
+    if not os.path.exists(file_name):
+        return {}
+    return {prop.get("property_id"): prop for prop in helpers.iter_json_clean(file_name)}
+
+def remove_files(*file_names):
+    for file_name in file_names:
+        if os.path.exists(file_name):
+            os.remove(file_name)
+
+def run_scrape(pipeline):
+    import web_scraper
+    config = pipeline.config
+    # new listings are appended, property ids already in the file are skipped
+    web_scraper.scrape_pages(range(1, config["max_pages"]), config["listings_file"], workers=config["scrape_workers"])
+
+def run_geocode(pipeline):
+    import geo_code_loader
+    config = pipeline.config
+    props = helpers.read_json_clean(config["listings_file"])
+    previous = read_by_id(config["geocoded_file"])
+    known = pipeline.get_state("geocode").get("properties", {})
+    fingerprints = {str(prop["property_id"]): fingerprint(geo_code_loader.normalize_address(prop.get("address"))) for prop in props}
+    # properties without coordinates are geocoded again, the error can have been temporary
+    todo = [prop for prop in props
+            if known.get(str(prop["property_id"])) != fingerprints[str(prop["property_id"])] or prop["property_id"] not in previous
+            or previous[prop["property_id"]].get("lat") is None]
+    print(f"geocode: {len(todo)} of {len(props)} properties changed")
+    fresh = {}
+    if todo:
+        from geopy.geocoders import Nominatim
+        from disk_cache import DiskCache
+        cache = DiskCache(geo_code_loader.geocode_cache_file) if geo_code_loader.geocode_cache_file else None
+        geolocator = Nominatim(user_agent="rental_geocoder")
+        centroids = geo_code_loader.load_postcode_centroids()
+        for prop in geo_code_loader.geocode_properties([dict(p) for p in todo], geolocator, cache=cache, centroids=centroids):
+            fresh[prop["property_id"]] = prop
+        if cache is not None:
+            cache.close()
+    if todo or len(previous) != len(props):
+        rows = []
+        for prop in props:
+            if prop["property_id"] in fresh:
+                rows.append(fresh[prop["property_id"]])
+            else:
+                # the listing can have changed (price, ...), only the coordinates are reused
+                row = dict(prop)
+                row["lat"] = previous[prop["property_id"]].get("lat")
+                row["lon"] = previous[prop["property_id"]].get("lon")
+                rows.append(row)
+        helpers.write_json_stream(config["geocoded_file"], rows)
+    # only properties with coordinates are recorded as done
+    located = {str(prop["property_id"]) for prop in props
+               if fresh.get(prop["property_id"], previous.get(prop["property_id"], {})).get("lat") is not None}
+    pipeline.set_state("geocode", {"properties": {pid: fp for pid, fp in fingerprints.items() if pid in located}})
+
+def amenity_fingerprint(prop, scenario, allowed_amenities):
+    return fingerprint(prop.get("lat"), prop.get("lon"), scenario["transport_type"], scenario["radius"],
+                       scenario["distance_in_minutes"], sorted(allowed_amenities))
+
+def amenities_fetched(prop):
+    # same rule as helpers.load_resume_index: a failed fetch leaves an empty amenity
+    # list and is fetched again, properties without coordinates have nothing to fetch
+    return bool(prop.get("amenities")) or prop.get("lat") is None or prop.get("lon") is None
+
+def run_amenities(pipeline):
+    import amenities
+    config = pipeline.config
+    allowed = config["allowed_amenities"]
+    props = helpers.read_json_clean(config["geocoded_file"])
+    known = pipeline.get_state("amenities").get("properties", {})
+    scenarios = get_scenarios(config)
+    fingerprints = {}
+    previous = {}
+    changed = {}
+    for scenario in scenarios:
+        name = helpers.scenario_name(scenario)
+        previous[name] = read_by_id(scenario["output_file"])
+        fingerprints[name] = {str(prop["property_id"]): amenity_fingerprint(prop, scenario, allowed) for prop in props}
+        changed[name] = {prop["property_id"] for prop in props
+                         if known.get(name, {}).get(str(prop["property_id"])) != fingerprints[name][str(prop["property_id"])]
+                         or prop["property_id"] not in previous[name]
+                         or not amenities_fetched(previous[name][prop["property_id"]])}
+        print(f"amenities {name}: {len(changed[name])} of {len(props)} properties changed")
+
+    # property ids per scenario whose amenities are fetched, only their fingerprints are recorded
+    fetched = {name: {str(pid) for pid, prop in previous[name].items() if amenities_fetched(prop)} for name in previous}
+    todo_ids = set().union(*changed.values())
+    if todo_ids:
+        # run the sweep over the changed properties only, into pending files next to the outputs
+        pending_input = config["geocoded_file"] + ".pending"
+        helpers.write_json_stream(pending_input, [prop for prop in props if prop["property_id"] in todo_ids])
+        pending = []
+        for scenario in scenarios:
+            name = helpers.scenario_name(scenario)
+            if not changed[name]:
+                continue
+            pending_scenario = dict(scenario, output_file=scenario["output_file"] + ".pending")
+            if not os.path.exists(pending_scenario["output_file"]):
+                # results that are still valid are resumed by the sweep instead of fetched again
+                valid = [previous[name][pid] for pid in todo_ids - changed[name] if pid in previous[name]]
+                helpers.write_json_stream(pending_scenario["output_file"], valid)
+            pending.append((scenario, pending_scenario))
+        amenities.add_amenities_sweep(pending_input, [p for _, p in pending], allowed_amenities=allowed,
+                                      index_file=config["index_file"], batch_tile_size=config["batch_tile_size"],
+                                      snap_tolerance=config["snap_tolerance"], n_workers=config["workers"])
+        for scenario, pending_scenario in pending:
+            name = helpers.scenario_name(scenario)
+            fresh = read_by_id(pending_scenario["output_file"])
+            rows = []
+            for prop in props:
+                row = dict(prop)
+                # unchanged properties keep their amenities and isochrone, with the current listing fields
+                amenities.resume_property(row, fresh if prop["property_id"] in todo_ids else previous[name])
+                row.setdefault("amenities", [])
+                rows.append(row)
+            fetched[name] = {str(row["property_id"]) for row in rows if amenities_fetched(row)}
+            helpers.write_json_stream(scenario["output_file"], rows)
+            remove_files(pending_scenario["output_file"], helpers.journal_file_name(pending_scenario["output_file"]))
+        remove_files(pending_input)
+    pipeline.set_state("amenities", {"properties": {name: {pid: fp for pid, fp in fingerprints[name].items() if pid in fetched[name]}
+                                                    for name in fingerprints}})
+
+def amenities_changed(pipeline, stage_name, outputs):
+    # stage fingerprint over all amenity fingerprints, the stage is skipped if
+    # it is unchanged and all its outputs exist
+    stage_fingerprint = fingerprint(pipeline.get_state("amenities").get("properties", {}), pipeline.config["allowed_amenities"])
+    if pipeline.get_state(stage_name).get("fingerprint") == stage_fingerprint and all(os.path.exists(f) for f in outputs):
+        print(f"{stage_name}: no amenities changed")
+        return None
+    return stage_fingerprint
+
+def run_features(pipeline):
+    import amenity_store
+    import feature_engineering
+    config = pipeline.config
+    inputs = [s["output_file"] for s in get_scenarios(config) if os.path.exists(s["output_file"])]
+    outputs = [f.replace("rental_properties_with_", "rental_features_").replace(".json", ".csv") for f in inputs]
+    stage_fingerprint = amenities_changed(pipeline, "features", outputs + [config["wide_features_file"]])
+    if stage_fingerprint is None:
+        return
+    # the feature matrix is vectorized, rebuilding it is cheaper than patching rows.
+    # the scenario files are read once into the array store, every amenity is held once
+    store = amenity_store.AmenityStore.from_scenario_files(inputs)
+    for input_file, output_csv in zip(inputs, outputs):
+        feature_engineering.create_feature_frame_from_amenity_store(store, helpers.scenario_from_file(input_file)).to_csv(output_csv, index=False)
+        print("dataframe saved to", output_csv)
+    wide = feature_engineering.create_wide_feature_matrix(inputs, store=store)
+    wide.to_csv(config["wide_features_file"], index=False)
+    if config["amenity_store_dir"]:
+        store.save(config["amenity_store_dir"])
+    pipeline.set_state("features", {"fingerprint": stage_fingerprint})
+
+def run_nearest_features(pipeline):
+    import pandas as pd
+    import feature_engineering
+    config = pipeline.config
+    inputs = [s["output_file"] for s in get_scenarios(config) if os.path.exists(s["output_file"])]
+    stage_fingerprint = amenities_changed(pipeline, "nearest_features", [config["nearest_features_file"]])
+    if stage_fingerprint is None:
+        return
+    # the saved index holds the amenities of the last run, build it again
+    remove_files(config["nearest_index_file"])
+    index = feature_engineering.load_or_build_nearest_index(config["nearest_index_file"], input_files=inputs)
+    props = pd.DataFrame(helpers.read_json_clean(config["geocoded_file"]))
+    nearest = feature_engineering.create_nearest_feature_frame(props, index, k=5, n_jobs=os.cpu_count())
+    nearest.to_csv(config["nearest_features_file"], index=False)
+    pipeline.set_state("nearest_features", {"fingerprint": stage_fingerprint})
+
+def run_columnar_store(pipeline):
+    import columnar_store
+    config = pipeline.config
+    inputs = [s["output_file"] for s in get_scenarios(config) if os.path.exists(s["output_file"])]
+    stage_fingerprint = amenities_changed(pipeline, "columnar_store", [os.path.join(config["store_dir"], "properties.parquet")])
+    if stage_fingerprint is None:
+        return
+    columnar_store.write_columnar_store(inputs, config["store_dir"])
+    pipeline.set_state("columnar_store", {"fingerprint": stage_fingerprint})
+
+def build_pipeline(config=None, state_file="pipeline_state.json"):
+    pipeline = Pipeline(config, state_file)
+    if pipeline.config["scrape"]:
+        pipeline.add(Stage("scrape", run_scrape))
+    pipeline.add(Stage("geocode", run_geocode, deps=["scrape"]))
+    pipeline.add(Stage("amenities", run_amenities, deps=["geocode"]))
+    # the feature stages only read the amenity outputs and run side by side
+    pipeline.add(Stage("features", run_features, deps=["amenities"]))
+    pipeline.add(Stage("nearest_features", run_nearest_features, deps=["amenities"]))
+    if pipeline.config["store_dir"]:
+        pipeline.add(Stage("columnar_store", run_columnar_store, deps=["amenities"]))
+    return pipeline
+
+def main():
+    pipeline = build_pipeline()
+    pipeline.run()
+    metrics.write_summary()
+    print("all done!")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,372 @@
+# Offline replay benchmark of the whole pipeline
+# a local http server stands in for overpass, mapbox and nominatim and replays
+# the responses recorded in the committed rental_properties_with_*_amenities.json
+# and rental_properties_geocoded.json files, with configurable latency and rate
+# limits. The stages run end to end against it and the timings are saved as json
+# usage: python replay_benchmark.py [output.json] [baseline.json]
+import asyncio
+import contextlib
+import io
+import json
+import os
+import platform
+import re
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import tracemalloc
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from urllib.parse import parse_qs, unquote, urlparse
+import numpy as np
+import shapely
+import helpers
+import amenity_index
+import metrics
+
+# scenarios the committed files have recorded responses for
+replay_scenarios = [
+    {"transport_type": "radius", "radius": 500},
+    {"transport_type": "walking", "radius": 500, "distance_in_minutes": 3},
+    {"transport_type": "walking", "radius": 500, "distance_in_minutes": 7},
+    {"transport_type": "driving", "radius": 500, "distance_in_minutes": 3},
+]
+
+
+class ReplayData:
+    """
+    Api responses recorded in the committed data files.
+
+    :param data_dir: Directory with the committed json files
+    """
+
+    def __init__(self, data_dir="."):
+        amenities = []
+        self.isochrones = {}
+        for file_name in helpers.list_scenario_files(data_dir):
+            profile, number = helpers.scenario_from_file(file_name).rsplit("_", 1)
+            for prop in helpers.iter_json_clean(os.path.join(data_dir, file_name)):
+                amenities.extend({k: a[k] for k in ("id", "name", "amenity", "lat", "lon")} for a in prop.get("amenities", []))
+                if prop.get("isochrone"):
+                    key = self.isochrone_key(profile, int(number), prop["lat"], prop["lon"])
+                    self.isochrones[key] = prop["isochrone"]["features"][0]
+        self.index = amenity_index.AmenityIndex(amenities)
+        self.lats = np.array([a["lat"] for a in self.index.amenities], dtype=float)
+        self.lons = np.array([a["lon"] for a in self.index.amenities], dtype=float)
+        self.geocodes = {}
+        for prop in helpers.iter_json_clean(os.path.join(data_dir, "rental_properties_geocoded.json")):
+            self.geocodes[prop["address"]] = (prop.get("lat"), prop.get("lon"))
+
+    @staticmethod
+    def isochrone_key(profile, minutes, lat, lon):
+        return (profile, int(minutes), round(float(lat), 6), round(float(lon), 6))
+
+    def overpass(self, query):
+        # union of all around(), poly: and bbox clauses of the query, filtered like the amenity filter
+        allowed = re.search(r'\["amenity"~"\^\(([^)]*)\)\$"\]', query)
+        allowed = allowed.group(1).split("|") if allowed else None
+        nodes = {}
+        for radius, lat, lon in re.findall(r"around:([\d.]+),([\d.-]+),([\d.-]+)", query):
+            for a in self.index.query_radius(float(lat), float(lon), float(radius), allowed_amenities=allowed):
+                nodes[a["id"]] = a
+        areas = [shapely.Polygon(np.array(poly.split(), dtype=float).reshape(-1, 2)[:, ::-1])
+                 for poly in re.findall(r'poly:"([^"]*)"', query)]
+        areas += [shapely.box(float(w), float(s), float(e), float(n))
+                  for s, w, n, e in re.findall(r"node\(([\d.-]+),([\d.-]+),([\d.-]+),([\d.-]+)\)", query)]
+        for area in areas:
+            west, south, east, north = area.bounds
+            candidates = np.flatnonzero((self.lats >= south) & (self.lats <= north) & (self.lons >= west) & (self.lons <= east))
+            inside = candidates[shapely.intersects_xy(area, self.lons[candidates], self.lats[candidates])]
+            if allowed:
+                inside = inside[np.isin(self.index.types[inside], allowed)]
+            for i in inside:
+                nodes[self.index.amenities[i]["id"]] = self.index.amenities[i]
+        found = sorted(nodes.values(), key=lambda a: a["id"])
+        if "[out:csv(" in query:
+            return "".join(f"{a['id']}\t{a['lat']}\t{a['lon']}\t{a['name']}\t{a['amenity']}\n" for a in found)
+        elements = [{"type": "node", "id": a["id"], "lat": a["lat"], "lon": a["lon"],
+                     "tags": {"name": a["name"], "amenity": a["amenity"]}} for a in found]
+        return {"version": 0.6, "generator": "replay", "elements": elements}
+
+    def isochrone(self, profile, lon, lat, minutes):
+        features = [self.isochrones[key] for key in (self.isochrone_key(profile, m, lat, lon) for m in minutes) if key in self.isochrones]
+        return {"features": features, "type": "FeatureCollection"}
+
+    def geocode(self, query):
+        address = re.sub(r", switzerland$", "", query)
+        lat, lon = self.geocodes.get(address, (None, None))
+        if lat is None:
+            return []
+        return [{"place_id": 1, "lat": str(lat), "lon": str(lon), "display_name": address}]
+
+
+class RateLimit:
+    # requests per second with a burst of one second, like fetch_engine.TokenBucket but blocking free
+    def __init__(self, rate):
+        self.rate = rate
+        self.tokens = rate
+        self.updated = time.monotonic()
+        self.lock = threading.Lock()
+
+    def allow(self):
+        with self.lock:
+            now = time.monotonic()
+            self.tokens = min(self.rate, self.tokens + (now - self.updated) * self.rate)
+            self.updated = now
+            if self.tokens >= 1:
+                self.tokens -= 1
+                return True
+            return False
+
+
+class ReplayServer:
+    """
+    Local http server that answers overpass, mapbox isochrone and nominatim requests.
+
+    :param data: ReplayData
+    :param latency: Seconds every response is delayed
+    :param rate_limits: Optional dict of provider -> requests per second, requests
+                        over the limit are answered with 429 and a retry-after header
+    """
+
+    def __init__(self, data, latency=0.0, rate_limits=None):
+        self.data = data
+        self.latency = latency
+        self.limits = {name: RateLimit(rate) for name, rate in (rate_limits or {}).items()}
+        self.stats = {}
+        self.stats_lock = threading.Lock()
+        self.server = ThreadingHTTPServer(("127.0.0.1", 0), self.handler())
+        self.server.daemon_threads = True
+        self.thread = None
+
+    @property
+    def url(self):
+        return f"http://127.0.0.1:{self.server.server_port}"
+
+    def count(self, provider, key, value=1):
+        with self.stats_lock:
+            self.stats.setdefault(provider, {"requests": 0, "rate_limited": 0, "bytes": 0})[key] += value
+
+    def handler(self):
+        replay = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def log_message(self, *args):
+                pass
+
+            def reply(self, provider, make_body):
+                replay.count(provider, "requests")
+                if replay.latency:
+                    time.sleep(replay.latency)
+                limit = replay.limits.get(provider)
+                if limit is not None and not limit.allow():
+                    replay.count(provider, "rate_limited")
+                    self.send_response(429)
+                    self.send_header("Retry-After", "1")
+                    self.send_header("Content-Length", "0")
+                    self.end_headers()
+                    return
+                body = make_body()
+                # overpass csv output is plain text, everything else json
+                content_type = "text/csv" if isinstance(body, str) else "application/json"
+                body = (body if isinstance(body, str) else json.dumps(body)).encode("utf-8")
+                replay.count(provider, "bytes", len(body))
+                self.send_response(200)
+                self.send_header("Content-Type", content_type)
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def do_GET(self):
+                url = urlparse(self.path)
+                params = parse_qs(url.query)
+                match = re.match(r"/isochrone/v1/mapbox/(\w+)/([\d.-]+)(?:%2C|,)([\d.-]+)", url.path)
+                if match:
+                    profile, lon, lat = match.group(1), float(match.group(2)), float(match.group(3))
+                    minutes = [int(m) for m in params["contours_minutes"][0].split(",")]
+                    self.reply("mapbox", lambda: replay.data.isochrone(profile, lon, lat, minutes))
+                elif url.path == "/search":
+                    self.reply("nominatim", lambda: replay.data.geocode(params["q"][0]))
+                elif url.path == "/api/interpreter":
+                    self.reply("overpass", lambda: replay.data.overpass(params["data"][0]))
+                else:
+                    self.send_error(404)
+
+            def do_POST(self):
+                body = self.rfile.read(int(self.headers.get("Content-Length", 0))).decode("utf-8")
+                # overpy posts the raw query, httpx posts a data= form
+                query = parse_qs(body)["data"][0] if body.startswith("data=") else unquote(body)
+                self.reply("overpass", lambda: replay.data.overpass(query))
+
+        return Handler
+
+    def start(self):
+        self.thread = threading.Thread(target=self.server.serve_forever, daemon=True)
+        self.thread.start()
+        return self
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *exc_info):
+        self.stop()
+
+
+def git_commit():
+    try:
+        return subprocess.run(["git", "rev-parse", "--short", "HEAD"], capture_output=True, text=True, check=True).stdout.strip()
+    except Exception:
+        return None
+
+
+def run_stage(results, name, n_properties, server, func, *args, verbose=False, **kwargs):
+    # time one stage and record its throughput, peak memory and api requests
+    before = json.loads(json.dumps(server.stats))
+    tracemalloc.reset_peak()
+    start = time.perf_counter()
+    output = io.StringIO()
+    with contextlib.redirect_stdout(sys.stdout if verbose else output):
+        result = func(*args, **kwargs)
+    seconds = time.perf_counter() - start
+    _, peak = tracemalloc.get_traced_memory()
+    requests = {provider: {key: value - before.get(provider, {}).get(key, 0) for key, value in counts.items()}
+                for provider, counts in server.stats.items()}
+    results[name] = {
+        "seconds": round(seconds, 4),
+        "properties": n_properties,
+        "properties_per_second": round(n_properties / seconds, 2) if seconds else None,
+        "peak_memory_mb": round(peak / 2 ** 20, 2),
+        "requests": {p: c for p, c in requests.items() if c["requests"]},
+    }
+    print(f"{name:24s} {seconds:8.3f} s {results[name]['properties_per_second']:10.1f} properties/s "
+          f"{results[name]['peak_memory_mb']:8.1f} MB peak")
+    return result
+
+
+def run_replay_benchmark(data_dir=".", n_properties=None, latency=0.0, rate_limits=None, concurrency=None, client_rate_limits=None,
+                         output_file="benchmark_results.json", baseline_file=None, verbose=False):
+    """
+    Run the geocoder, the amenity stage of every recorded scenario and the feature
+    engineering end to end against the replay server.
+
+    :param n_properties: Only use the first n listings, None for all
+    :param latency: Seconds every stub response is delayed
+    :param rate_limits: Optional dict of provider -> requests per second of the stubs
+    :param concurrency: Run the amenity stages with the async engine and this concurrency
+    :param client_rate_limits: Rate limits of the async engine, dict of provider ->
+                               (requests per second, burst size), its defaults are the real api limits
+    :param output_file: Json file the results are saved to
+    :param baseline_file: Optional earlier results to compare against
+    :return: Results dict
+    """
+    import amenities
+    import nn_isochrones
+    import geo_code_loader
+    import feature_engineering
+    from geopy.geocoders import Nominatim
+
+    data = ReplayData(data_dir)
+    listings = helpers.read_json_clean(os.path.join(data_dir, "rental_properties.json"))[:n_properties]
+    settings = {
+        (amenities, "overpass_url"): None,
+        (amenities, "request_pause"): 0,
+        (nn_isochrones, "mapbox_url"): None,
+        (nn_isochrones, "mapbox_token"): "replay",
+        (nn_isochrones, "min_request_interval"): 0,
+        (geo_code_loader, "min_request_interval"): 0,
+    }
+    saved = {key: getattr(*key) for key in settings}
+    saved_cache = (nn_isochrones.isochrone_cache_file, nn_isochrones.isochrone_cache_max_bytes, nn_isochrones.isochrone_cache_precision)
+    results = {}
+    # the api latencies, retries and cache hits of the run go into the report too
+    metrics_enabled = metrics.enabled
+    metrics.enable()
+    metrics.reset()
+    tracemalloc.start()
+    with ReplayServer(data, latency=latency, rate_limits=rate_limits) as server, tempfile.TemporaryDirectory() as tmp:
+        settings[(amenities, "overpass_url")] = server.url + "/api/interpreter"
+        settings[(nn_isochrones, "mapbox_url")] = server.url
+        try:
+            for (module, name), value in settings.items():
+                setattr(module, name, value)
+            # every isochrone has to go through the stub, not the cache of an earlier run
+            nn_isochrones.configure_isochrone_cache(None)
+            start = time.perf_counter()
+
+            geolocator = Nominatim(user_agent="rental_geocoder", domain=server.url.split("//")[1], scheme="http")
+            geocoded_file = os.path.join(tmp, "rental_properties_geocoded.json")
+            run_stage(results, "geocode", len(listings), server, helpers.write_json_stream, geocoded_file,
+                      geo_code_loader.geocode_properties([dict(p) for p in listings], geolocator), verbose=verbose)
+
+            output_files = []
+            for scenario in replay_scenarios:
+                name = helpers.scenario_name(scenario)
+                output_file_scenario = os.path.join(tmp, helpers.scenario_file(name))
+                kwargs = dict(radius=scenario["radius"], allowed_amenities=amenities.allowed_amenities)
+                if "distance_in_minutes" in scenario:
+                    kwargs["distance_in_minutes"] = scenario["distance_in_minutes"]
+                if concurrency:
+                    stage = lambda *args, **kw: asyncio.run(amenities.add_amenities_to_properties_async(
+                        *args, concurrency=concurrency, rate_limits=client_rate_limits, **kw))
+                else:
+                    stage = amenities.add_amenities_to_properties
+                run_stage(results, f"amenities_{name}", len(listings), server, stage, geocoded_file, output_file_scenario,
+                          scenario["transport_type"], verbose=verbose, **kwargs)
+                output_files.append(output_file_scenario)
+
+            run_stage(results, "features", len(listings) * len(output_files), server,
+                      lambda: [feature_engineering.create_feature_frame(helpers.iter_json_clean(f)) for f in output_files]
+                      + [feature_engineering.create_wide_feature_matrix(output_files)], verbose=verbose)
+            total = time.perf_counter() - start
+        finally:
+            for (module, name), value in saved.items():
+                setattr(module, name, value)
+            nn_isochrones.configure_isochrone_cache(*saved_cache)
+            metrics.enabled = metrics_enabled
+    tracemalloc.stop()
+
+    report = {
+        "timestamp": time.strftime("%Y-%m-%dT%H:%M:%S"),
+        "commit": git_commit(),
+        "python": platform.python_version(),
+        "config": {"properties": len(listings), "latency": latency, "rate_limits": rate_limits, "concurrency": concurrency,
+                   "client_rate_limits": client_rate_limits},
+        "total_seconds": round(total, 4),
+        "properties_per_second": round(len(listings) / total, 2),
+        "peak_memory_mb": max(stage["peak_memory_mb"] for stage in results.values()),
+        "stages": results,
+        "metrics": metrics.summary(),
+    }
+    print(f"{'total':24s} {total:8.3f} s {report['properties_per_second']:10.1f} properties/s")
+    if baseline_file and os.path.exists(baseline_file):
+        compare_results(helpers.json_loads(open(baseline_file, "r", encoding="utf-8").read()), report)
+    if output_file:
+        with open(output_file, "w", encoding="utf-8") as f:
+            json.dump(report, f, indent=2)
+        print(f"results saved to {output_file}")
+    return report
+
+
+def compare_results(baseline, report):
+    # time of every stage relative to the baseline, > 1 means slower
+    print(f"compared to {baseline.get('commit')} ({baseline.get('timestamp')}):")
+    for name, stage in report["stages"].items():
+        old = baseline.get("stages", {}).get(name)
+        if old and old["seconds"]:
+            print(f"  {name:22s} {stage['seconds'] / old['seconds']:6.2f}x time, "
+                  f"{stage['peak_memory_mb'] - old['peak_memory_mb']:+8.1f} MB peak")
+
+
+def main():
+    output_file = sys.argv[1] if len(sys.argv) > 1 else "benchmark_results.json"
+    baseline_file = sys.argv[2] if len(sys.argv) > 2 else None
+    run_replay_benchmark(output_file=output_file, baseline_file=baseline_file)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,320 @@
+# Scoring service for single listings
+# keeps the amenity index, the isochrones and the geocodes in memory and returns
+# the create_feature_dict features of all scenarios for an address or a lat/lon
+# within milliseconds, as a python api (ScoringService.score / score_batch) and
+# as a small local http endpoint:
+#   GET  /score?lat=47.56&lon=7.59     or  /score?address=Bläsiring 10, 4057 Basel
+#   POST /score                         json object or list of objects (lat/lon or address, optional rooms/area/...)
+#   GET  /health
+# usage: python scoring_service.py [port]      python scoring_service.py benchmark
+import json
+import os
+import random
+import sys
+import threading
+import time
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from urllib.parse import parse_qs, urlparse
+import numpy as np
+import helpers
+import amenities
+import amenity_index
+import feature_engineering
+import geo_code_loader
+import metrics
+import nn_isochrones
+from disk_cache import DiskCache
+
+default_scenario_files = [
+    "rental_properties_with_driving_3_amenities.json",
+    "rental_properties_with_driving_7_amenities.json",
+    "rental_properties_with_driving_10_amenities.json",
+    "rental_properties_with_radius_500_amenities.json",
+    "rental_properties_with_radius_1000_amenities.json",
+    "rental_properties_with_radius_1500_amenities.json",
+    "rental_properties_with_walking_3_amenities.json",
+    "rental_properties_with_walking_7_amenities.json",
+    "rental_properties_with_walking_10_amenities.json",
+]
+# fields of a request that are passed on to create_feature_dict
+listing_fields = ["address", "property_id", "rooms", "area"]
+
+
+class ScoringService:
+    """
+    Feature vectors of single listings from preloaded indexes, without network calls by default.
+
+    :param index_file: Pickled amenity_index.AmenityIndex, built from the amenities
+                       of the scenario files if it does not exist
+    :param scenario_files: Scenario json files, their amenities and recorded isochrones are preloaded
+    :param geocoded_file: Geocoded properties, their coordinates are preloaded as geocodes
+    :param radiuses: Search radiuses of the radius scenarios in meters
+    :param distances_in_minutes: Isochrone minutes of the walking / driving scenarios
+    :param transport_types: Transport types, like amenities.main
+    :param allow_network: Ask nominatim / mapbox for addresses and isochrones that are not preloaded
+    """
+
+    def __init__(self, index_file="amenity_index.pkl", scenario_files=default_scenario_files, geocoded_file="rental_properties_geocoded.json",
+                 radiuses=(500, 1000, 1500), distances_in_minutes=(3, 7, 10), transport_types=("driving", "walking", "radius"),
+                 allowed_amenities=None, allow_network=False):
+        start = time.perf_counter()
+        self.allowed_amenities = allowed_amenities or amenities.allowed_amenities
+        self.allow_network = allow_network
+        self.scenarios = amenities.get_scenarios(list(radiuses), list(distances_in_minutes), list(transport_types))
+        self.names = [helpers.scenario_name(s) for s in self.scenarios]
+        scenario_files = [f for f in scenario_files if os.path.exists(f)]
+
+        # amenity index, the scenario files only hold amenities near the known properties
+        if index_file and os.path.exists(index_file):
+            self.index = amenity_index.AmenityIndex.load(index_file)
+        else:
+            print(f"{index_file} not found, indexing the amenities of {len(scenario_files)} scenario files")
+            self.index = amenity_index.AmenityIndex(
+                {k: a[k] for k in ("id", "name", "amenity", "lat", "lon")}
+                for f in scenario_files for p in helpers.iter_json_clean(f) for a in p.get("amenities", []))
+
+        # isochrones: the persistent cache and the ones recorded in the scenario files
+        self.isochrones = {}
+        if nn_isochrones.isochrone_backend == "mapbox":
+            for f in scenario_files:
+                profile, minutes = helpers.scenario_from_file(f).rsplit("_", 1)
+                for p in helpers.iter_json_clean(f):
+                    if p.get("isochrone"):
+                        self.isochrones[nn_isochrones.isochrone_cache_key(profile, int(minutes), p["lat"], p["lon"])] = p["isochrone"]
+        else:
+            nn_isochrones.get_local_graph()
+        isochrone_cache = nn_isochrones.get_isochrone_cache()
+        if isochrone_cache is not None:
+            self.isochrones.update(isochrone_cache.items())
+
+        # geocodes: the geocoded properties, the persistent cache and the postcode centroids
+        self.geocodes = {}
+        if geocoded_file and os.path.exists(geocoded_file):
+            for p in helpers.iter_json_clean(geocoded_file):
+                if p.get("lat") is not None and p.get("lon") is not None:
+                    self.geocodes[geo_code_loader.normalize_address(p.get("address"))] = [p["lat"], p["lon"]]
+        self.geocode_cache = DiskCache(geo_code_loader.geocode_cache_file) if geo_code_loader.geocode_cache_file else None
+        if self.geocode_cache is not None:
+            self.geocodes.update((key, coords) for key, coords in self.geocode_cache.items() if coords)
+        self.centroids = geo_code_loader.load_postcode_centroids()
+        self.geolocator = None
+        self.lock = threading.Lock()
+        self.startup_seconds = time.perf_counter() - start
+        print(f"scoring service ready in {self.startup_seconds:.2f}s: {len(self.index)} amenities, "
+              f"{len(self.isochrones)} isochrones, {len(self.geocodes)} geocodes, {len(self.centroids)} postcodes")
+
+    def geocode(self, address):
+        """
+        Coordinates of an address from the preloaded geocodes, the postcode centroids
+        or, with allow_network, nominatim.
+
+        :return: ([lat, lon] or None, source)
+        """
+        key = geo_code_loader.normalize_address(address)
+        if key in self.geocodes:
+            return self.geocodes[key], "cache"
+        if self.allow_network:
+            try:
+                with self.lock:
+                    if self.geolocator is None:
+                        from geopy.geocoders import Nominatim
+                        self.geolocator = Nominatim(user_agent="rental_geocoder")
+                    location = geo_code_loader.geocode_address(address, self.geolocator)
+                coords = [location.latitude, location.longitude] if location else None
+                # only real answers are cached, errors fall through to the postcode
+                if self.geocode_cache is not None:
+                    self.geocode_cache.set(key, coords)
+            except geo_code_loader.GeocodingFailed:
+                coords = None
+            if coords:
+                self.geocodes[key] = coords
+                return coords, "nominatim"
+        coords = geo_code_loader.geocode_offline(address, self.centroids)
+        return (list(coords), "postcode") if coords else (None, None)
+
+    def isochrone(self, lat, lon, profile, minutes):
+        # preloaded isochrone, else the local backend or (with allow_network) mapbox, None if there is none
+        isochrone = self.isochrones.get(nn_isochrones.isochrone_cache_key(profile, minutes, lat, lon))
+        if isochrone is None and (nn_isochrones.isochrone_backend == "local" or self.allow_network):
+            isochrone = nn_isochrones.get_isochrones(lat, lon, profile, [minutes])[minutes]
+            if isochrone is not None:
+                self.isochrones[nn_isochrones.isochrone_cache_key(profile, minutes, lat, lon)] = isochrone
+        return isochrone
+
+    def score(self, request):
+        """
+        Features of one listing.
+
+        :param request: Dict with lat and lon or an address, optional property_id, rooms and area
+        :return: Dict with lat, lon, the geocode source, "features" of scenario -> create_feature_dict
+                 dict and "missing", the scenarios without an isochrone (their features are None)
+        """
+        with metrics.timer("scoring_seconds"):
+            lat, lon = request.get("lat"), request.get("lon")
+            source = "request"
+            if lat is None or lon is None:
+                coords, source = self.geocode(request.get("address", ""))
+                if coords is None:
+                    return {"address": request.get("address"), "lat": None, "lon": None, "geocoded": None,
+                            "features": {name: None for name in self.names}, "missing": list(self.names)}
+                lat, lon = coords
+            lat, lon = float(lat), float(lon)
+            # isochrones and search radius of every scenario, like the amenities sweep
+            available, isochrones, search_radiuses, missing = [], [], [], []
+            for scenario, name in zip(self.scenarios, self.names):
+                if scenario["transport_type"] in ("walking", "driving"):
+                    isochrone = self.isochrone(lat, lon, scenario["transport_type"], scenario["distance_in_minutes"])
+                    if isochrone is None:
+                        missing.append(name)
+                        continue
+                    coords = isochrone["features"][0]["geometry"]["coordinates"][0]
+                    search_radiuses.append(helpers.farthest_distance_from_center(lat, lon, coords))
+                else:
+                    isochrone = None
+                    search_radiuses.append(scenario["radius"])
+                available.append(scenario)
+                isochrones.append(isochrone)
+            # one index query at the largest extent, every scenario is a local filter of it
+            candidates = self.index.query_radius(lat, lon, radius=max(search_radiuses), allowed_amenities=self.allowed_amenities) if available else []
+            results = amenities.derive_scenario_amenities(lat, lon, candidates, available, isochrones, search_radiuses)
+            listing = {field: request[field] for field in listing_fields if field in request}
+            features = {name: None for name in self.names}
+            for scenario, ams in zip(available, results):
+                features[helpers.scenario_name(scenario)] = feature_engineering.create_feature_dict(dict(listing, lat=lat, lon=lon, amenities=ams))
+            metrics.count("scored_total", source=source)
+            return {"address": request.get("address"), "lat": lat, "lon": lon, "geocoded": source, "features": features, "missing": missing}
+
+    def score_batch(self, requests):
+        """Features of many listings, see score, in the order of requests."""
+        return [self.score(request) for request in requests]
+
+    def serve(self, host="127.0.0.1", port=8000):
+        """Start the http endpoint in a background thread, returns the server (call shutdown() to stop it)."""
+        server = ThreadingHTTPServer((host, port), self.handler())
+        server.daemon_threads = True
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        print(f"scoring service listening on http://{host}:{server.server_port}")
+        return server
+
+    def handler(self):
+        service = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def log_message(self, *args):
+                pass
+
+            def reply(self, status, body):
+                data = json.dumps(body, ensure_ascii=False).encode("utf-8")
+                self.send_response(status)
+                self.send_header("Content-Type", "application/json")
+                self.send_header("Content-Length", str(len(data)))
+                self.end_headers()
+                self.wfile.write(data)
+
+            def do_GET(self):
+                url = urlparse(self.path)
+                if url.path == "/health":
+                    self.reply(200, {"status": "ok", "amenities": len(service.index), "isochrones": len(service.isochrones),
+                                     "geocodes": len(service.geocodes), "scenarios": service.names})
+                elif url.path == "/score":
+                    params = {k: v[0] for k, v in parse_qs(url.query).items()}
+                    try:
+                        self.reply(200, service.score(params))
+                    except (ValueError, TypeError) as e:
+                        self.reply(400, {"error": str(e)})
+                else:
+                    self.reply(404, {"error": "not found"})
+
+            def do_POST(self):
+                if urlparse(self.path).path != "/score":
+                    self.reply(404, {"error": "not found"})
+                    return
+                try:
+                    body = json.loads(self.rfile.read(int(self.headers.get("Content-Length", 0))) or b"{}")
+                    self.reply(200, service.score_batch(body) if isinstance(body, list) else service.score(body))
+                except (ValueError, TypeError, AttributeError) as e:
+                    self.reply(400, {"error": str(e)})
+
+        return Handler
+
+
+def percentiles(latencies):
+    # p50 / p99 / max in milliseconds
+    ms = np.asarray(latencies, dtype=float) * 1000
+    return {"p50_ms": round(float(np.percentile(ms, 50)), 3), "p99_ms": round(float(np.percentile(ms, 99)), 3),
+            "max_ms": round(float(ms.max()), 3), "requests": len(ms)}
+
+
+def run_latency_benchmark(n_requests=200, by_address=False, http=True, output_file=None, seed=0, **service_kwargs):
+    """
+    Latency of the scoring service: startup, the first (cold) pass over n listings
+    and a second (warm) pass over the same listings, through the python api and
+    the http endpoint, and the throughput of one batch request.
+
+    :param n_requests: Number of listings, sampled from the geocoded properties
+    :param by_address: Send addresses instead of coordinates
+    :param output_file: Optional json file for the results
+    :return: Dict of results
+    """
+    import urllib.request
+    props = [p for p in helpers.read_json_clean("rental_properties_geocoded.json") if p.get("lat") is not None]
+    sample = random.Random(seed).sample(props, min(n_requests, len(props)))
+    requests = [{"address": p["address"]} if by_address else {"lat": p["lat"], "lon": p["lon"]} for p in sample]
+    for request, p in zip(requests, sample):
+        request.update({field: p[field] for field in ("property_id", "rooms", "area") if field in p})
+
+    start = time.perf_counter()
+    service = ScoringService(**service_kwargs)
+    results = {"startup_seconds": round(time.perf_counter() - start, 3), "by_address": by_address}
+    for name in ("cold", "warm"):
+        latencies = []
+        for request in requests:
+            t = time.perf_counter()
+            service.score(request)
+            latencies.append(time.perf_counter() - t)
+        results[f"api_{name}"] = percentiles(latencies)
+    t = time.perf_counter()
+    service.score_batch(requests)
+    results["api_batch_per_listing_ms"] = round((time.perf_counter() - t) * 1000 / len(requests), 3)
+
+    if http:
+        server = service.serve(port=0)
+        url = f"http://127.0.0.1:{server.server_port}/score"
+        latencies = []
+        for request in requests:
+            data = json.dumps(request).encode("utf-8")
+            t = time.perf_counter()
+            with urllib.request.urlopen(urllib.request.Request(url, data=data, headers={"Content-Type": "application/json"})) as response:
+                response.read()
+            latencies.append(time.perf_counter() - t)
+        results["http_warm"] = percentiles(latencies)
+        t = time.perf_counter()
+        data = json.dumps(requests).encode("utf-8")
+        with urllib.request.urlopen(urllib.request.Request(url, data=data, headers={"Content-Type": "application/json"})) as response:
+            response.read()
+        results["http_batch_per_listing_ms"] = round((time.perf_counter() - t) * 1000 / len(requests), 3)
+        server.shutdown()
+        server.server_close()
+
+    print(json.dumps(results, indent=2))
+    if output_file:
+        with open(output_file, "w", encoding="utf-8") as f:
+            json.dump(results, f, indent=2)
+        print(f"results saved to {output_file}")
+    return results
+
+
+def main():
+    if sys.argv[1:2] == ["benchmark"]:
+        run_latency_benchmark()
+        return
+    port = int(sys.argv[1]) if len(sys.argv) > 1 else 8000
+    server = ScoringService().serve(port=port)
+    try:
+        threading.Event().wait()
+    except KeyboardInterrupt:
+        server.shutdown()
+
+
+if __name__ == "__main__":
+    main()
@@ -1,21 +1,55 @@
+import os
+import re
+import threading
 import time
+from concurrent.futures import ThreadPoolExecutor
 import helpers
-from selenium import webdriver
-from selenium.webdriver.common.by import By
-from selenium.webdriver.chrome.options import Options
-import pandas as pd
+from bs4 import BeautifulSoup
 
-chrome_options = Options()
-chrome_options.add_experimental_option("detach", True)
+# optional fast html parser, falls back to the parser of the standard library
+try:
+    import lxml
+    html_parser = "lxml"
+except ImportError:
+    html_parser = "html.parser"
 
-# Initialize the Chrome driver
-driver = webdriver.Chrome(options=chrome_options)
+base_url = 'https://www.homegate.ch/mieten/immobilien/land-schweiz/trefferliste?ep='
 
-def getPageRentals(pageNr, rental):
-    # Construct the URL for the page
-    url = 'https://www.homegate.ch/mieten/immobilien/land-schweiz/trefferliste?ep=' + pageNr
+# one chrome driver per worker thread, created on first use
+local = threading.local()
+drivers = []
+drivers_lock = threading.Lock()
+
+def create_driver(headless=True):
+    from selenium import webdriver
+    from selenium.webdriver.chrome.options import Options
+    chrome_options = Options()
+    if headless:
+        chrome_options.add_argument("--headless=new")
+    else:
+        chrome_options.add_experimental_option("detach", True)
+    return webdriver.Chrome(options=chrome_options)
+
+def get_driver(headless=True):
+    if getattr(local, "driver", None) is None:
+        local.driver = create_driver(headless)
+        with drivers_lock:
+            drivers.append(local.driver)
+    return local.driver
+
+def quit_drivers():
+    # It's a good practice to close the browsers when done
+    with drivers_lock:
+        for driver in drivers:
+            driver.quit()
+        drivers.clear()
+
+def getPageRentals(pageNr, rental, driver=None):
+    # selenium version of parse_rentals, kept for interactive use
+    from selenium.webdriver.common.by import By
+    driver = driver or get_driver(headless=False)
     # Navigate to the URL
-    driver.get(url)
+    driver.get(base_url + pageNr)
     rentalProperties = driver.find_elements(By.CSS_SELECTOR, '[role="listitem"]')
     # Check if rentalProperties is empty
     if len(rentalProperties) == 0:
@@ -25,16 +59,17 @@ def getPageRentals(pageNr, rental):
     for rentalProperty in rentalProperties:
         property_id = rentalProperty.find_element(By.CSS_SELECTOR, 'a[href*="/mieten/"]').get_attribute('href')
         # Check if the property_id is empty or does not contain a number
-        if not property_id and helpers.has_numbers(property_id):
+        if not property_id or not helpers.has_numbers(property_id):
             print("Property ID not found.")
             continue
         #only get number after the last "/"
         try:
             property_id = int(property_id.split("/")[-1])
-            price = rentalProperty.find_element(By.XPATH, "//*[contains(@class, 'HgListingCard_price')]").text
+            # relative xpaths (".//"), so only the subtree of this card is searched
+            price = rentalProperty.find_element(By.XPATH, ".//*[contains(@class, 'HgListingCard_price')]").text
             price = helpers.parse_price(price)
             address = rentalProperty.find_element(By.TAG_NAME, "address").text
-            space = rentalProperty.find_element(By.XPATH, "//*[contains(@class, 'HgListingRoomsLivingSpace_rooms')]")
+            space = rentalProperty.find_element(By.XPATH, ".//*[contains(@class, 'HgListingRoomsLivingSpace_rooms')]")
             space = space.find_elements(By.CSS_SELECTOR, 'strong')
             rooms = float(space[0].text) if len(space) > 0 else None
             area = space[1].text if len(space) > 1 else None
@@ -50,27 +85,147 @@ def getPageRentals(pageNr, rental):
             continue
     return rental
 
-# Set the maximum number of pages to scrape
-maxPages = 51
-# Initialize an empty list to store the rental properties
-rental = []
-for i in range(1, maxPages):
-    pageNr = str(i)
-    print("Scraping page " + pageNr)
-    rental = getPageRentals(pageNr, rental)
-    if i % 10 == 0:
-        print("Sleeping for 3 seconds...")
-        time.sleep(3)
-
-# Save the data to a JSON file
-df = pd.DataFrame(rental)
-filename = 'rental_properties.json'
-df.to_json(filename, orient='records', lines=True)
-
-#quickfix to save the data in a readable format
-with open(filename, 'w', encoding='utf-8') as file:
-    df.to_json(file, force_ascii=False, orient='records', lines=True)
-print("Data saved to " + filename)
-
-# It's a good practice to close the browser when done
-driver.quit()
\ No newline at end of file
+def text_of(element):
+    # whitespace normalized text, like the .text of a selenium element
+    return " ".join(element.get_text(" ").split()) if element is not None else None
+
+def parse_card(card):
+    """
+    Extract one rental property from the html subtree of its listing card.
+
+    :param card: BeautifulSoup element of a [role="listitem"] card
+    :return: Property dict, or None if the card has no property id
+    """
+    link = card.select_one('a[href*="/mieten/"]')
+    property_id = link.get("href") if link is not None else None
+    # Check if the property_id is empty or does not contain a number
+    if not property_id or not helpers.has_numbers(property_id):
+        print("Property ID not found.")
+        return None
+    # only the card subtree is searched, not the whole page
+    price = text_of(card.select_one('[class*="HgListingCard_price"]'))
+    space = card.select_one('[class*="HgListingRoomsLivingSpace_rooms"]')
+    space = space.find_all("strong") if space is not None else []
+    return {
+        'address': text_of(card.find("address")),
+        'price': helpers.parse_price(price) if price else None,
+        #only get number after the last "/"
+        'property_id': int(property_id.rstrip("/").split("/")[-1]),
+        'area': text_of(space[1]) if len(space) > 1 else None,
+        'rooms': float(text_of(space[0])) if len(space) > 0 else None
+    }
+
+def parse_rentals(html):
+    """
+    Parse all listing cards of a result page.
+
+    :param html: Page source of a result page
+    :return: List of property dicts in page order
+    """
+    soup = BeautifulSoup(html, html_parser)
+    rental = []
+    for card in soup.select('[role="listitem"]'):
+        try:
+            prop = parse_card(card)
+        except Exception as e:
+            print(f"Error extracting data from rental property: {e}")
+            continue
+        if prop is not None:
+            rental.append(prop)
+    return rental
+
+def fetch_page(pageNr, html_dir=None, headless=True, page_delay=1):
+    # load a result page in the driver of this worker, optionally keep the html as fixture
+    driver = get_driver(headless)
+    driver.get(base_url + str(pageNr))
+    html = driver.page_source
+    if html_dir:
+        with open(os.path.join(html_dir, f"page_{pageNr}.html"), "w", encoding="utf-8") as f:
+            f.write(html)
+    # be nice to the server, every worker waits between its pages
+    time.sleep(page_delay)
+    return html
+
+def write_new_rentals(output_file, rental, seen):
+    # append the rows that are not in the output yet, deduplicated by property_id
+    new = [prop for prop in rental if prop['property_id'] not in seen]
+    seen.update(prop['property_id'] for prop in new)
+    return helpers.write_json_stream(output_file, new, append=True)
+
+def load_seen_ids(output_file):
+    if not os.path.exists(output_file):
+        return set()
+    return {prop.get('property_id') for prop in helpers.iter_json_clean(output_file)}
+
+def scrape_pages(page_numbers, output_file, workers=4, html_dir=None, headless=True, page_delay=1):
+    """
+    Scrape result pages with a pool of browser workers.
+
+    Every worker has its own chrome driver, the page html is parsed with
+    parse_rentals and the rows are appended to output_file as soon as a page
+    is done (in page order), skipping property ids that are already in it.
+
+    :param page_numbers: Result pages to load
+    :param output_file: Json lines file the rental properties are appended to
+    :param workers: Number of parallel browsers
+    :param html_dir: Optional directory to keep the page html in, for parse_saved_pages
+    :param page_delay: Seconds every worker waits after a page
+    :return: Number of new rental properties written
+    """
+    if html_dir:
+        os.makedirs(html_dir, exist_ok=True)
+    seen = load_seen_ids(output_file)
+    count = 0
+    try:
+        with ThreadPoolExecutor(max_workers=workers) as pool:
+            pages = pool.map(lambda pageNr: fetch_page(pageNr, html_dir, headless, page_delay), page_numbers)
+            for pageNr, html in zip(page_numbers, pages):
+                rental = parse_rentals(html)
+                if not rental:
+                    print(f"No rental properties found on page {pageNr}.")
+                    continue
+                written = write_new_rentals(output_file, rental, seen)
+                count += written
+                print(f"page {pageNr}: {len(rental)} rental properties, {written} new")
+    finally:
+        quit_drivers()
+    return count
+
+def parse_saved_pages(html_dir, output_file):
+    """
+    Parse-only mode: extract the rental properties of saved result pages, no browser needed.
+
+    :param html_dir: Directory with page_<nr>.html files, e.g. from scrape_pages(html_dir=...)
+    :param output_file: Json lines file the rental properties are appended to
+    :return: Number of new rental properties written
+    """
+    files = sorted((f for f in os.listdir(html_dir) if f.endswith(".html")),
+                   key=lambda f: int(re.sub(r"\D", "", f) or 0))
+    seen = load_seen_ids(output_file)
+    count = 0
+    for file_name in files:
+        with open(os.path.join(html_dir, file_name), "r", encoding="utf-8") as f:
+            rental = parse_rentals(f.read())
+        written = write_new_rentals(output_file, rental, seen)
+        count += written
+        print(f"{file_name}: {len(rental)} rental properties, {written} new")
+    return count
+
+def main():
+    filename = 'rental_properties.json'
+    # Set the maximum number of pages to scrape
+    maxPages = 51
+    # number of parallel browsers
+    workers = 4
+    # keep the html of every page, to parse it again without a browser
+    html_dir = None
+    # parse saved pages from html_dir instead of loading them
+    parse_only = False
+    if parse_only:
+        count = parse_saved_pages(html_dir, filename)
+    else:
+        count = scrape_pages(range(1, maxPages), filename, workers=workers, html_dir=html_dir)
+    print(f"{count} new rental properties saved to {filename}")
+
+if __name__ == "__main__":
+    main()